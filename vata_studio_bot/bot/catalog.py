@@ -0,0 +1,190 @@
+﻿"""
+Каталог тарифов и моделей.
+
+Страницы списков и карточки позиций (текст + клавиатура) строятся один раз
+на загрузку таблиц и дальше только выдаются по номеру, поэтому нажатие на
+кнопку стоит одинаково при любом размере каталога. Загрузка таблиц заменяет
+списки в кэше GoogleSheetsClient новыми объектами - по этому признаку
+каталог понимает, что данные обновились, и перестраивается.
+
+Формат callback_data (версия - номер построения каталога, кнопки старых
+сообщений после обновления данных не открывают чужие позиции):
+    tariffs_<версия>_<страница>, models_<версия>_<страница> - страница списка
+    tariff_<версия>_<номер>, model_<версия>_<номер>         - карточка позиции
+"""
+
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+from bot.keyboards import get_card_keyboard, get_catalog_keyboard
+from utils.helpers import format_model_response, format_tariff_response, truncate_text
+
+logger = logging.getLogger(__name__)
+
+Page = Tuple[str, InlineKeyboardMarkup]
+
+_EMPTY: Tuple = ()  # Все пустые источники считаются одними и теми же данными
+
+class CatalogPages:
+    """Готовые страницы и карточки каталога для текущих данных таблиц"""
+
+    # Заголовки и подсказки страниц списков
+    TITLES = {'tariffs': '📋 Наши тарифы:', 'models': '👥 Наши модели:'}
+    HINTS = {
+        'tariffs': 'Нажмите на тариф или напишите его название для подробностей',
+        'models': 'Нажмите на модель или напишите ее имя для подробностей'
+    }
+
+    def __init__(self, tariffs_per_page: int = 8, models_per_page: int = 8):
+        self.per_page = {'tariffs': tariffs_per_page, 'models': models_per_page}
+
+        # Списки, из которых построен каталог (сравниваются по идентичности)
+        self._sources: Dict[str, Optional[Sequence[Dict[str, Any]]]] = {'tariffs': None, 'models': None}
+
+        # tariffs/models - страницы списков, tariff/model - карточки
+        self._entries: Dict[str, List[Page]] = {'tariffs': [], 'models': [], 'tariff': [], 'model': []}
+
+        # Версия построения (время в секундах, не повторяется и после перезапуска)
+        self.version = 0
+
+        # id словаря позиции -> номер карточки (для ответов на найденный текстом тариф/модель)
+        self._card_index: Dict[int, Tuple[str, int]] = {}
+
+        # Статистика
+        self.stats = {
+            'builds': 0,
+            'hits': 0,
+            'misses': 0
+        }
+
+    # ================== ПОСТРОЕНИЕ ==================
+
+    def sync(self, tariffs: Sequence[Dict[str, Any]], models: Sequence[Dict[str, Any]]) -> bool:
+        """
+        Перестроение каталога, если данные таблиц сменились
+
+        Returns:
+            True, если каталог был перестроен
+        """
+        tariffs, models = tariffs or _EMPTY, models or _EMPTY
+        if self._sources['tariffs'] is tariffs and self._sources['models'] is models:
+            return False
+
+        self.build(tariffs, models)
+        return True
+
+    def build(self, tariffs: Sequence[Dict[str, Any]], models: Sequence[Dict[str, Any]]):
+        """Построение всех страниц и карточек"""
+        self.version = max(self.version + 1, int(time.time()))
+        self._card_index = {}
+        self._entries['tariffs'], self._entries['tariff'] = self._build_section(
+            'tariffs', 'tariff', tariffs, format_tariff_response
+        )
+        self._entries['models'], self._entries['model'] = self._build_section(
+            'models', 'model', models, format_model_response
+        )
+        self._sources = {'tariffs': tariffs, 'models': models}
+        self.stats['builds'] += 1
+
+        logger.info(f"📚 Каталог построен: {len(self._entries['tariffs'])} стр. тарифов, "
+                    f"{len(self._entries['models'])} стр. моделей")
+
+    def _build_section(self, kind: str, card_kind: str, items: Sequence[Dict[str, Any]],
+                       format_card) -> Tuple[List[Page], List[Page]]:
+        """Страницы списка и карточки одного раздела"""
+        per_page = self.per_page[kind]
+        page_prefix = f"{kind}_{self.version}"
+        total_pages = (len(items) + per_page - 1) // per_page
+        pages: List[Page] = []
+        cards: List[Page] = []
+
+        for page in range(total_pages):
+            start = page * per_page
+            chunk = items[start:start + per_page]
+            buttons = []
+            lines = [f"<b>{self.TITLES[kind]}</b> (стр. {page + 1}/{total_pages})\n"]
+
+            for i, item in enumerate(chunk, start):
+                label, item_lines = self._render_item(kind, i + 1, item)
+                lines.extend(item_lines)
+                lines.append("")
+                buttons.append((truncate_text(f"{i + 1}. {label}", 60), f"{card_kind}_{self.version}_{i}"))
+
+                cards.append((format_card(item), get_card_keyboard(f"{page_prefix}_{page}")))
+                self._card_index[id(item)] = (card_kind, i)
+
+            lines.append(f"<i>{self.HINTS[kind]}</i>")
+            keyboard = get_catalog_keyboard(buttons, page_prefix, page, page + 1 < total_pages)
+            pages.append(("\n".join(lines), keyboard))
+
+        return pages, cards
+
+    @staticmethod
+    def _render_item(kind: str, number: int, item: Dict[str, Any]) -> Tuple[str, List[str]]:
+        """Подпись кнопки и строки позиции в списке"""
+        if kind == 'tariffs':
+            name = item.get("Название тарифа", f"Тариф {number}")
+            price = item.get("Цена за 1 арт, руб.", "?")
+            frames = item.get("Количество кадров", "?")
+            desc = truncate_text(item.get("Описание", ""), 53)
+
+            lines = [
+                f"{number}. <b>{name}</b>",
+                f"   💰 Цена: {price}₽",
+                f"   📸 Кадров: {frames}"
+            ]
+            if desc:
+                lines.append(f"   📝 {desc}")
+            return f"{name} - {price}₽", lines
+
+        name = item.get("Имя", "Без имени")
+        height = item.get("Рост", "?")
+        shooting_type = item.get("Тип съемок", "")
+
+        lines = [f"{number}. <b>{name}</b> - рост {height} см"]
+        if shooting_type:
+            lines.append(f"   🎬 {shooting_type}")
+        return f"{name}, {height} см", lines
+
+    # ================== ВЫДАЧА ==================
+
+    def lookup(self, kind: str, number: int, version: Optional[int] = None) -> Optional[Page]:
+        """
+        Готовая страница или карточка
+
+        Args:
+            kind: tariffs/models (страница) или tariff/model (карточка)
+            number: Номер страницы или позиции
+            version: Версия каталога из callback_data (None - текущая)
+
+        Returns:
+            (текст, клавиатура) или None, если такой нет или данные обновились
+        """
+        entries = self._entries.get(kind)
+        if entries is None or not 0 <= number < len(entries) or version not in (None, self.version):
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        return entries[number]
+
+    def card_for(self, item: Dict[str, Any]) -> Optional[Page]:
+        """Карточка позиции из текущих данных (найденной поиском по тексту)"""
+        found = self._card_index.get(id(item))
+        return self.lookup(*found) if found else None
+
+    def page_count(self, kind: str) -> int:
+        return len(self._entries.get(kind, []))
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика и размер каталога"""
+        return {
+            **self.stats,
+            'version': self.version,
+            'tariff_pages': len(self._entries['tariffs']),
+            'model_pages': len(self._entries['models']),
+            'cards': len(self._entries['tariff']) + len(self._entries['model'])
+        }
@@ -1,19 +1,30 @@
-﻿from aiogram import Router, F
-from aiogram.filters import Command, CommandStart
+﻿from aiogram import Bot, Router, F
+from aiogram.filters import Command, CommandStart, CommandObject
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 import asyncio
+import html
 import logging
+import re
+from datetime import datetime, timedelta, timezone
 
 from bot.states import UserStates
-from bot.keyboards import get_main_keyboard, get_tariffs_keyboard, get_models_keyboard
+from bot.middlewares import setup_middlewares, stage_metrics
+from bot.keyboards import get_main_keyboard, get_pagination_keyboard
+from bot.catalog import CatalogPages
 from data.gsheets import GoogleSheetsClient
 from data.database import ConversationDatabase
+from data.archive import MessageArchiver
+from data.sharding import shard_archive_dir
+from data.rollups import AnalyticsRollup, merge_daily_stats, merge_intent_stats
 from data.ai_assistant import AIAssistant
+from data.analysis import AnalysisContext
 from managers.notification import ManagerNotifier
 from managers.control import BotController
-from config import SHEETS_CONFIG, CACHE_SETTINGS
+from config import (SHEETS_CONFIG, CACHE_SETTINGS, HISTORY_SETTINGS, RETENTION_SETTINGS, ROLLUP_SETTINGS,
+                    CONTROLLER_STATE_SETTINGS, OUTBOUND_SETTINGS, NOTIFICATION_SETTINGS, CATALOG_SETTINGS)
 from utils.helpers import format_tariff_response, format_model_response
+from utils.outbound import OutboundScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -26,17 +37,178 @@ db_client = None
 ai_assistant = None
 manager_notifier = None
 bot_controller = None
+outbound = None
+message_archivers = []
+analytics_rollups = []
+
+# Фоновые задачи, запущенные при старте
+background_tasks = []
+
+def make_analysis(message: Message) -> AnalysisContext:
+    """Разбор сообщения, общий для middleware, обработчика и ИИ-ассистента"""
+    return AnalysisContext(message.text, message.from_user.id, ai_assistant, db_client, HISTORY_SETTINGS["depth"])
+
+# Общие этапы (доступ, сессия, интент, сохранение) выполняются в middleware
+setup_middlewares(
+    router,
+    get_controller=lambda: bot_controller,
+    get_db=lambda: db_client,
+    get_notifier=lambda: manager_notifier,
+    make_analysis=make_analysis,
+    answer=lambda message, text: reply(message, text)
+)
+
+# Последний поисковый запрос каждого менеджера (для листания страниц)
+SEARCH_PAGE_SIZE = 5
+search_queries = {}
+
+# Готовые страницы каталога тарифов и моделей (перестраиваются при загрузке таблиц)
+catalog = CatalogPages(CATALOG_SETTINGS["tariffs_per_page"], CATALOG_SETTINGS["models_per_page"])
+
+# ================== ЗАПУСК И ОСТАНОВКА ==================
+
+@router.startup()
+async def on_startup(bot: Bot):
+    """Запуск фоновых задач"""
+    global outbound
+    
+    # Все исходящие сообщения идут через общую очередь с лимитами Telegram
+    outbound = OutboundScheduler(bot, **OUTBOUND_SETTINGS)
+    await outbound.start()
+    if manager_notifier and manager_notifier.sender is None:
+        manager_notifier.sender = outbound
+    
+    if manager_notifier:
+        # Распределение вызовов и эскалация - по config (уведомитель создается вне модуля)
+        manager_notifier.router.set_strategy(NOTIFICATION_SETTINGS["routing"])
+        manager_notifier.sla_seconds = NOTIFICATION_SETTINGS["sla_seconds"]
+        
+        # Интервал сводок задается до запуска run_digest (при 0 события уходят сразу)
+        manager_notifier.digest_interval_seconds = NOTIFICATION_SETTINGS["digest_interval_seconds"]
+        
+        background_tasks.append(asyncio.create_task(manager_notifier.run_outbox()))
+        background_tasks.append(asyncio.create_task(manager_notifier.run_digest()))
+        background_tasks.append(asyncio.create_task(
+            manager_notifier.run_periodic_cleanup(NOTIFICATION_SETTINGS["cleanup_hours"])
+        ))
+    
+    if manager_notifier and bot_controller and manager_notifier.router.affinity is None:
+        # Закрепление пользователя за менеджером, который его переопределял
+        manager_notifier.router.affinity = bot_controller.get_manager_for_user
+    
+    if bot_controller:
+        bot_controller.typing_timers.on_expire = on_typing_timeout
+        background_tasks.append(asyncio.create_task(bot_controller.run_session_expiry()))
+        if bot_controller.state_store is not None:
+            background_tasks.append(asyncio.create_task(
+                bot_controller.run_snapshots(CONTROLLER_STATE_SETTINGS["snapshot_interval_seconds"])
+            ))
+    
+    if db_client:
+        # Сводки считаются по каждому шарду отдельно и складываются при чтении
+        for shard in getattr(db_client, "shards", [db_client]):
+            rollup = AnalyticsRollup(shard, batch_size=ROLLUP_SETTINGS["batch_size"])
+            analytics_rollups.append(rollup)
+            background_tasks.append(asyncio.create_task(
+                rollup.run_periodic(ROLLUP_SETTINGS["interval_seconds"])
+            ))
+    
+    if db_client and RETENTION_SETTINGS["enabled"]:
+        # У шардированной базы - свой архиватор и каталог на каждый шард; в архив уходят
+        # только сообщения, уже учтенные сводками шарда (до водяного знака)
+        shards = getattr(db_client, "shards", [db_client])
+        for i, shard in enumerate(shards):
+            archiver = MessageArchiver(
+                shard,
+                archive_dir=shard_archive_dir(RETENTION_SETTINGS["archive_dir"], i, len(shards)),
+                max_age_days=RETENTION_SETTINGS["max_age_days"],
+                batch_size=RETENTION_SETTINGS["batch_size"],
+                vacuum_pages=RETENTION_SETTINGS["vacuum_pages"],
+                history_cache=db_client.history_cache,
+                archive_limit=analytics_rollups[i].watermark
+            )
+            message_archivers.append(archiver)
+            background_tasks.append(asyncio.create_task(
+                archiver.run_periodic(RETENTION_SETTINGS["interval_seconds"])
+            ))
+
+@router.shutdown()
+async def on_shutdown():
+    """Остановка фоновых задач"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    
+    # Дописываем очереди шардов
+    if db_client and hasattr(db_client, "close"):
+        db_client.close()
+    
+    # Последний снимок состояния контроллера
+    if bot_controller:
+        bot_controller.close()
+    
+    # Идущие отправки outbox завершаются (через еще работающую очередь исходящих),
+    # недоставленные уведомления остаются в outbox до следующего запуска
+    if manager_notifier:
+        await manager_notifier.close()
+    
+    # Дожидаемся отправки очереди исходящих
+    if outbound:
+        await outbound.stop()
+
+async def reply(message: Message, text: str, **kwargs):
+    """Ответ пользователю через очередь исходящих (до запуска очереди - напрямую)"""
+    with stage_metrics.measure('send'):
+        if outbound:
+            return await outbound.answer(message, text, **kwargs)
+        return await message.answer(text, **kwargs)
+
+async def edit(message: Message, text: str, **kwargs):
+    """Редактирование сообщения бота через очередь исходящих (листание страниц)"""
+    with stage_metrics.measure('send'):
+        if outbound:
+            return await outbound.edit_text(message, text, **kwargs)
+        return await message.edit_text(text, **kwargs)
+
+def save_bot_reply(message: Message, text: str):
+    """Сохранение ответа бота в БД"""
+    if not db_client:
+        return
+    with stage_metrics.measure('db'):
+        db_client.save_message(
+            user_id=message.from_user.id,
+            username=message.from_user.username,
+            first_name=message.from_user.first_name,
+            last_name=message.from_user.last_name,
+            message=text,
+            is_bot=True
+        )
+
+async def on_typing_timeout(user_id: int, user_info: dict):
+    """Бот не ответил пользователю вовремя - сообщаем менеджеру"""
+    logger.info(f"⏰ Таймаут набора текста у user_id={user_id}")
+    bot_controller.record_typing_timeout(user_id)
+    
+    if manager_notifier:
+        user_info = user_info or {}
+        await manager_notifier.notify_typing_timeout(
+            user_id=user_id,
+            username=user_info.get('username'),
+            first_name=user_info.get('first_name'),
+            last_name=user_info.get('last_name')
+        )
 
 # ================== ОБРАБОТЧИКИ КОМАНД ==================
 
-@router.message(CommandStart())
+@router.message(CommandStart(), flags={"session": "start", "save": "command"})
 async def cmd_start(message: Message, state: FSMContext):
     """Обработчик команды /start"""
     await state.clear()
     
     # Проверяем, включен ли бот для пользователя
     if bot_controller and not bot_controller.is_bot_enabled_for_user(message.from_user.id):
-        await message.answer("⛔ Бот временно отключен для вас. Обратитесь к менеджеру.")
+        await reply(message, "⛔ Бот временно отключен для вас. Обратитесь к менеджеру.")
         return
     
     welcome_text = """
@@ -53,23 +225,8 @@ async def cmd_start(message: Message, state: FSMContext):
 <b>Выберите опцию ниже или напишите вопрос:</b>
     """
     
-    # Запускаем сессию
-    if bot_controller:
-        bot_controller.enable_bot_for_user(message.from_user.id)
-        bot_controller.record_user_message(message.from_user.id)
-    
-    # Сохраняем в БД
-    if db_client:
-        db_client.save_message(
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name,
-            message="/start",
-            is_bot=False
-        )
-    
-    await message.answer(welcome_text, reply_markup=get_main_keyboard())
+    # Сессия и сохранение в БД - в SessionMiddleware и SaveMessageMiddleware
+    await reply(message, welcome_text, reply_markup=get_main_keyboard())
     await state.set_state(UserStates.waiting_for_question)
 
 @router.message(Command("help"))
@@ -99,7 +256,7 @@ async def cmd_help(message: Message):
 модель = девушка = лицо для съемки
     """
     
-    await message.answer(help_text)
+    await reply(message, help_text)
 
 @router.message(Command("tariffs"))
 async def cmd_tariffs(message: Message):
@@ -125,11 +282,12 @@ async def cmd_debug(message: Message):
 async def cmd_stats(message: Message):
     """Обработчик команды /stats - статистика пользователя"""
     if not db_client or not bot_controller:
-        await message.answer("❌ Статистика временно недоступна")
+        await reply(message, "❌ Статистика временно недоступна")
         return
     
     # Статистика из базы данных
-    db_stats = db_client.get_user_stats(message.from_user.id)
+    with stage_metrics.measure('db'):
+        db_stats = db_client.get_user_stats(message.from_user.id)
     
     # Статистика из контроллера
     session_info = bot_controller.get_user_session_info(message.from_user.id)
@@ -151,13 +309,98 @@ async def cmd_stats(message: Message):
         stats_text += f"• Сообщений: {session_info['message_count']}\n"
         stats_text += f"• Ответов ИИ: {session_info['ai_responses']}\n"
     
-    await message.answer(stats_text)
+    await reply(message, stats_text)
 
 @router.message(Command("manager"))
 async def cmd_manager(message: Message):
     """Обработчик команды /manager - вызов менеджера"""
     await call_manager(message)
 
+@router.message(Command("globalstats"))
+async def cmd_globalstats(message: Message):
+    """Обработчик команды /globalstats - общая статистика бота (только менеджеры)"""
+    if not is_manager(message.from_user.id):
+        await reply(message, "⛔ Команда доступна только менеджерам.")
+        return
+    
+    if not analytics_rollups:
+        await reply(message, "❌ Статистика временно недоступна")
+        return
+    
+    days = ROLLUP_SETTINGS["report_days"]
+    daily = merge_daily_stats([rollup.get_daily_stats(days) for rollup in analytics_rollups])
+    intents = merge_intent_stats([rollup.get_intent_stats(days) for rollup in analytics_rollups])
+    
+    stats_text = f"<b>📈 Статистика бота за {days} дн.:</b>\n\n"
+    
+    if daily:
+        stats_text += "<b>По дням</b> (сообщений / пользователей):\n"
+        for row in daily:
+            stats_text += f"• {row['day']}: {row['total_messages']} / {row['active_users']}\n"
+        
+        total = sum(row['total_messages'] for row in daily)
+        user_total = sum(row['user_messages'] for row in daily)
+        stats_text += f"\n<b>Всего сообщений:</b> {total} (от пользователей: {user_total})\n"
+    else:
+        stats_text += "Нет данных за период.\n"
+    
+    if intents:
+        stats_text += "\n<b>Запросы по темам:</b>\n"
+        for intent, count in intents.items():
+            stats_text += f"• {intent}: {count}\n"
+    
+    await reply(message, stats_text)
+
+@router.message(Command("handled"))
+async def cmd_handled(message: Message, command: CommandObject):
+    """Обработчик команды /handled - вызов пользователя обработан (только менеджеры)"""
+    if not is_manager(message.from_user.id):
+        await reply(message, "⛔ Команда доступна только менеджерам.")
+        return
+    
+    args = (command.args or "").strip()
+    if not args.isdigit():
+        await reply(message, "Использование: <code>/handled ID_пользователя</code>")
+        return
+    
+    if manager_notifier.mark_notification_handled(int(args), message.from_user.id):
+        await reply(message, f"✅ Вызов пользователя {args} закрыт.")
+    else:
+        await reply(message, f"ℹ️ У пользователя {args} нет открытых вызовов.")
+
+@router.message(Command("search"))
+async def cmd_search(message: Message, command: CommandObject):
+    """Обработчик команды /search - поиск по истории диалогов (только менеджеры)"""
+    if not is_manager(message.from_user.id):
+        await reply(message, "⛔ Команда доступна только менеджерам.")
+        return
+    
+    if not db_client or not db_client.fts_enabled:
+        await reply(message, "❌ Поиск по истории временно недоступен")
+        return
+    
+    query = (command.args or "").strip()
+    
+    # Необязательный период в конце запроса: "vata prod 7d" / "vata prod 7д"
+    since = None
+    period = re.search(r'\s+(\d+)\s*[dд]$', query)
+    if period:
+        days = int(period.group(1))
+        since = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        query = query[:period.start()].strip()
+    
+    if not query:
+        await reply(message,
+            "🔎 <b>Поиск по истории</b>\n\n"
+            "Использование: <code>/search запрос [N]d</code>\n"
+            "Например: <code>/search vata prod 7d</code>"
+        )
+        return
+    
+    search_queries[message.from_user.id] = {'query': query, 'since': since}
+    text, keyboard = render_search_page(message.from_user.id, 0)
+    await reply(message, text, reply_markup=keyboard)
+
 # ================== ОБРАБОТЧИКИ КНОПОК ==================
 
 @router.callback_query(F.data.startswith("menu_"))
@@ -180,73 +423,113 @@ async def handle_menu_callback(callback: CallbackQuery, state: FSMContext):
     
     await callback.answer()
 
-# ================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==================
-
-async def show_tariffs(message: Message):
-    """Показать все тарифы"""
-    if not gsheets_client or not gsheets_client.cache.get("tariffs"):
-        await message.answer("❌ Данные тарифов не загружены. Используйте /reload")
+@router.callback_query(F.data.startswith("search_"))
+async def handle_search_page(callback: CallbackQuery):
+    """Листание результатов поиска"""
+    if not is_manager(callback.from_user.id) or callback.from_user.id not in search_queries:
+        await callback.answer("Запрос устарел, выполните /search заново")
         return
     
-    tariffs = gsheets_client.cache.get("tariffs", [])
+    page = int(callback.data.split("_")[1])
+    text, keyboard = render_search_page(callback.from_user.id, page)
+    await edit(callback.message, text, reply_markup=keyboard)
+    await callback.answer()
+
+@router.callback_query(F.data.regexp(r"^(tariffs|models|tariff|model)_\d+_\d+$"))
+async def handle_catalog_callback(callback: CallbackQuery):
+    """Листание каталога и карточки тарифов и моделей (готовые страницы)"""
+    kind, version, number = callback.data.split("_")
     
-    if not tariffs:
-        await message.answer("⚠️ Тарифы не найдены в таблице")
+    entry = get_catalog().lookup(kind, int(number), int(version))
+    if entry is None:
+        await callback.answer("Данные обновились, откройте список заново")
         return
     
-    response = ["<b>📋 Наши тарифы:</b>\n"]
-    
-    for i, tariff in enumerate(tariffs[:10], 1):
-        name = tariff.get("Название тарифа", f"Тариф {i}")
-        price = tariff.get("Цена за 1 арт, руб.", "?")
-        frames = tariff.get("Количество кадров", "?")
-        desc = tariff.get("Описание", "")[:50] + "..." if len(tariff.get("Описание", "")) > 50 else tariff.get("Описание", "")
+    text, keyboard = entry
+    await edit(callback.message, text, reply_markup=keyboard)
+    await callback.answer()
+
+# ================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==================
+
+def is_manager(user_id: int) -> bool:
+    """Является ли пользователь менеджером"""
+    return bool(manager_notifier) and user_id in manager_notifier.manager_ids
+
+def get_catalog() -> CatalogPages:
+    """Каталог для текущих данных таблиц (перестраивается, только если данные сменились)"""
+    if gsheets_client:
+        with stage_metrics.measure('catalog'):
+            catalog.sync(gsheets_client.cache.get("tariffs", []), gsheets_client.cache.get("models", []))
+    return catalog
+
+def render_search_page(manager_id: int, page: int):
+    """Страница результатов поиска для менеджера"""
+    search = search_queries[manager_id]
+    
+    # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+    hits = db_client.search_messages(
+        search['query'],
+        limit=SEARCH_PAGE_SIZE + 1,
+        offset=page * SEARCH_PAGE_SIZE,
+        since=search['since']
+    )
+    has_next = len(hits) > SEARCH_PAGE_SIZE
+    hits = hits[:SEARCH_PAGE_SIZE]
+    
+    text = f"🔎 <b>Поиск:</b> {html.escape(search['query'])} (стр. {page + 1})\n"
+    
+    if not hits:
+        text += "\nНичего не найдено."
+    
+    for i, hit in enumerate(hits, page * SEARCH_PAGE_SIZE + 1):
+        name = " ".join(filter(None, [hit['first_name'], hit['last_name']])) or "Без имени"
+        user_info = html.escape(name)
+        if hit['username']:
+            user_info += f" (@{html.escape(hit['username'])})"
         
-        response.append(f"{i}. <b>{name}</b>")
-        response.append(f"   💰 Цена: {price}₽")
-        response.append(f"   📸 Кадров: {frames}")
-        if desc:
-            response.append(f"   📝 {desc}")
-        response.append("")
+        snippet = html.escape(hit['snippet']).replace("\x02", "<b>").replace("\x03", "</b>")
+        
+        text += f"\n{i}. 👤 {user_info}, ID: <code>{hit['user_id']}</code>\n"
+        text += f"   🕒 {hit['timestamp']}\n"
+        text += f"   💬 {snippet}\n"
+    
+    return text, get_pagination_keyboard("search", page, has_next)
+
+async def show_tariffs(message: Message):
+    """Показать первую страницу тарифов"""
+    if not gsheets_client or not gsheets_client.cache.get("tariffs"):
+        await reply(message, "❌ Данные тарифов не загружены. Используйте /reload")
+        return
     
-    if len(tariffs) > 10:
-        response.append(f"<i>И еще {len(tariffs) - 10} тарифов...</i>")
+    page = get_catalog().lookup("tariffs", 0)
     
-    response.append("\n<i>Напишите название тарифа для подробностей</i>")
+    if not page:
+        await reply(message, "⚠️ Тарифы не найдены в таблице")
+        return
     
-    await message.answer("\n".join(response), reply_markup=get_tariffs_keyboard())
+    text, keyboard = page
+    await reply(message, text, reply_markup=keyboard)
 
 async def show_models(message: Message):
-    """Показать всех моделей"""
+    """Показать первую страницу моделей"""
     if not gsheets_client or not gsheets_client.cache.get("models"):
-        await message.answer("❌ Данные моделей не загружены. Используйте /reload")
+        await reply(message, "❌ Данные моделей не загружены. Используйте /reload")
         return
     
-    models = gsheets_client.cache.get("models", [])
+    page = get_catalog().lookup("models", 0)
     
-    if not models:
-        await message.answer("⚠️ Модели не найдены в таблице")
+    if not page:
+        await reply(message, "⚠️ Модели не найдены в таблице")
         return
     
-    response = ["<b>👥 Наши модели:</b>\n"]
-    
-    for model in models[:15]:
-        name = model.get("Имя", "Без имени")
-        height = model.get("Рост", "?")
-        shooting_type = model.get("Тип съемок", "")
-        
-        response.append(f"• <b>{name}</b> - рост {height} см")
-        if shooting_type:
-            response.append(f"  🎬 {shooting_type}")
-        response.append("")
-    
-    await message.answer("\n".join(response), reply_markup=get_models_keyboard())
+    text, keyboard = page
+    await reply(message, text, reply_markup=keyboard)
 
 async def reload_data(message: Message):
     """Перезагрузить данные из таблиц"""
     global gsheets_client
     
-    await message.answer("🔄 Загружаю данные из таблиц...")
+    await reply(message, "🔄 Загружаю данные из таблиц...")
     
     if not gsheets_client:
         gsheets_client = GoogleSheetsClient(SHEETS_CONFIG, CACHE_SETTINGS)
@@ -254,6 +537,9 @@ async def reload_data(message: Message):
     try:
         data = await gsheets_client.load_all_data()
         
+        # Страницы каталога строятся сразу, а не на первом нажатии
+        get_catalog()
+        
         status_text = """
 ✅ <b>Данные успешно загружены!</b>
 
@@ -274,11 +560,11 @@ async def reload_data(message: Message):
 Или напишите ваш вопрос
         """
         
-        await message.answer(status_text)
+        await reply(message, status_text)
         
     except Exception as e:
         logger.error(f"Ошибка загрузки данных: {e}")
-        await message.answer("""
+        await reply(message, """
 ❌ <b>Не удалось загрузить данные.</b>
 
 <b>Возможные причины:</b>
@@ -299,6 +585,9 @@ async def show_debug_info(message: Message):
             if data_type in gsheets_client.cache:
                 count = len(gsheets_client.cache[data_type])
                 debug_text += f"• {data_type.capitalize()}: {count} записей\n"
+        
+        catalog_stats = catalog.get_stats()
+        debug_text += f"• Каталог: {catalog_stats['tariff_pages']} стр. тарифов, {catalog_stats['model_pages']} стр. моделей\n"
     
     # Информация о сессии
     if bot_controller:
@@ -320,16 +609,33 @@ async def show_debug_info(message: Message):
         debug_text += f"• Всего вызовов: {stats['total_calls']}\n"
         debug_text += f"• Обработано: {stats['handled_calls']}\n"
     
-    await message.answer(debug_text[:4000])
+    # Время этапов обработки за последние 5 минут
+    stages = stage_metrics.get_stats()
+    if stages:
+        debug_text += "\n<b>Этапы обработки (5 мин, медиана / 99%):</b>\n"
+        for name in sorted(stages, key=str):
+            window = stages[name]['window']
+            if window['count']:
+                debug_text += (f"• {name}: {window['p50'] * 1000:.1f} / {window['p99'] * 1000:.1f} мс "
+                               f"({window['count']})\n")
+    
+    await reply(message, debug_text[:4000])
 
-async def call_manager(message: Message):
+async def call_manager(message: Message, analysis: AnalysisContext = None):
     """Вызов менеджера"""
     user_id = message.from_user.id
     
-    # Получаем историю диалога для контекста
+    # Повторный вызов дописывается в уже отправленное уведомление - контекст не нужен
+    follow_up = bool(manager_notifier) and manager_notifier.has_active_call(user_id)
+    
+    # Получаем историю диалога для контекста (из разбора сообщения, если он уже ее читал)
     context = []
-    if db_client:
-        context = db_client.get_conversation_history(user_id, limit=3)
+    if db_client and not follow_up:
+        with stage_metrics.measure('db'):
+            if analysis is not None and analysis.history_depth >= 3:
+                context = analysis.history[-3:]
+            else:
+                context = db_client.get_conversation_history(user_id, limit=3)
     
     # Получаем последний вопрос пользователя
     last_question = message.text
@@ -347,89 +653,66 @@ async def call_manager(message: Message):
             context=context
         )
         
-        if success:
-            await message.answer("✅ <b>Менеджер уведомлен!</b>\n\nС вами свяжутся в ближайшее время.")
+        if success and follow_up:
+            await reply(message, "📝 <b>Добавили это к вашему вызову.</b>\n\nМенеджер увидит сообщение.")
+        elif success:
+            await reply(message, "✅ <b>Менеджер уведомлен!</b>\n\nС вами свяжутся в ближайшее время.")
         else:
-            await message.answer("⚠️ <b>Не удалось уведомить менеджера.</b>\n\nПопробуйте позже или напишите напрямую.")
+            await reply(message, "⚠️ <b>Не удалось уведомить менеджера.</b>\n\nПопробуйте позже или напишите напрямую.")
     else:
-        await message.answer("📞 <b>Вызов менеджера зарегистрирован.</b>\n\nС вами свяжутся при первой возможности.")
+        await reply(message, "📞 <b>Вызов менеджера зарегистрирован.</b>\n\nС вами свяжутся при первой возможности.")
 
 # ================== ОБРАБОТЧИКИ ТЕКСТА ==================
 
-@router.message(F.text)
-async def handle_text_message(message: Message, state: FSMContext):
-    """Обработка текстовых сообщений"""
-    user_text = message.text.strip()
+@router.message(F.text, flags={"access": True, "session": "message", "nlu": True, "save": True})
+async def handle_text_message(message: Message, state: FSMContext, needs_manager: bool = False,
+                              analysis: AnalysisContext = None):
+    """
+    Обработка текстовых сообщений
+    
+    Доступ, лимиты, сессия, интент (needs_manager) и сохранение сообщения
+    уже выполнены в middleware (bot/middlewares.py); analysis - общий
+    разбор сообщения, его результаты переиспользуются ниже.
+    """
+    if analysis is None:
+        analysis = make_analysis(message)
+    user_text = analysis.text
     user_id = message.from_user.id
     
     logger.info(f"👤 {user_id}: {user_text}")
     
-    # Проверяем, включен ли бот для пользователя
-    if bot_controller and not bot_controller.is_bot_enabled_for_user(user_id):
-        await message.answer("⛔ Бот временно отключен для вас. Обратитесь к менеджеру.")
-        return
-    
-    # Проверяем ограничение скорости сообщений
-    if bot_controller and not bot_controller.check_message_rate_limit(user_id):
-        await message.answer("⚠️ <b>Слишком много сообщений.</b>\n\nПожалуйста, подождите немного.")
-        return
-    
-    # Записываем активность пользователя
-    if bot_controller:
-        bot_controller.record_user_message(user_id)
-        bot_controller.start_typing_timer(user_id)
-    
-    # Сохраняем сообщение в БД
-    if db_client:
-        db_client.save_message(
-            user_id=user_id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name,
-            message=user_text,
-            is_bot=False
-        )
-    
     # Проверяем загружены ли данные
     if not gsheets_client or not gsheets_client.cache.get("tariffs"):
-        await message.answer("""
+        await reply(message, """
 ❌ <b>Данные не загружены.</b>
 
 Используйте команду <code>/reload</code> для загрузки данных из таблиц.
         """, reply_markup=get_main_keyboard())
         return
     
-    # Определяем, нужно ли вызывать менеджера
-    if manager_notifier and ai_assistant:
-        intent = ai_assistant.detect_intent(user_text)
-        if ai_assistant.should_call_manager(user_text, intent):
-            await call_manager(message)
-            return
+    # Вызываем менеджера, если это требуется
+    if needs_manager:
+        if bot_controller:
+            bot_controller.stop_typing_timer(user_id)
+        await call_manager(message, analysis)
+        return
     
     # Обрабатываем с помощью ИИ-ассистента
     if ai_assistant and ai_assistant.enabled:
         try:
             # Получаем историю для контекста
-            history = []
-            if db_client:
-                history = db_client.get_conversation_history(user_id, limit=AI_SETTINGS["max_context"])
+            with stage_metrics.measure('db'):
+                history = analysis.history
             
-            # Обрабатываем запрос через ИИ
-            response = await ai_assistant.process_query(user_text, user_id, history)
+            # Обрабатываем запрос через ИИ (интент и сущности - из разбора)
+            with stage_metrics.measure('ai'):
+                response = await ai_assistant.process_query(user_text, user_id, history, analysis=analysis)
             
             # Отправляем ответ
-            await message.answer(response, reply_markup=get_main_keyboard())
+            await reply(message, response, reply_markup=get_main_keyboard())
             
             # Записываем ответ бота
-            if db_client:
-                db_client.save_message(
-                    user_id=user_id,
-                    username=message.from_user.username,
-                    first_name=message.from_user.first_name,
-                    last_name=message.from_user.last_name,
-                    message=response,
-                    is_bot=True
-                )
+            save_bot_reply(message, response)
             
             # Записываем ответ ИИ в статистику
             if bot_controller:
@@ -446,26 +729,27 @@ async def handle_text_message(message: Message, state: FSMContext):
     
     # ========== ПОИСК ТАРИФОВ ==========
     tariff_keywords = ["тариф", "пакет", "услуг", "цена", "стоит", "кадр", "ракурс", "стоимость"]
-    if any(keyword in user_text.lower() for keyword in tariff_keywords):
+    if analysis.mentions(tariff_keywords):
+        if bot_controller:
+            bot_controller.stop_typing_timer(user_id)
+        
         tariffs = gsheets_client.cache.get("tariffs", [])
         synonyms = gsheets_client.cache.get("synonyms_dict", {})
         
-        found_tariff = gsheets_client.search_tariff(user_text, tariffs, synonyms)
+        with stage_metrics.measure('search'):
+            found_tariff = gsheets_client.search_tariff(user_text, tariffs, synonyms)
         
         if found_tariff:
-            response = format_tariff_response(found_tariff)
-            await message.answer(response)
+            card = get_catalog().card_for(found_tariff)
+            if card:
+                response, keyboard = card
+            else:
+                with stage_metrics.measure('render'):
+                    response, keyboard = format_tariff_response(found_tariff), None
+            await reply(message, response, reply_markup=keyboard)
             
             # Сохраняем ответ бота
-            if db_client:
-                db_client.save_message(
-                    user_id=user_id,
-                    username=message.from_user.username,
-                    first_name=message.from_user.first_name,
-                    last_name=message.from_user.last_name,
-                    message=response,
-                    is_bot=True
-                )
+            save_bot_reply(message, response)
             
         else:
             await show_tariffs(message)
@@ -473,24 +757,25 @@ async def handle_text_message(message: Message, state: FSMContext):
     
     # ========== ПОИСК МОДЕЛЕЙ ==========
     model_keywords = ["модель", "девушка", "парень", "рост", "портфолио", "когда свободн"]
-    if any(keyword in user_text.lower() for keyword in model_keywords):
+    if analysis.mentions(model_keywords):
+        if bot_controller:
+            bot_controller.stop_typing_timer(user_id)
+        
         models = gsheets_client.cache.get("models", [])
-        found_model = gsheets_client.search_model(user_text, models)
+        with stage_metrics.measure('search'):
+            found_model = gsheets_client.search_model(user_text, models)
         
         if found_model:
-            response = format_model_response(found_model)
-            await message.answer(response)
+            card = get_catalog().card_for(found_model)
+            if card:
+                response, keyboard = card
+            else:
+                with stage_metrics.measure('render'):
+                    response, keyboard = format_model_response(found_model), None
+            await reply(message, response, reply_markup=keyboard)
             
             # Сохраняем ответ бота
-            if db_client:
-                db_client.save_message(
-                    user_id=user_id,
-                    username=message.from_user.username,
-                    first_name=message.from_user.first_name,
-                    last_name=message.from_user.last_name,
-                    message=response,
-                    is_bot=True
-                )
+            save_bot_reply(message, response)
             
         else:
             await show_models(message)
@@ -513,17 +798,6 @@ async def handle_text_message(message: Message, state: FSMContext):
 Или напишите <code>менеджер</code> для связи со специалистом.
     """
     
-    await message.answer(unknown_response, reply_markup=get_main_keyboard())
-    
-    # Проверяем таймаут набора текста
-    if bot_controller:
-        if bot_controller.check_typing_timeout(user_id):
-            logger.info(f"⏰ Таймаут набора текста у user_id={user_id}")
-            # Можно уведомить менеджера о долгом наборе
-            if manager_notifier:
-                await manager_notifier.notify_typing_timeout(
-                    user_id=user_id,
-                    username=message.from_user.username,
-                    first_name=message.from_user.first_name,
-                    last_name=message.from_user.last_name
-                )
\ No newline at end of file
+    # Таймер набора не останавливаем: если пользователь так и не получит
+    # понятного ответа, менеджер узнает об этом по истечении таймера
+    await reply(message, unknown_response, reply_markup=get_main_keyboard())
\ No newline at end of file
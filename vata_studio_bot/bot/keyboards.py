@@ -1,4 +1,6 @@
-﻿from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+﻿from typing import List, Tuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 def get_main_keyboard() -> InlineKeyboardMarkup:
     """Основная клавиатура меню"""
@@ -35,4 +37,41 @@ def get_models_keyboard() -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="🔄 Обновить", callback_data="menu_reload"),
         ]
     ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def get_pagination_keyboard(prefix: str, page: int, has_next: bool) -> InlineKeyboardMarkup:
+    """Клавиатура листания страниц (callback_data: <prefix>_<номер страницы>)"""
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"{prefix}_{page - 1}"))
+    if has_next:
+        row.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"{prefix}_{page + 1}"))
+    
+    keyboard = [row] if row else []
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def get_catalog_keyboard(items: List[Tuple[str, str]], prefix: str, page: int, has_next: bool) -> InlineKeyboardMarkup:
+    """
+    Клавиатура страницы каталога
+    
+    Args:
+        items: Кнопки позиций (текст, callback_data), по одной в ряд
+        prefix: Префикс листания (callback_data: <prefix>_<номер страницы>)
+    """
+    keyboard = [[InlineKeyboardButton(text=text, callback_data=data)] for text, data in items]
+    keyboard.extend(get_pagination_keyboard(prefix, page, has_next).inline_keyboard)
+    keyboard.append([
+        InlineKeyboardButton(text="🏠 Меню", callback_data="menu_main"),
+        InlineKeyboardButton(text="🔄 Обновить", callback_data="menu_reload"),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def get_card_keyboard(back_callback: str) -> InlineKeyboardMarkup:
+    """Клавиатура карточки тарифа или модели"""
+    keyboard = [
+        [
+            InlineKeyboardButton(text="◀️ К списку", callback_data=back_callback),
+            InlineKeyboardButton(text="🏠 Меню", callback_data="menu_main"),
+        ]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
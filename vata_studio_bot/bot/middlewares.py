@@ -0,0 +1,182 @@
+﻿"""
+Middleware конвейера обработки сообщений.
+
+Общие для обработчиков этапы выполняются здесь один раз на сообщение
+и в постоянном порядке:
+
+    MetricsMiddleware (outer)  - общее время обработки сообщения
+    AccessMiddleware           - бот включен для пользователя, лимиты скорости
+    SessionMiddleware          - запись активности, запуск сессии и таймера набора
+    NLUMiddleware              - разбор сообщения (AnalysisContext): интент, нужен ли менеджер
+    SaveMessageMiddleware      - сохранение входящего сообщения в БД
+    обработчик                 - время каждого обработчика отдельно
+
+Какие этапы нужны обработчику, задается флагами декоратора, например
+@router.message(F.text, flags={"access": True, "session": "message", "nlu": True, "save": True}).
+Время каждого этапа пишется в общий реестр stage_metrics.
+"""
+
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, TelegramObject
+
+from utils.latency import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# Задержки этапов (controller, nlu, db, ai, render, catalog, send, handler:*, update) за последние 5 минут
+stage_metrics = LatencyStats(window_seconds=300, min_value=0.00001)
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+class MetricsMiddleware(BaseMiddleware):
+    """Общее время обработки сообщения (внешний middleware)"""
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        with stage_metrics.measure('update'):
+            return await handler(event, data)
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Время самого обработчика (последний внутренний middleware)"""
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        with stage_metrics.measure(f"handler:{name}"):
+            return await handler(event, data)
+
+class AccessMiddleware(BaseMiddleware):
+    """Проверка, включен ли бот для пользователя, и ограничение скорости (флаг access)"""
+
+    def __init__(self, get_controller: Callable[[], Any], answer: Callable[..., Awaitable[Any]]):
+        self.get_controller = get_controller
+        self.answer = answer
+
+    async def __call__(self, handler: Handler, event: Message, data: Dict[str, Any]) -> Any:
+        controller = self.get_controller()
+        if controller is None or not get_flag(data, 'access'):
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        with stage_metrics.measure('controller'):
+            enabled = controller.is_bot_enabled_for_user(user_id)
+            allowed = enabled and controller.check_message_rate_limit(user_id, event.chat.id)
+
+        if not enabled:
+            await self.answer(event, "⛔ Бот временно отключен для вас. Обратитесь к менеджеру.")
+            return None
+        if not allowed:
+            await self.answer(event, "⚠️ <b>Слишком много сообщений.</b>\n\nПожалуйста, подождите немного.")
+            return None
+
+        return await handler(event, data)
+
+class SessionMiddleware(BaseMiddleware):
+    """
+    Запись активности пользователя (флаг session)
+
+    session="start" - включить бот и начать сессию (/start); отключенному
+                      менеджером пользователю бот не включается, отказ
+                      отвечает сам обработчик,
+    session="message" - активность и таймер набора ответа.
+    """
+
+    def __init__(self, get_controller: Callable[[], Any]):
+        self.get_controller = get_controller
+
+    async def __call__(self, handler: Handler, event: Message, data: Dict[str, Any]) -> Any:
+        controller = self.get_controller()
+        mode = get_flag(data, 'session')
+        if controller is None or not mode:
+            return await handler(event, data)
+
+        user = event.from_user
+        with stage_metrics.measure('controller'):
+            if mode == 'start' and user.id not in controller.disabled_users:
+                controller.enable_bot_for_user(user.id)
+            controller.record_user_message(user.id)
+            if mode == 'message':
+                controller.start_typing_timer(user.id, {
+                    'username': user.username,
+                    'first_name': user.first_name,
+                    'last_name': user.last_name
+                })
+
+        return await handler(event, data)
+
+class NLUMiddleware(BaseMiddleware):
+    """
+    Разбор сообщения (флаг nlu)
+
+    В data кладутся analysis (AnalysisContext, общий для всех этапов),
+    intent и needs_manager.
+    """
+
+    def __init__(self, make_analysis: Callable[[Message], Any], get_notifier: Callable[[], Any]):
+        self.make_analysis = make_analysis
+        self.get_notifier = get_notifier
+
+    async def __call__(self, handler: Handler, event: Message, data: Dict[str, Any]) -> Any:
+        if not get_flag(data, 'nlu'):
+            return await handler(event, data)
+
+        analysis = self.make_analysis(event)
+        with stage_metrics.measure('nlu'):
+            intent: Optional[str] = analysis.intent
+            needs_manager = bool(self.get_notifier()) and analysis.needs_manager
+
+        data['analysis'] = analysis
+        data['intent'] = intent
+        data['needs_manager'] = needs_manager
+        return await handler(event, data)
+
+class SaveMessageMiddleware(BaseMiddleware):
+    """
+    Сохранение входящего сообщения (флаг save)
+
+    save=True - интент из NLUMiddleware, строка - заданный интент.
+    """
+
+    def __init__(self, get_db: Callable[[], Any]):
+        self.get_db = get_db
+
+    async def __call__(self, handler: Handler, event: Message, data: Dict[str, Any]) -> Any:
+        db = self.get_db()
+        save = get_flag(data, 'save')
+        if db is None or not save:
+            return await handler(event, data)
+
+        if isinstance(save, str):
+            intent = save
+        else:
+            intent = "manager_call" if data.get('needs_manager') else data.get('intent')
+
+        user = event.from_user
+        with stage_metrics.measure('db'):
+            db.save_message(
+                user_id=user.id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name,
+                message=(event.text or "").strip(),
+                is_bot=False,
+                intent=intent
+            )
+
+        return await handler(event, data)
+
+def setup_middlewares(router, get_controller, get_db, get_notifier, make_analysis, answer):
+    """
+    Подключение конвейера к роутеру сообщений
+
+    Сервисы передаются функциями, потому что создаются позже роутера.
+    """
+    router.message.outer_middleware(MetricsMiddleware())
+    router.message.middleware(AccessMiddleware(get_controller, answer))
+    router.message.middleware(SessionMiddleware(get_controller))
+    router.message.middleware(NLUMiddleware(make_analysis, get_notifier))
+    router.message.middleware(SaveMessageMiddleware(get_db))
+    router.message.middleware(HandlerTimingMiddleware())
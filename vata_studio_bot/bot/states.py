@@ -1,7 +1,7 @@
-from aiogram.fsm.state import State, StatesGroup
+﻿from aiogram.fsm.state import State, StatesGroup
 
 class UserStates(StatesGroup):
-    """   FSM"""
+    """Состояния пользователя для FSM"""
     waiting_for_question = State()
     asking_about_tariff = State()
     asking_about_model = State()
\ No newline at end of file
@@ -15,4 +15,55 @@ CACHE_SETTINGS = {
     "tariffs": 300,
     "models": 300,
     "synonyms": 600,
+}
+
+# Кэш последних сообщений пользователей
+HISTORY_SETTINGS = {
+    "cache_users": 10000,
+    "depth": 5,
+}
+
+# Дневные сводки для /globalstats
+ROLLUP_SETTINGS = {
+    "interval_seconds": 300,
+    "batch_size": 10000,
+    "report_days": 7,
+}
+
+# Снимки состояния контроллера (если BotController создан с state_path)
+CONTROLLER_STATE_SETTINGS = {
+    "snapshot_interval_seconds": 300,
+}
+
+# Вызовы менеджеров (в SQLite и после перезапуска - если ManagerNotifier создан с store_path)
+NOTIFICATION_SETTINGS = {
+    "cleanup_hours": 24,
+    "routing": "least_loaded",  # least_loaded / round_robin / sticky
+    "sla_seconds": 300,         # Без ответа - вызов уходит следующему менеджеру
+    "digest_interval_seconds": 600,  # Сводка некритичных событий (0 - сразу)
+}
+
+# Каталог тарифов и моделей (страницы строятся один раз на загрузку таблиц)
+CATALOG_SETTINGS = {
+    "tariffs_per_page": 8,
+    "models_per_page": 8,
+}
+
+# Очередь исходящих сообщений (лимиты Telegram)
+OUTBOUND_SETTINGS = {
+    "global_per_second": 30,
+    "chat_per_second": 1,
+    "chat_burst": 3,
+    "max_in_flight": 30,
+    "max_retries": 5,
+}
+
+# Архивация старых сообщений
+RETENTION_SETTINGS = {
+    "enabled": True,
+    "max_age_days": 90,
+    "archive_dir": "data/archive",
+    "batch_size": 5000,
+    "vacuum_pages": 1000,
+    "interval_seconds": 24 * 3600,
 }
\ No newline at end of file
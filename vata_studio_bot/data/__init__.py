@@ -1,14 +1,25 @@
-"""
-    .
-     Google Sheets,    -.
+﻿"""
+Пакет для работы с данными.
+Содержит модули для работы с Google Sheets, базой данных и ИИ-ассистентом.
 """
 
 from .gsheets import GoogleSheetsClient
 from .database import ConversationDatabase
 from .ai_assistant import AIAssistant
+from .analysis import AnalysisContext
+from .history_cache import RecentHistoryCache
+from .archive import MessageArchiver
+from .sharding import ShardedConversationDatabase, create_database
+from .rollups import AnalyticsRollup
 
 __all__ = [
     'GoogleSheetsClient',
     'ConversationDatabase',
-    'AIAssistant'
+    'AIAssistant',
+    'AnalysisContext',
+    'RecentHistoryCache',
+    'MessageArchiver',
+    'ShardedConversationDatabase',
+    'create_database',
+    'AnalyticsRollup'
 ]
\ No newline at end of file
@@ -5,6 +5,15 @@ import re
 
 logger = logging.getLogger(__name__)
 
+# Шаблоны дат и времени для извлечения сущностей
+DATE_PATTERNS = [re.compile(pattern) for pattern in (
+    r'(\d{1,2}[./]\d{1,2}[./]\d{2,4})',  # DD.MM.YYYY
+    r'(\d{1,2}\s+[а-я]+)',  # "15 декабря"
+    r'(завтра|послезавтра|сегодня)',
+    r'(понедельник|вторник|сред[ау]|четверг|пятниц[ау]|суббот[ау]|воскресень[ея])'
+)]
+TIME_PATTERN = re.compile(r'(\d{1,2}[:.]\d{2})')
+
 class AIAssistant:
     """Простой ИИ-ассистент для обработки естественного языка"""
     
@@ -49,6 +58,11 @@ class AIAssistant:
             ]
         }
         
+        # Шаблоны интента собраны в одно выражение на интент
+        self._intent_regexes = {
+            intent: re.compile('|'.join(patterns)) for intent, patterns in self.intent_patterns.items()
+        }
+        
         # Шаблоны ответов
         self.response_templates = {
             'greeting': [
@@ -101,20 +115,19 @@ class AIAssistant:
         
         logger.info("🤖 ИИ-ассистент инициализирован")
     
-    def detect_intent(self, text: str) -> str:
-        """Определение намерения пользователя"""
-        text_lower = text.lower()
+    def detect_intent(self, text: str, lower: str = None) -> str:
+        """Определение намерения пользователя (lower - уже приведенный к нижнему регистру текст)"""
+        text_lower = lower if lower is not None else text.lower()
         
         # Проверяем команды
         if text_lower.startswith('/'):
             return 'command'
         
         # Проверяем шаблоны
-        for intent, patterns in self.intent_patterns.items():
-            for pattern in patterns:
-                if re.search(pattern, text_lower):
-                    logger.info(f"🎯 Обнаружен интент: {intent}")
-                    return intent
+        for intent, regex in self._intent_regexes.items():
+            if regex.search(text_lower):
+                logger.info(f"🎯 Обнаружен интент: {intent}")
+                return intent
         
         # Если не нашли - проверяем ключевые слова для тарифов/моделей
         tariff_words = ['тариф', 'цена', 'стоит', 'пакет', 'услуг', 'vata', 'prod', 'базов']
@@ -127,7 +140,7 @@ class AIAssistant:
         
         return 'unknown'
     
-    def extract_entities(self, text: str) -> Dict[str, Any]:
+    def extract_entities(self, text: str, lower: str = None) -> Dict[str, Any]:
         """Извлечение сущностей из текста"""
         entities = {
             'tariff_name': None,
@@ -137,7 +150,7 @@ class AIAssistant:
             'time': None
         }
         
-        text_lower = text.lower()
+        text_lower = lower if lower is not None else text.lower()
         
         # Извлекаем названия тарифов
         tariff_names = ['базовый', 'vata prod', 'vata', 'prod', 'премиум', 'стандарт']
@@ -156,45 +169,45 @@ class AIAssistant:
                 break
         
         # Ищем упоминания о дате/времени
-        date_patterns = [
-            r'(\d{1,2}[./]\d{1,2}[./]\d{2,4})',  # DD.MM.YYYY
-            r'(\d{1,2}\s+[а-я]+)',  # "15 декабря"
-            r'(завтра|послезавтра|сегодня)',
-            r'(понедельник|вторник|сред[ау]|четверг|пятниц[ау]|суббот[ау]|воскресень[ея])'
-        ]
-        
-        for pattern in date_patterns:
-            match = re.search(pattern, text_lower)
+        for pattern in DATE_PATTERNS:
+            match = pattern.search(text_lower)
             if match:
                 entities['date'] = match.group(1)
                 break
         
         # Ищем время
-        time_pattern = r'(\d{1,2}[:.]\d{2})'
-        match = re.search(time_pattern, text_lower)
+        match = TIME_PATTERN.search(text_lower)
         if match:
             entities['time'] = match.group(1)
         
         return entities
     
-    async def process_query(self, query: str, user_id: int = None, context: List[Dict] = None) -> str:
-        """Обработка запроса пользователя"""
+    async def process_query(self, query: str, user_id: int = None, context: List[Dict] = None,
+                            analysis=None) -> str:
+        """
+        Обработка запроса пользователя
+        
+        Если передан analysis (AnalysisContext этого сообщения), интент,
+        сущности и история берутся из него, а не вычисляются заново.
+        """
         if not self.enabled:
             return "Извините, ИИ-помощник временно недоступен. Используйте команды из меню."
         
         logger.info(f"🤖 Обработка запроса: {query}")
         
         # Определяем намерение
-        intent = self.detect_intent(query)
+        intent = analysis.intent if analysis is not None else self.detect_intent(query)
         logger.info(f"🎯 Намерение: {intent}")
         
         # Извлекаем сущности
-        entities = self.extract_entities(query)
+        entities = analysis.entities if analysis is not None else self.extract_entities(query)
         logger.info(f"🔍 Сущности: {entities}")
         
-        # Получаем историю диалога
-        history = []
-        if self.db_client and user_id:
+        # Получаем историю диалога (переданную обработчиком, из разбора сообщения или из БД)
+        history = context[-3:] if context else []
+        if not history and analysis is not None:
+            history = analysis.history[-3:]
+        elif not history and self.db_client and user_id:
             history = self.db_client.get_conversation_history(user_id, limit=3)
         
         # Обрабатываем в зависимости от интента
@@ -326,7 +339,7 @@ class AIAssistant:
             # Если не нашли конкретную модель, предлагаем посмотреть все
             return "Конкретная модель не найдена. Используйте команду /models чтобы увидеть всех моделей."
     
-    def should_call_manager(self, query: str, intent: str) -> bool:
+    def should_call_manager(self, query: str, intent: str, lower: str = None) -> bool:
         """Определяет, нужно ли вызывать менеджера"""
         # Фразы, требующие менеджера
         manager_keywords = [
@@ -336,7 +349,7 @@ class AIAssistant:
             'жалоба', 'проблема', 'недоволен', 'претензия'
         ]
         
-        query_lower = query.lower()
+        query_lower = lower if lower is not None else query.lower()
         
         # Проверяем ключевые слова
         if any(keyword in query_lower for keyword in manager_keywords):
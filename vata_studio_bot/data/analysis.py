@@ -0,0 +1,74 @@
+﻿import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_UNSET = object()  # Интент может быть None, поэтому отдельный признак "еще не считали"
+
+class AnalysisContext:
+    """
+    Разбор одного входящего сообщения
+
+    Все производные от текста (нижний регистр, интент, сущности, нужен ли
+    менеджер) и история диалога считаются при первом обращении и дальше
+    переиспользуются всеми этапами обработки: middleware, обработчиком и
+    ИИ-ассистентом. Объект живет одно обновление.
+    """
+
+    __slots__ = ('text', 'user_id', 'assistant', 'db_client', 'history_depth',
+                 '_lower', '_intent', '_entities', '_needs_manager', '_history')
+
+    def __init__(self, text: str, user_id: int, assistant=None, db_client=None,
+                 history_depth: int = 10):
+        self.text = (text or "").strip()
+        self.user_id = user_id
+        self.assistant = assistant
+        self.db_client = db_client
+        self.history_depth = history_depth
+
+        self._lower = None
+        self._intent = _UNSET
+        self._entities = None
+        self._needs_manager = None
+        self._history = None
+
+    @property
+    def lower(self) -> str:
+        """Текст в нижнем регистре"""
+        if self._lower is None:
+            self._lower = self.text.lower()
+        return self._lower
+
+    @property
+    def intent(self) -> Optional[str]:
+        if self._intent is _UNSET:
+            self._intent = self.assistant.detect_intent(self.text, lower=self.lower) if self.assistant else None
+        return self._intent
+
+    @property
+    def entities(self) -> Dict[str, Any]:
+        if self._entities is None:
+            self._entities = self.assistant.extract_entities(self.text, lower=self.lower) if self.assistant else {}
+        return self._entities
+
+    @property
+    def needs_manager(self) -> bool:
+        if self._needs_manager is None:
+            self._needs_manager = bool(self.assistant) and \
+                self.assistant.should_call_manager(self.text, self.intent, lower=self.lower)
+        return self._needs_manager
+
+    @property
+    def history(self) -> List[Dict[str, Any]]:
+        """Последние history_depth сообщений диалога (включая текущее, если оно уже сохранено)"""
+        if self._history is None:
+            if not self.db_client or self.user_id is None:
+                self._history = []
+            else:
+                self._history = self.db_client.get_conversation_history(self.user_id, limit=self.history_depth)
+        return self._history
+
+    def mentions(self, keywords: Iterable[str]) -> bool:
+        """Есть ли в тексте хотя бы одно из ключевых слов"""
+        lower = self.lower
+        return any(keyword in lower for keyword in keywords)
@@ -0,0 +1,276 @@
+﻿import asyncio
+import json
+import logging
+import os
+import sqlite3
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Any, Iterator
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, по умолчанию используется zlib
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CODEC_EXTENSIONS = {
+    'zstd': '.jsonl.zst',
+    'zlib': '.jsonl.zz',
+}
+
+class MessageArchiver:
+    """
+    Архивация старых сообщений в сжатые помесячные сегменты
+
+    Сообщения старше max_age_days выгружаются в файлы JSONL, сжатые zstd
+    (если установлен пакет zstandard) или zlib. В горячей базе остается
+    только индекс: archive_segments (файлы) и archive_index
+    (пользователь -> сегмент), после чего выполняется incremental vacuum.
+
+    archive_limit - функция, возвращающая наибольший message_id, который
+    можно архивировать (водяной знак AnalyticsRollup): сообщение уходит в
+    архив только после того, как попало в дневные сводки.
+    """
+
+    def __init__(self, db, archive_dir: str, max_age_days: int = 90,
+                 batch_size: int = 5000, vacuum_pages: int = 1000, history_cache=None,
+                 archive_limit: Optional[Callable[[], int]] = None):
+        self.db = db
+        self.archive_limit = archive_limit
+        # Кэш истории, который нужно сбрасывать (у шардов он общий, у роутера)
+        self.history_cache = history_cache if history_cache is not None else db.history_cache
+        self.archive_dir = archive_dir
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.codec = 'zstd' if zstandard else 'zlib'
+
+        # Статистика
+        self.stats = {
+            'archived_messages': 0,
+            'segments_written': 0,
+            'last_run': None
+        }
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        logger.info(f"🗄️ Архиватор сообщений инициализирован: {self.archive_dir} ({self.codec})")
+
+    # ================== СЖАТИЕ ==================
+
+    def _compress(self, payload: bytes) -> bytes:
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=10).compress(payload)
+        return zlib.compress(payload, 9)
+
+    @staticmethod
+    def _decompress(data: bytes, codec: str) -> bytes:
+        if codec == 'zstd':
+            if not zstandard:
+                raise RuntimeError("Для чтения сегмента нужен пакет zstandard")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    # ================== АРХИВАЦИЯ ==================
+
+    def archive_old_messages(self) -> int:
+        """
+        Перенос сообщений старше max_age_days в архив
+
+        Returns:
+            Количество заархивированных сообщений
+        """
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        archived = 0
+
+        try:
+            max_message_id = self.archive_limit() if self.archive_limit is not None else None
+            while True:
+                moved = self._archive_batch(cutoff, max_message_id)
+                archived += moved
+                if moved < self.batch_size:
+                    break
+
+            if archived:
+                self.db.purge_unused_replies()
+                self._incremental_vacuum()
+                logger.info(f"🗄️ Заархивировано сообщений: {archived}")
+
+            self.stats['archived_messages'] += archived
+            self.stats['last_run'] = datetime.now()
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка архивации сообщений: {e}")
+
+        return archived
+
+    def _archive_batch(self, cutoff: str, max_message_id: Optional[int] = None) -> int:
+        """Архивация одной пачки сообщений (не больше batch_size, message_id не больше max_message_id)"""
+        with sqlite3.connect(self.db.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT m.message_id, m.user_id, m.message_text, m.is_bot, m.intent, m.timestamp,
+                       m.reply_hash, b.body
+                FROM messages m
+                LEFT JOIN reply_blobs b ON b.hash = m.reply_hash
+                WHERE m.timestamp < ? AND (? IS NULL OR m.message_id <= ?)
+                ORDER BY m.message_id
+                LIMIT ?
+            ''', (cutoff, max_message_id, max_message_id, self.batch_size))
+            rows = cursor.fetchall()
+
+            if not rows:
+                return 0
+
+            by_month = defaultdict(list)
+            for row in rows:
+                by_month[row['timestamp'][:7]].append(row)
+
+            for month, month_rows in by_month.items():
+                # Файл пишется до транзакции: при сбое останется лишь
+                # неиндексированный сегмент, а сообщения - в горячей базе
+                path = self._write_segment(month, month_rows)
+
+                cursor.execute('''
+                    INSERT INTO archive_segments
+                    (month, path, codec, message_count, min_message_id, max_message_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (month, os.path.basename(path), self.codec, len(month_rows),
+                      month_rows[0]['message_id'], month_rows[-1]['message_id']))
+                segment_id = cursor.lastrowid
+
+                per_user = {}
+                for row in month_rows:
+                    entry = per_user.setdefault(row['user_id'], [0, 0, row['timestamp'], row['timestamp']])
+                    entry[0] += 1
+                    entry[1] += 1 if row['is_bot'] else 0
+                    entry[2] = min(entry[2], row['timestamp'])
+                    entry[3] = max(entry[3], row['timestamp'])
+
+                cursor.executemany('''
+                    INSERT INTO archive_index
+                    (user_id, segment_id, message_count, bot_messages, first_timestamp, last_timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(user_id, segment_id, *entry) for user_id, entry in per_user.items()])
+
+                self.stats['segments_written'] += 1
+
+            cursor.executemany('DELETE FROM messages WHERE message_id = ?',
+                               [(row['message_id'],) for row in rows])
+            conn.commit()
+
+        # Архивированные пользователи должны перечитать хвост истории из БД
+        if self.history_cache is not None:
+            for user_id in {row['user_id'] for row in rows}:
+                self.history_cache.invalidate(user_id)
+
+        return len(rows)
+
+    def _write_segment(self, month: str, rows: List[sqlite3.Row]) -> str:
+        """Запись сжатого сегмента JSONL"""
+        existing = [name for name in os.listdir(self.archive_dir) if name.startswith(f"messages-{month}.")]
+        name = f"messages-{month}.{len(existing) + 1:04d}{CODEC_EXTENSIONS[self.codec]}"
+        path = os.path.join(self.archive_dir, name)
+
+        payload = "".join(
+            json.dumps({
+                'message_id': row['message_id'],
+                'user_id': row['user_id'],
+                'text': self.db.resolve_message_text(row['message_text'], row['reply_hash'], row['body']),
+                'is_bot': bool(row['is_bot']),
+                'intent': row['intent'],
+                'timestamp': row['timestamp']
+            }, ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode('utf-8')
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self._compress(payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        return path
+
+    def _incremental_vacuum(self):
+        """Возврат освободившихся страниц файлу базы"""
+        with sqlite3.connect(self.db.db_path) as conn:
+            mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if mode != 2:
+                # База создана до включения auto_vacuum - переводим один раз
+                logger.info("🧹 Включаю incremental auto_vacuum (однократный VACUUM)")
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.commit()
+                conn.execute('VACUUM')
+                return
+
+            conn.execute(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})')
+
+    # ================== ЧТЕНИЕ АРХИВА ==================
+
+    def iter_segment(self, segment_id: int) -> Iterator[Dict[str, Any]]:
+        """Чтение всех сообщений сегмента"""
+        with sqlite3.connect(self.db.db_path) as conn:
+            row = conn.execute('SELECT path, codec FROM archive_segments WHERE segment_id = ?',
+                               (segment_id,)).fetchone()
+
+        if not row:
+            return
+
+        with open(os.path.join(self.archive_dir, row[0]), 'rb') as f:
+            payload = self._decompress(f.read(), row[1])
+
+        for line in payload.decode('utf-8').splitlines():
+            if line:
+                yield json.loads(line)
+
+    def get_archived_history(self, user_id: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Архивная история пользователя (от старых к новым)
+
+        Args:
+            user_id: ID пользователя
+            limit: Сколько последних архивных сообщений вернуть (None - все)
+        """
+        try:
+            with sqlite3.connect(self.db.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT segment_id, message_count
+                    FROM archive_index
+                    WHERE user_id = ?
+                    ORDER BY segment_id DESC
+                ''', (user_id,))
+                segments = cursor.fetchall()
+
+            # Читаем сегменты с конца, пока не наберем limit сообщений
+            chunks = []
+            collected = 0
+            for segment_id, count in segments:
+                chunks.append([
+                    {'text': msg['text'], 'is_bot': msg['is_bot'], 'timestamp': msg['timestamp']}
+                    for msg in self.iter_segment(segment_id)
+                    if msg['user_id'] == user_id
+                ])
+                collected += count
+                if limit is not None and collected >= limit:
+                    break
+
+            history = [msg for chunk in reversed(chunks) for msg in chunk]
+            return history[-limit:] if limit is not None else history
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка чтения архива: {e}")
+            return []
+
+    # ================== ФОНОВЫЙ ЗАПУСК ==================
+
+    async def run_periodic(self, interval_seconds: int):
+        """Периодическая архивация в фоне"""
+        while True:
+            await asyncio.to_thread(self.archive_old_messages)
+            await asyncio.sleep(interval_seconds)
@@ -1,24 +1,53 @@
 ﻿import sqlite3
 import os
 import logging
-from typing import Dict, List, Optional, Any
+import hashlib
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Any, Iterator
+
+from .history_cache import RecentHistoryCache
 
 logger = logging.getLogger(__name__)
 
 class ConversationDatabase:
     """База данных для хранения истории диалогов"""
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, history_cache_users: int = 10000, history_depth: int = 5):
         self.db_path = db_path
+        
+        # Последние сообщения активных пользователей (0 - кэш отключен)
+        self.history_cache = None
+        if history_cache_users > 0:
+            self.history_cache = RecentHistoryCache(max_users=history_cache_users, depth=history_depth)
+        
+        # Сжатые и распакованные тексты частых ответов бота. Кэши общие для цикла
+        # событий и потоков архивации (asyncio.to_thread), поэтому под одной блокировкой
+        self._compressed_replies: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._reply_text_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._reply_cache_lock = threading.Lock()
+        self.reply_cache_size = 2048
+        
+        # Полнотекстовый поиск (FTS5 может отсутствовать в сборке SQLite)
+        self.fts_enabled = False
+        
         self._init_database()
     
     def _init_database(self):
         """Инициализация базы данных"""
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
         
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             
+            # Для новой базы - освобождение страниц после архивации без полного VACUUM
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            
             # Таблица пользователей
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -45,12 +74,103 @@ class ConversationDatabase:
             
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
             
+            # Ответы бота хранятся один раз, сжатыми, и адресуются хэшем содержимого
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS reply_blobs (
+                    hash BLOB PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            
+            cursor.execute('PRAGMA table_info(messages)')
+            columns = {row[1] for row in cursor.fetchall()}
+            if 'reply_hash' not in columns:
+                cursor.execute('ALTER TABLE messages ADD COLUMN reply_hash BLOB')
+            
+            # Интент сообщения пользователя (для аналитики, см. data/rollups.py)
+            if 'intent' not in columns:
+                cursor.execute('ALTER TABLE messages ADD COLUMN intent TEXT')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_reply_hash
+                ON messages(reply_hash) WHERE reply_hash IS NOT NULL
+            ''')
+            
+            # Агрегаты по пользователям (поддерживаются триггером)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'")
+            stats_exists = cursor.fetchone() is not None
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    total_messages INTEGER NOT NULL DEFAULT 0,
+                    bot_messages INTEGER NOT NULL DEFAULT 0,
+                    user_messages INTEGER NOT NULL DEFAULT 0,
+                    first_message TIMESTAMP,
+                    last_message TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_messages_user_stats
+                AFTER INSERT ON messages
+                BEGIN
+                    INSERT INTO user_stats
+                    (user_id, total_messages, bot_messages, user_messages, first_message, last_message)
+                    VALUES (
+                        NEW.user_id, 1,
+                        CASE WHEN NEW.is_bot THEN 1 ELSE 0 END,
+                        CASE WHEN NEW.is_bot THEN 0 ELSE 1 END,
+                        NEW.timestamp, NEW.timestamp
+                    )
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        total_messages = total_messages + 1,
+                        bot_messages = bot_messages + excluded.bot_messages,
+                        user_messages = user_messages + excluded.user_messages,
+                        last_message = excluded.last_message;
+                END
+            ''')
+            
+            # Индекс архивных сегментов (см. data/archive.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS archive_segments (
+                    segment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    month TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    codec TEXT NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    min_message_id INTEGER NOT NULL,
+                    max_message_id INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS archive_index (
+                    user_id INTEGER NOT NULL,
+                    segment_id INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    bot_messages INTEGER NOT NULL,
+                    first_timestamp TIMESTAMP,
+                    last_timestamp TIMESTAMP,
+                    PRIMARY KEY (user_id, segment_id),
+                    FOREIGN KEY (segment_id) REFERENCES archive_segments (segment_id)
+                )
+            ''')
+            
+            # Одноразовое заполнение агрегатов по уже накопленной истории
+            if not stats_exists:
+                self._rebuild_user_stats(cursor)
+            
+            self._init_fts(cursor)
+            
             conn.commit()
             logger.info(f"✅ База данных инициализирована: {self.db_path}")
     
     def save_message(self, user_id: int, username: str, 
                     first_name: str, last_name: str, 
-                    message: str, is_bot: bool = False):
+                    message: str, is_bot: bool = False, intent: Optional[str] = None):
         """Сохранение сообщения"""
         try:
             with sqlite3.connect(self.db_path) as conn:
@@ -62,73 +182,534 @@ class ConversationDatabase:
                     VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
                 ''', (user_id, username, first_name, last_name))
                 
-                cursor.execute('''
-                    INSERT INTO messages (user_id, message_text, is_bot)
-                    VALUES (?, ?, ?)
-                ''', (user_id, message, is_bot))
+                if is_bot and message:
+                    reply_hash = self._store_reply(cursor, message)
+                    cursor.execute('''
+                        INSERT INTO messages (user_id, message_text, is_bot, reply_hash)
+                        VALUES (?, NULL, ?, ?)
+                    ''', (user_id, is_bot, reply_hash))
+                else:
+                    cursor.execute('''
+                        INSERT INTO messages (user_id, message_text, is_bot, intent)
+                        VALUES (?, ?, ?, ?)
+                    ''', (user_id, message, is_bot, intent))
                 
                 conn.commit()
+            
+            if self.history_cache is not None:
+                self.history_cache.append(user_id, {
+                    'text': message,
+                    'is_bot': bool(is_bot),
+                    # Тот же формат, что у CURRENT_TIMESTAMP в SQLite (UTC)
+                    'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+                })
                 
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения сообщения: {e}")
     
     def get_conversation_history(self, user_id: int, limit: int = 5) -> List[Dict[str, Any]]:
         """Получение истории диалога"""
+        if self.history_cache is not None:
+            cached = self.history_cache.get(user_id, limit)
+            if cached is not None:
+                return cached
+        
         try:
             with sqlite3.connect(self.db_path) as conn:
                 conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
                 
                 cursor.execute('''
-                    SELECT message_text, is_bot, timestamp
-                    FROM messages 
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
+                    SELECT m.message_text, m.is_bot, m.timestamp, m.reply_hash, b.body
+                    FROM messages m
+                    LEFT JOIN reply_blobs b ON b.hash = m.reply_hash
+                    WHERE m.user_id = ?
+                    ORDER BY m.message_id DESC
                     LIMIT ?
-                ''', (user_id, limit))
+                ''', (user_id, max(limit, self.history_cache.depth) if self.history_cache is not None else limit))
                 
                 rows = cursor.fetchall()
                 history = []
                 
                 for row in reversed(rows):
                     history.append({
-                        'text': row['message_text'],
+                        'text': self.resolve_message_text(row['message_text'], row['reply_hash'], row['body']),
                         'is_bot': bool(row['is_bot']),
                         'timestamp': row['timestamp']
                     })
                 
-                return history
+                if self.history_cache is not None:
+                    self.history_cache.load(user_id, history)
+                
+                return history[-limit:] if limit > 0 else []
                 
         except Exception as e:
             logger.error(f"❌ Ошибка получения истории: {e}")
             return []
     
-    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получение статистики пользователя"""
+    def _init_fts(self, cursor: sqlite3.Cursor):
+        """Индекс FTS5 по сообщениям пользователей (ответы бота не индексируются)"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+        fts_exists = cursor.fetchone() is not None
+        
+        try:
+            # unicode61 корректно разбивает и приводит к нижнему регистру кириллицу;
+            # prefix - индексы для быстрого поиска по началу слова
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    message_text,
+                    content='messages',
+                    content_rowid='message_id',
+                    tokenize='unicode61',
+                    prefix='2 3 4'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            logger.warning(f"⚠️ FTS5 недоступен, поиск по истории отключен: {e}")
+            return
+        
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert
+            AFTER INSERT ON messages
+            WHEN NOT NEW.is_bot AND NEW.message_text IS NOT NULL
+            BEGIN
+                INSERT INTO messages_fts (rowid, message_text)
+                VALUES (NEW.message_id, NEW.message_text);
+            END
+        ''')
+        
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+            AFTER DELETE ON messages
+            WHEN NOT OLD.is_bot AND OLD.message_text IS NOT NULL
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message_text)
+                VALUES ('delete', OLD.message_id, OLD.message_text);
+            END
+        ''')
+        
+        if not fts_exists:
+            cursor.execute('''
+                INSERT INTO messages_fts (rowid, message_text)
+                SELECT message_id, message_text
+                FROM messages
+                WHERE NOT is_bot AND message_text IS NOT NULL
+            ''')
+            logger.info(f"🔎 Индекс поиска построен: {cursor.rowcount} сообщений")
+        
+        self.fts_enabled = True
+    
+    # ================== ПОИСК ПО ИСТОРИИ ==================
+    
+    @staticmethod
+    def build_fts_query(text: str) -> str:
+        """
+        Преобразование пользовательского запроса в запрос FTS5
+        
+        Каждое слово ищется по префиксу; у длинных русских слов отбрасывается
+        окончание, чтобы "тарифы" находило "тариф", "тарифом" и т.д.
+        """
+        terms = []
+        for word in re.findall(r'\w+', text.lower()):
+            if len(word) >= 6 and re.fullmatch(r'[а-яё]+', word):
+                word = word[:-2]
+            terms.append(f'"{word}"*')
+        return " ".join(terms)
+    
+    def search_messages(self, query: str, limit: int = 10, offset: int = 0,
+                        since: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Полнотекстовый поиск по сообщениям пользователей (горячая база)
+        
+        Args:
+            query: Поисковый запрос
+            limit: Размер страницы
+            offset: Смещение
+            since: Нижняя граница timestamp ('YYYY-MM-DD HH:MM:SS', UTC)
+        
+        Returns:
+            Найденные сообщения по убыванию релевантности; в snippet
+            совпадения обрамлены символами \x02 и \x03
+        """
+        fts_query = self.build_fts_query(query)
+        if not self.fts_enabled or not fts_query:
+            return []
+        
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
                 
-                cursor.execute('SELECT COUNT(*) FROM messages WHERE user_id = ?', (user_id,))
-                total = cursor.fetchone()[0] or 0
+                cursor.execute('''
+                    SELECT m.message_id, m.user_id, m.timestamp, messages_fts.rank AS rank,
+                           u.username, u.first_name, u.last_name,
+                           snippet(messages_fts, 0, char(2), char(3), '…', 12) AS snippet
+                    FROM messages_fts
+                    JOIN messages m ON m.message_id = messages_fts.rowid
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    WHERE messages_fts MATCH ?
+                      AND (? IS NULL OR m.timestamp >= ?)
+                    ORDER BY rank
+                    LIMIT ? OFFSET ?
+                ''', (fts_query, since, since, limit, offset))
                 
-                cursor.execute('SELECT COUNT(*) FROM messages WHERE user_id = ? AND is_bot = 1', (user_id,))
-                bot = cursor.fetchone()[0] or 0
+                return [dict(row) for row in cursor.fetchall()]
                 
-                cursor.execute('SELECT MIN(timestamp) FROM messages WHERE user_id = ?', (user_id,))
-                first = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"❌ Ошибка поиска по истории: {e}")
+            return []
+    
+    # ================== ВЫГРУЗКА ==================
+    
+    def iter_messages(self, since: Optional[str] = None, until: Optional[str] = None,
+                      user_id: Optional[int] = None, chunk_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """
+        Потоковое чтение сообщений в порядке message_id
+        
+        Строки читаются с курсора порциями по chunk_size, поэтому расход
+        памяти не зависит от размера истории.
+        
+        Args:
+            since: Нижняя граница timestamp включительно ('YYYY-MM-DD HH:MM:SS', UTC)
+            until: Верхняя граница timestamp не включительно
+            user_id: Только сообщения этого пользователя
+            chunk_size: Размер порции чтения
+        """
+        conditions = []
+        params = []
+        if since:
+            conditions.append('m.timestamp >= ?')
+            params.append(since)
+        if until:
+            conditions.append('m.timestamp < ?')
+            params.append(until)
+        if user_id is not None:
+            conditions.append('m.user_id = ?')
+            params.append(user_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.arraysize = chunk_size
+            
+            cursor.execute(f'''
+                SELECT m.message_id, m.user_id, u.username, m.message_text, m.is_bot,
+                       m.intent, m.timestamp, m.reply_hash, b.body
+                FROM messages m
+                LEFT JOIN users u ON u.user_id = m.user_id
+                LEFT JOIN reply_blobs b ON b.hash = m.reply_hash
+                {where}
+                ORDER BY m.message_id
+            ''', params)
+            
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
                 
-                cursor.execute('SELECT last_activity FROM users WHERE user_id = ?', (user_id,))
-                last = cursor.fetchone()
+                for row in rows:
+                    yield {
+                        'message_id': row['message_id'],
+                        'user_id': row['user_id'],
+                        'username': row['username'],
+                        'text': self.resolve_message_text(row['message_text'], row['reply_hash'], row['body']),
+                        'is_bot': bool(row['is_bot']),
+                        'intent': row['intent'],
+                        'timestamp': row['timestamp']
+                    }
+    
+    def bulk_insert_messages(self, rows: List[Dict[str, Any]]):
+        """
+        Пакетная вставка сообщений с сохранением исходных timestamp (перенос данных)
+        
+        Args:
+            rows: Словари с ключами user_id, username, first_name, last_name,
+                  text, is_bot, timestamp (и необязательным intent)
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            
+            users = {row['user_id']: row for row in rows}
+            cursor.executemany('''
+                INSERT OR REPLACE INTO users
+                (user_id, username, first_name, last_name, last_activity)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(user_id, row.get('username'), row.get('first_name'), row.get('last_name'), row['timestamp'])
+                  for user_id, row in users.items()])
+            
+            for row in rows:
+                if row['is_bot'] and row['text']:
+                    cursor.execute('''
+                        INSERT INTO messages (user_id, message_text, is_bot, timestamp, reply_hash)
+                        VALUES (?, NULL, ?, ?, ?)
+                    ''', (row['user_id'], True, row['timestamp'], self._store_reply(cursor, row['text'])))
+                else:
+                    cursor.execute('''
+                        INSERT INTO messages (user_id, message_text, is_bot, intent, timestamp)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (row['user_id'], row['text'], bool(row['is_bot']), row.get('intent'), row['timestamp']))
+            
+            conn.commit()
+        
+        if self.history_cache is not None:
+            for user_id in users:
+                self.history_cache.invalidate(user_id)
+    
+    def get_global_stats(self) -> Dict[str, Any]:
+        """Общая статистика базы (по агрегатам user_stats)"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT COUNT(*), COALESCE(SUM(total_messages), 0), COALESCE(SUM(bot_messages), 0)
+                    FROM user_stats
+                ''')
+                users, total, bot = cursor.fetchone()
                 
                 return {
+                    'users': users,
                     'total_messages': total,
                     'bot_messages': bot,
-                    'user_messages': total - bot,
-                    'first_message': first,
-                    'last_activity': last[0] if last else None
+                    'user_messages': total - bot
+                }
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения общей статистики: {e}")
+            return {}
+    
+    # ================== ХРАНЕНИЕ ОТВЕТОВ БОТА ==================
+    
+    @staticmethod
+    def _reply_hash(text: str) -> bytes:
+        """Хэш содержимого ответа (16 байт)"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    
+    def _store_reply(self, cursor: sqlite3.Cursor, text: str) -> bytes:
+        """
+        Сохранение текста ответа в reply_blobs (однократно на каждое содержимое)
+        
+        INSERT OR IGNORE выполняется всегда, даже для знакомого ответа: тело могла
+        удалить purge_unused_replies, а в одной транзакции с записью сообщения
+        вставка гарантирует, что сообщение не сошлется на удаленное тело.
+        Кэш только избавляет от повторного сжатия.
+        """
+        reply_hash = self._reply_hash(text)
+        raw = text.encode('utf-8')
+        
+        with self._reply_cache_lock:
+            body = self._compressed_replies.get(reply_hash)
+            if body is not None:
+                self._compressed_replies.move_to_end(reply_hash)
+        
+        if body is None:
+            body = zlib.compress(raw, 6)
+            with self._reply_cache_lock:
+                self._compressed_replies[reply_hash] = body
+                if len(self._compressed_replies) > self.reply_cache_size:
+                    self._compressed_replies.popitem(last=False)
+        
+        cursor.execute('''
+            INSERT OR IGNORE INTO reply_blobs (hash, body, size)
+            VALUES (?, ?, ?)
+        ''', (reply_hash, body, len(raw)))
+        
+        return reply_hash
+    
+    def resolve_message_text(self, message_text: Optional[str], reply_hash: Optional[bytes],
+                             body: Optional[bytes]) -> Optional[str]:
+        """
+        Текст сообщения: либо хранится в строке, либо восстанавливается из reply_blobs
+        
+        Args:
+            message_text: Значение messages.message_text
+            reply_hash: Значение messages.reply_hash
+            body: Сжатое тело из reply_blobs (LEFT JOIN по reply_hash)
+        """
+        if reply_hash is None or body is None:
+            return message_text
+        
+        reply_hash = bytes(reply_hash)
+        with self._reply_cache_lock:
+            text = self._reply_text_cache.get(reply_hash)
+            if text is not None:
+                self._reply_text_cache.move_to_end(reply_hash)
+                return text
+        
+        text = zlib.decompress(body).decode('utf-8')
+        with self._reply_cache_lock:
+            self._reply_text_cache[reply_hash] = text
+            if len(self._reply_text_cache) > self.reply_cache_size:
+                self._reply_text_cache.popitem(last=False)
+        
+        return text
+    
+    def compact_bot_replies(self, batch_size: int = 5000) -> int:
+        """
+        Перенос ответов бота, сохраненных текстом, в reply_blobs (миграция старых данных)
+        
+        Returns:
+            Количество перенесенных сообщений
+        """
+        moved = 0
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                
+                while True:
+                    cursor.execute('''
+                        SELECT message_id, message_text
+                        FROM messages
+                        WHERE is_bot = 1 AND reply_hash IS NULL AND message_text IS NOT NULL
+                        LIMIT ?
+                    ''', (batch_size,))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    
+                    cursor.executemany('''
+                        UPDATE messages SET reply_hash = ?, message_text = NULL
+                        WHERE message_id = ?
+                    ''', [(self._store_reply(cursor, text), message_id) for message_id, text in rows])
+                    conn.commit()
+                    moved += len(rows)
+            
+            if moved:
+                logger.info(f"🗜️ Ответов бота перенесено в reply_blobs: {moved}")
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка сжатия ответов бота: {e}")
+        
+        return moved
+    
+    def purge_unused_replies(self) -> int:
+        """Удаление тел ответов, на которые больше не ссылаются сообщения"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM reply_blobs
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM messages WHERE messages.reply_hash = reply_blobs.hash
+                    )
+                ''')
+                removed = cursor.rowcount
+                conn.commit()
+            
+            return removed
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка очистки reply_blobs: {e}")
+            return 0
+    
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение статистики пользователя"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT total_messages, bot_messages, user_messages, first_message, last_message
+                    FROM user_stats
+                    WHERE user_id = ?
+                ''', (user_id,))
+                row = cursor.fetchone()
+                
+                if not row:
+                    return {
+                        'total_messages': 0,
+                        'bot_messages': 0,
+                        'user_messages': 0,
+                        'first_message': None,
+                        'last_activity': None
+                    }
+                
+                return {
+                    'total_messages': row[0],
+                    'bot_messages': row[1],
+                    'user_messages': row[2],
+                    'first_message': row[3],
+                    'last_activity': row[4]
                 }
                 
         except Exception as e:
             logger.error(f"❌ Ошибка получения статистики: {e}")
-            return {}
\ No newline at end of file
+            return {}
+    
+    # Фактические агрегаты: горячая таблица messages плюс индекс архива
+    _ACTUAL_STATS_SQL = '''
+        SELECT user_id,
+               SUM(total_messages) AS total_messages,
+               SUM(bot_messages) AS bot_messages,
+               MIN(first_message) AS first_message,
+               MAX(last_message) AS last_message
+        FROM (
+            SELECT user_id,
+                   COUNT(*) AS total_messages,
+                   SUM(CASE WHEN is_bot THEN 1 ELSE 0 END) AS bot_messages,
+                   MIN(timestamp) AS first_message,
+                   MAX(timestamp) AS last_message
+            FROM messages
+            GROUP BY user_id
+            UNION ALL
+            SELECT user_id, message_count, bot_messages, first_timestamp, last_timestamp
+            FROM archive_index
+        )
+        GROUP BY user_id
+    '''
+    
+    def _rebuild_user_stats(self, cursor: sqlite3.Cursor):
+        """Полный пересчет агрегатов user_stats по messages и архиву"""
+        cursor.execute('DELETE FROM user_stats')
+        cursor.execute(f'''
+            INSERT INTO user_stats
+            (user_id, total_messages, bot_messages, user_messages, first_message, last_message)
+            SELECT user_id, total_messages, bot_messages, total_messages - bot_messages,
+                   first_message, last_message
+            FROM ({self._ACTUAL_STATS_SQL})
+        ''')
+        logger.info(f"📊 Агрегаты пользователей пересчитаны: {cursor.rowcount} записей")
+    
+    def check_user_stats_consistency(self, fix: bool = False) -> List[int]:
+        """
+        Сверка user_stats с messages и индексом архива (полный проход, для обслуживания)
+        
+        Args:
+            fix: Пересчитать агрегаты, если найдены расхождения
+        
+        Returns:
+            Список user_id с расхождениями
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute(f'''
+                    WITH actual AS ({self._ACTUAL_STATS_SQL})
+                    SELECT a.user_id
+                    FROM actual a
+                    LEFT JOIN user_stats s ON s.user_id = a.user_id
+                    WHERE s.user_id IS NULL
+                       OR s.total_messages != a.total_messages
+                       OR s.bot_messages != a.bot_messages
+                       OR s.user_messages != a.total_messages - a.bot_messages
+                       OR s.first_message IS NOT a.first_message
+                       OR s.last_message IS NOT a.last_message
+                    UNION
+                    SELECT s.user_id
+                    FROM user_stats s
+                    WHERE s.user_id NOT IN (SELECT user_id FROM actual)
+                ''')
+                mismatched = [row[0] for row in cursor.fetchall()]
+                
+                if mismatched:
+                    logger.warning(f"⚠️ Расхождения в user_stats: {len(mismatched)} пользователей")
+                    if fix:
+                        self._rebuild_user_stats(cursor)
+                        conn.commit()
+                
+                return mismatched
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки user_stats: {e}")
+            return []
\ No newline at end of file
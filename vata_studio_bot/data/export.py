@@ -0,0 +1,122 @@
+﻿# data/export.py - потоковая выгрузка истории диалогов
+import argparse
+import csv
+import json
+import logging
+import os
+from typing import Dict, Iterable, Iterator, List, Any
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet необязателен, иначе пишем CSV по колонкам
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ['message_id', 'user_id', 'username', 'text', 'is_bot', 'intent', 'timestamp']
+
+def _chunked(rows: Iterable[Dict[str, Any]], chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Разбиение потока строк на порции фиксированного размера"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def export_jsonl(rows: Iterable[Dict[str, Any]], path: str) -> int:
+    """
+    Выгрузка сообщений в JSONL (одна строка - одно сообщение)
+
+    Returns:
+        Количество выгруженных сообщений
+    """
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+
+    logger.info(f"📤 JSONL: {count} сообщений -> {path}")
+    return count
+
+def export_columnar(rows: Iterable[Dict[str, Any]], out_dir: str, chunk_size: int = 1000) -> int:
+    """
+    Колоночная выгрузка: Parquet (если установлен pyarrow) или CSV на каждую колонку
+
+    Parquet пишется группами строк по chunk_size, CSV - построчно,
+    так что в памяти держится не больше одной порции.
+
+    Returns:
+        Количество выгруженных сообщений
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0
+
+    if pyarrow:
+        path = os.path.join(out_dir, "messages.parquet")
+        schema = pyarrow.schema([
+            ('message_id', pyarrow.int64()),
+            ('user_id', pyarrow.int64()),
+            ('username', pyarrow.string()),
+            ('text', pyarrow.string()),
+            ('is_bot', pyarrow.bool_()),
+            ('intent', pyarrow.string()),
+            ('timestamp', pyarrow.string()),
+        ])
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for chunk in _chunked(rows, chunk_size):
+                writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema))
+                count += len(chunk)
+
+        logger.info(f"📤 Parquet: {count} сообщений -> {path}")
+        return count
+
+    files = {column: open(os.path.join(out_dir, f"{column}.csv"), 'w', encoding='utf-8', newline='')
+             for column in EXPORT_COLUMNS}
+    try:
+        writers = {column: csv.writer(f) for column, f in files.items()}
+        for column, writer in writers.items():
+            writer.writerow([column])
+
+        for row in rows:
+            for column, writer in writers.items():
+                writer.writerow([row[column]])
+            count += 1
+    finally:
+        for f in files.values():
+            f.close()
+
+    logger.info(f"📤 CSV по колонкам: {count} сообщений -> {out_dir}")
+    return count
+
+def main():
+    """CLI: python -m data.export --db conversations.db --format jsonl --out messages.jsonl"""
+    from .database import ConversationDatabase
+
+    parser = argparse.ArgumentParser(description="Выгрузка истории диалогов Vata Studio")
+    parser.add_argument('--db', required=True, help="Путь к базе SQLite")
+    parser.add_argument('--out', required=True, help="Файл (jsonl) или каталог (columnar)")
+    parser.add_argument('--format', choices=['jsonl', 'columnar'], default='jsonl')
+    parser.add_argument('--since', help="Начало периода, 'YYYY-MM-DD[ HH:MM:SS]' (UTC)")
+    parser.add_argument('--until', help="Конец периода (не включительно)")
+    parser.add_argument('--user', type=int, help="Только этот user_id")
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    db = ConversationDatabase(args.db, history_cache_users=0)
+    rows = db.iter_messages(since=args.since, until=args.until,
+                            user_id=args.user, chunk_size=args.chunk_size)
+
+    if args.format == 'jsonl':
+        export_jsonl(rows, args.out)
+    else:
+        export_columnar(rows, args.out, chunk_size=args.chunk_size)
+
+if __name__ == "__main__":
+    main()
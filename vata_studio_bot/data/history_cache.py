@@ -0,0 +1,86 @@
+﻿import logging
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+class RecentHistoryCache:
+    """
+    Кольцевой буфер последних сообщений пользователя в памяти
+
+    Для каждого пользователя хранится deque(maxlen=depth) с последними
+    сообщениями. Пользователи вытесняются по LRU, поэтому объем памяти
+    ограничен max_users * depth записями.
+    """
+
+    def __init__(self, max_users: int = 10000, depth: int = 5):
+        self.max_users = max_users
+        self.depth = depth
+        self._buffers: "OrderedDict[int, deque]" = OrderedDict()
+
+        # Статистика
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+
+    def get(self, user_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Последние limit сообщений пользователя или None при промахе
+
+        Буфер заполняется только из БД или поверх загруженного из БД,
+        поэтому его содержимое всегда совпадает с хвостом истории.
+        """
+        buffer = self._buffers.get(user_id)
+        if buffer is None or limit > self.depth:
+            self.stats['misses'] += 1
+            return None
+
+        self._buffers.move_to_end(user_id)
+        self.stats['hits'] += 1
+
+        if limit >= len(buffer):
+            return list(buffer)
+        return list(buffer)[-limit:] if limit > 0 else []
+
+    def load(self, user_id: int, history: List[Dict[str, Any]]):
+        """Заполнение буфера историей, прочитанной из БД"""
+        self._buffers[user_id] = deque(history[-self.depth:], maxlen=self.depth)
+        self._buffers.move_to_end(user_id)
+        self._evict()
+
+    def append(self, user_id: int, entry: Dict[str, Any]):
+        """Добавление нового сообщения (только для уже загруженных пользователей)"""
+        buffer = self._buffers.get(user_id)
+        if buffer is None:
+            # Пользователь не в кэше - хвост истории подтянется из БД при чтении
+            return
+
+        buffer.append(entry)
+        self._buffers.move_to_end(user_id)
+
+    def invalidate(self, user_id: int = None):
+        """Сброс буфера пользователя (или всех буферов)"""
+        if user_id is None:
+            self._buffers.clear()
+        else:
+            self._buffers.pop(user_id, None)
+
+    def _evict(self):
+        """Вытеснение давно неактивных пользователей"""
+        while len(self._buffers) > self.max_users:
+            self._buffers.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def __len__(self) -> int:
+        return len(self._buffers)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика кэша"""
+        total = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'users': len(self._buffers),
+            'hit_rate': self.stats['hits'] / total if total else 0.0
+        }
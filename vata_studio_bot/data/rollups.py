@@ -0,0 +1,245 @@
+﻿import asyncio
+import logging
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Any
+
+logger = logging.getLogger(__name__)
+
+class AnalyticsRollup:
+    """
+    Дневные сводки по сообщениям для общей аналитики бота
+
+    Новые сообщения (message_id больше сохраненного водяного знака)
+    агрегируются в daily_stats и daily_intents в одной транзакции
+    с продвижением водяного знака, поэтому каждое сообщение учитывается
+    ровно один раз. Отчеты читают только сводные таблицы.
+    """
+
+    WATERMARK_KEY = 'messages_rollup'
+
+    def __init__(self, db, batch_size: int = 10000):
+        self.db = db
+        self.batch_size = batch_size
+        self._init_tables()
+
+    def _init_tables(self):
+        """Создание сводных таблиц"""
+        with sqlite3.connect(self.db.db_path) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    day TEXT PRIMARY KEY,
+                    total_messages INTEGER NOT NULL DEFAULT 0,
+                    user_messages INTEGER NOT NULL DEFAULT 0,
+                    bot_messages INTEGER NOT NULL DEFAULT 0,
+                    active_users INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_intents (
+                    day TEXT NOT NULL,
+                    intent TEXT NOT NULL,
+                    messages INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, intent)
+                ) WITHOUT ROWID
+            ''')
+
+            # Нужна для подсчета уникальных пользователей за день
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_active_users (
+                    day TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    PRIMARY KEY (day, user_id)
+                ) WITHOUT ROWID
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rollup_watermarks (
+                    name TEXT PRIMARY KEY,
+                    last_message_id INTEGER NOT NULL
+                )
+            ''')
+
+            conn.commit()
+
+    def watermark(self) -> int:
+        """message_id последнего сообщения, уже учтенного в сводках"""
+        with sqlite3.connect(self.db.db_path) as conn:
+            row = conn.execute('SELECT last_message_id FROM rollup_watermarks WHERE name = ?',
+                               (self.WATERMARK_KEY,)).fetchone()
+        return row[0] if row else 0
+
+    def run_once(self) -> int:
+        """
+        Агрегация всех новых сообщений
+
+        Returns:
+            Количество учтенных сообщений
+        """
+        processed = 0
+        try:
+            while True:
+                count = self._rollup_batch()
+                processed += count
+                if count < self.batch_size:
+                    break
+
+            if processed:
+                logger.info(f"📈 Сводки обновлены: {processed} новых сообщений")
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления сводок: {e}")
+
+        return processed
+
+    def _rollup_batch(self) -> int:
+        """Агрегация одной пачки сообщений после водяного знака"""
+        with sqlite3.connect(self.db.db_path) as conn:
+            cursor = conn.cursor()
+
+            row = cursor.execute('SELECT last_message_id FROM rollup_watermarks WHERE name = ?',
+                                 (self.WATERMARK_KEY,)).fetchone()
+            watermark = row[0] if row else 0
+
+            row = cursor.execute('''
+                SELECT COUNT(*), MAX(message_id)
+                FROM (
+                    SELECT message_id FROM messages
+                    WHERE message_id > ?
+                    ORDER BY message_id
+                    LIMIT ?
+                )
+            ''', (watermark, self.batch_size)).fetchone()
+            count, upper = row
+            if not count:
+                return 0
+
+            cursor.execute('DROP TABLE IF EXISTS temp.rollup_batch')
+            cursor.execute('''
+                CREATE TEMP TABLE rollup_batch AS
+                SELECT date(timestamp) AS day, user_id, is_bot, COALESCE(intent, 'unknown') AS intent
+                FROM messages
+                WHERE message_id > ? AND message_id <= ?
+            ''', (watermark, upper))
+
+            cursor.execute('''
+                INSERT INTO daily_stats (day, total_messages, user_messages, bot_messages)
+                SELECT day, COUNT(*),
+                       SUM(CASE WHEN is_bot THEN 0 ELSE 1 END),
+                       SUM(CASE WHEN is_bot THEN 1 ELSE 0 END)
+                FROM rollup_batch
+                WHERE true
+                GROUP BY day
+                ON CONFLICT(day) DO UPDATE SET
+                    total_messages = total_messages + excluded.total_messages,
+                    user_messages = user_messages + excluded.user_messages,
+                    bot_messages = bot_messages + excluded.bot_messages
+            ''')
+
+            cursor.execute('''
+                INSERT INTO daily_intents (day, intent, messages)
+                SELECT day, intent, COUNT(*)
+                FROM rollup_batch
+                WHERE NOT is_bot
+                GROUP BY day, intent
+                ON CONFLICT(day, intent) DO UPDATE SET
+                    messages = messages + excluded.messages
+            ''')
+
+            cursor.execute('''
+                INSERT OR IGNORE INTO daily_active_users (day, user_id)
+                SELECT DISTINCT day, user_id FROM rollup_batch WHERE NOT is_bot
+            ''')
+
+            # Пересчитываем уникальных только для затронутых дней (обычно один)
+            cursor.execute('''
+                UPDATE daily_stats
+                SET active_users = (
+                    SELECT COUNT(*) FROM daily_active_users d WHERE d.day = daily_stats.day
+                )
+                WHERE day IN (SELECT DISTINCT day FROM rollup_batch)
+            ''')
+
+            cursor.execute('''
+                INSERT INTO rollup_watermarks (name, last_message_id) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET last_message_id = excluded.last_message_id
+            ''', (self.WATERMARK_KEY, upper))
+
+            cursor.execute('DROP TABLE temp.rollup_batch')
+            conn.commit()
+
+            return count
+
+    def get_daily_stats(self, days: int = 7) -> List[Dict[str, Any]]:
+        """Сводка по дням за последние days дней (от новых к старым)"""
+        since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        try:
+            with sqlite3.connect(self.db.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT day, total_messages, user_messages, bot_messages, active_users
+                    FROM daily_stats
+                    WHERE day >= ?
+                    ORDER BY day DESC
+                ''', (since,))
+                return [dict(row) for row in cursor.fetchall()]
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка чтения сводок: {e}")
+            return []
+
+    def get_intent_stats(self, days: int = 7) -> Dict[str, int]:
+        """Количество сообщений по интентам за последние days дней"""
+        since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        try:
+            with sqlite3.connect(self.db.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT intent, SUM(messages)
+                    FROM daily_intents
+                    WHERE day >= ?
+                    GROUP BY intent
+                    ORDER BY SUM(messages) DESC
+                ''', (since,))
+                return {intent: count for intent, count in cursor.fetchall()}
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка чтения сводок по интентам: {e}")
+            return {}
+
+    async def run_periodic(self, interval_seconds: int):
+        """Периодическое обновление сводок в фоне"""
+        while True:
+            await asyncio.to_thread(self.run_once)
+            await asyncio.sleep(interval_seconds)
+
+def merge_daily_stats(parts: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Объединение дневных сводок нескольких шардов
+
+    Пользователь живет ровно в одном шарде, поэтому уникальных
+    пользователей за день тоже можно просто сложить.
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    for rows in parts:
+        for row in rows:
+            day = merged.setdefault(row['day'], {
+                'day': row['day'], 'total_messages': 0, 'user_messages': 0,
+                'bot_messages': 0, 'active_users': 0
+            })
+            for key in ('total_messages', 'user_messages', 'bot_messages', 'active_users'):
+                day[key] += row[key]
+
+    return sorted(merged.values(), key=lambda row: row['day'], reverse=True)
+
+def merge_intent_stats(parts: List[Dict[str, int]]) -> Dict[str, int]:
+    """Объединение сводок по интентам нескольких шардов"""
+    merged: Dict[str, int] = {}
+    for part in parts:
+        for intent, count in part.items():
+            merged[intent] = merged.get(intent, 0) + count
+    return dict(sorted(merged.items(), key=lambda item: item[1], reverse=True))
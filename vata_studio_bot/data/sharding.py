@@ -0,0 +1,353 @@
+﻿# data/sharding.py - распределение истории диалогов по нескольким файлам SQLite
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Any, Iterator, Tuple
+
+from .archive import MessageArchiver
+from .database import ConversationDatabase
+from .history_cache import RecentHistoryCache
+
+logger = logging.getLogger(__name__)
+
+def shard_paths(base_path: str, shard_count: int) -> List[str]:
+    """
+    Пути файлов шардов
+
+    При shard_count == 1 это сам base_path, поэтому обычная база
+    является частным случаем шардированной.
+    """
+    if shard_count <= 1:
+        return [base_path]
+
+    root, ext = os.path.splitext(base_path)
+    return [f"{root}.shard{i:02d}{ext or '.db'}" for i in range(shard_count)]
+
+def shard_for_user(user_id: int, shard_count: int) -> int:
+    """Номер шарда пользователя (стабильный хэш user_id)"""
+    if shard_count <= 1:
+        return 0
+    return zlib.crc32(struct.pack('<q', user_id)) % shard_count
+
+class _ShardWriter(threading.Thread):
+    """
+    Поток-писатель шарда: записи в один файл идут последовательно из очереди
+
+    Пока сообщение ждет в очереди, оно видно читателям через pending
+    (read-your-writes): чтение берет файл шарда и еще не записанные
+    сообщения пользователя под одной блокировкой, поэтому ждет не всю
+    очередь, а не больше одной текущей записи.
+    """
+
+    def __init__(self, db: ConversationDatabase, index: int):
+        super().__init__(name=f"shard-writer-{index}", daemon=True)
+        self.db = db
+        self.queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self.lock = threading.Lock()
+        self._pending: Dict[int, List[Dict[str, Any]]] = {}  # user_id -> сообщения в очереди (как в истории)
+
+    def put(self, item: Dict[str, Any], entry: Dict[str, Any]):
+        """Постановка сообщения в очередь; entry - его вид в истории диалога"""
+        with self.lock:
+            self._pending.setdefault(item['user_id'], []).append(entry)
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                with self.lock:
+                    try:
+                        self.db.save_message(**item)
+                    finally:
+                        pending = self._pending.get(item['user_id'])
+                        if pending:
+                            pending.pop(0)
+                            if not pending:
+                                del self._pending[item['user_id']]
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи в шард {self.db.db_path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def read(self, user_id: int, read_file: Callable[[], Any]) -> Tuple[Any, List[Dict[str, Any]]]:
+        """Чтение из файла шарда и еще не записанные сообщения пользователя"""
+        with self.lock:
+            return read_file(), list(self._pending.get(user_id, ()))
+
+    def flush(self):
+        """Ожидание записи всех сообщений из очереди"""
+        self.queue.join()
+
+class ShardedConversationDatabase:
+    """
+    История диалогов, распределенная по N файлам SQLite по хэшу user_id
+
+    Интерфейс совпадает с ConversationDatabase. Каждый шард пишет свой
+    поток, поэтому сообщения разных пользователей сохраняются параллельно;
+    общая статистика и поиск собираются опросом всех шардов.
+    """
+
+    def __init__(self, base_path: str, shard_count: int,
+                 history_cache_users: int = 10000, history_depth: int = 5):
+        self.base_path = base_path
+        self.shard_count = shard_count
+
+        # Кэш последних сообщений общий, шарды работают без своего кэша
+        self.history_cache = None
+        if history_cache_users > 0:
+            self.history_cache = RecentHistoryCache(max_users=history_cache_users, depth=history_depth)
+
+        self.shards = [
+            ConversationDatabase(path, history_cache_users=0)
+            for path in shard_paths(base_path, shard_count)
+        ]
+
+        self._writers = [_ShardWriter(shard, i) for i, shard in enumerate(self.shards)]
+        for writer in self._writers:
+            writer.start()
+
+        self._pool = ThreadPoolExecutor(max_workers=shard_count, thread_name_prefix="shard-read")
+
+        logger.info(f"🧩 Шардированная база: {shard_count} шардов ({base_path})")
+
+    @property
+    def fts_enabled(self) -> bool:
+        return all(shard.fts_enabled for shard in self.shards)
+
+    def _shard_index(self, user_id: int) -> int:
+        return shard_for_user(user_id, self.shard_count)
+
+    def shard_for(self, user_id: int) -> ConversationDatabase:
+        """Шард, в котором хранится пользователь"""
+        return self.shards[self._shard_index(user_id)]
+
+    def _fan_out(self, method: str, *args, **kwargs) -> List[Any]:
+        """Параллельный вызов метода на всех шардах"""
+        futures = [self._pool.submit(getattr(shard, method), *args, **kwargs) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    # ================== ЗАПИСЬ ==================
+
+    def save_message(self, user_id: int, username: str,
+                     first_name: str, last_name: str,
+                     message: str, is_bot: bool = False, intent: Optional[str] = None):
+        """Сохранение сообщения (асинхронно, через очередь шарда)"""
+        entry = {
+            'text': message,
+            'is_bot': bool(is_bot),
+            'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self._writers[self._shard_index(user_id)].put({
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'message': message,
+            'is_bot': is_bot,
+            'intent': intent
+        }, entry)
+
+        if self.history_cache is not None:
+            self.history_cache.append(user_id, dict(entry))
+
+    def flush(self):
+        """Дождаться записи всех поставленных в очередь сообщений"""
+        for writer in self._writers:
+            writer.flush()
+
+    def close(self):
+        """Остановка потоков-писателей"""
+        for writer in self._writers:
+            writer.queue.put(None)
+        for writer in self._writers:
+            writer.join()
+        self._pool.shutdown(wait=True)
+
+    # ================== ЧТЕНИЕ ==================
+
+    def get_conversation_history(self, user_id: int, limit: int = 5) -> List[Dict[str, Any]]:
+        """Получение истории диалога"""
+        if self.history_cache is not None:
+            cached = self.history_cache.get(user_id, limit)
+            if cached is not None:
+                return cached
+
+        # Хвост истории, еще не записанный в файл, берем из очереди шарда (без ожидания записи)
+        index = self._shard_index(user_id)
+        depth = max(limit, self.history_cache.depth if self.history_cache is not None else limit)
+        history, pending = self._writers[index].read(
+            user_id, lambda: self.shards[index].get_conversation_history(user_id, depth))
+        history = (history + pending)[-depth:]
+
+        if self.history_cache is not None:
+            self.history_cache.load(user_id, history)
+
+        return history[-limit:] if limit > 0 else []
+
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение статистики пользователя"""
+        index = self._shard_index(user_id)
+        stats, pending = self._writers[index].read(user_id, lambda: self.shards[index].get_user_stats(user_id))
+        if not stats or not pending:
+            return stats
+
+        # Учитываем сообщения, которые еще ждут записи в очереди шарда
+        bot_messages = sum(1 for entry in pending if entry['is_bot'])
+        return {
+            'total_messages': stats['total_messages'] + len(pending),
+            'bot_messages': stats['bot_messages'] + bot_messages,
+            'user_messages': stats['user_messages'] + len(pending) - bot_messages,
+            'first_message': stats['first_message'] or pending[0]['timestamp'],
+            'last_activity': pending[-1]['timestamp']
+        }
+
+    def get_global_stats(self) -> Dict[str, Any]:
+        """Общая статистика по всем шардам"""
+        totals = {'users': 0, 'total_messages': 0, 'bot_messages': 0, 'user_messages': 0}
+        for stats in self._fan_out('get_global_stats'):
+            for key in totals:
+                totals[key] += stats.get(key, 0)
+        totals['shards'] = self.shard_count
+        return totals
+
+    def search_messages(self, query: str, limit: int = 10, offset: int = 0,
+                        since: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Поиск по всем шардам с объединением по релевантности"""
+        results = self._fan_out('search_messages', query, limit=offset + limit, offset=0, since=since)
+        merged = heapq.merge(*results, key=lambda hit: hit['rank'])
+        return list(itertools.islice(merged, offset, offset + limit))
+
+    def iter_messages(self, since: Optional[str] = None, until: Optional[str] = None,
+                      user_id: Optional[int] = None, chunk_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Потоковое чтение сообщений (шард за шардом)"""
+        shards = [self.shard_for(user_id)] if user_id is not None else self.shards
+        for shard in shards:
+            yield from shard.iter_messages(since=since, until=until, user_id=user_id, chunk_size=chunk_size)
+
+    def check_user_stats_consistency(self, fix: bool = False) -> List[int]:
+        """Сверка агрегатов на всех шардах"""
+        self.flush()
+        return [user_id for mismatched in self._fan_out('check_user_stats_consistency', fix=fix)
+                for user_id in mismatched]
+
+def create_database(path: str, shards: int = 1,
+                    history_cache_users: int = 10000, history_depth: int = 5):
+    """Обычная база при shards <= 1, иначе шардированная"""
+    if shards <= 1:
+        return ConversationDatabase(path, history_cache_users=history_cache_users,
+                                    history_depth=history_depth)
+    return ShardedConversationDatabase(path, shards, history_cache_users=history_cache_users,
+                                       history_depth=history_depth)
+
+# ================== РЕШАРДИНГ ==================
+
+def shard_archive_dir(archive_dir: str, index: int, shard_count: int) -> str:
+    """Каталог архива шарда (так же, как его задает архиватор при запуске бота)"""
+    if shard_count <= 1:
+        return archive_dir
+    return os.path.join(archive_dir, f"shard{index:02d}")
+
+def _archived_messages(src: ConversationDatabase, archive_dir: str) -> Iterator[Dict[str, Any]]:
+    """Сообщения из архивных сегментов исходного шарда (от старых к новым)"""
+    archiver = MessageArchiver(src, archive_dir)
+    with sqlite3.connect(src.db_path) as conn:
+        segment_ids = [row[0] for row in conn.execute('SELECT segment_id FROM archive_segments ORDER BY segment_id')]
+    for segment_id in segment_ids:
+        yield from archiver.iter_segment(segment_id)
+
+def reshard(base_path: str, src_shards: int, dst_base_path: str, dst_shards: int,
+            batch_size: int = 5000, archive_dir: Optional[str] = None) -> int:
+    """
+    Перенос истории из src_shards файлов в dst_shards файлов
+
+    Целевые файлы должны быть новыми (пустыми). Агрегаты user_stats
+    и поисковый индекс целевых шардов строятся их триггерами.
+
+    Архивные сегменты привязаны к каталогу исходного шарда, поэтому
+    переносятся сами сообщения: с archive_dir (каталог архива исходной
+    базы) архивные сообщения возвращаются в messages целевых шардов, и
+    архиватор заново выгрузит их в каталоги новых шардов. Без archive_dir
+    база с архивом не решардится - иначе архивные счетчики пропали бы.
+
+    Returns:
+        Количество перенесенных сообщений
+    """
+    src_paths = shard_paths(base_path, src_shards)
+    dst_paths = shard_paths(dst_base_path, dst_shards)
+    if set(src_paths) & set(dst_paths):
+        raise ValueError("Исходные и целевые файлы шардов должны различаться")
+
+    sources = [ConversationDatabase(path, history_cache_users=0) for path in src_paths]
+    for src in sources:
+        with sqlite3.connect(src.db_path) as conn:
+            archived = conn.execute('SELECT COUNT(*) FROM archive_segments').fetchone()[0]
+        if archived and archive_dir is None:
+            raise ValueError(f"В {src.db_path} есть архивные сегменты ({archived}): "
+                             f"укажите каталог архива (archive_dir, --archive-dir), чтобы перенести и их")
+
+    targets = [ConversationDatabase(path, history_cache_users=0) for path in dst_paths]
+    moved = 0
+
+    for src_index, src in enumerate(sources):
+        src_path = src.db_path
+        with sqlite3.connect(src_path) as conn:
+            users = {row[0]: row[1:] for row in conn.execute(
+                'SELECT user_id, username, first_name, last_name FROM users')}
+
+        rows = src.iter_messages(chunk_size=batch_size)
+        if archive_dir is not None:
+            rows = itertools.chain(_archived_messages(src, shard_archive_dir(archive_dir, src_index, src_shards)), rows)
+
+        batches: Dict[int, List[Dict[str, Any]]] = {i: [] for i in range(dst_shards)}
+        for row in rows:
+            username, first_name, last_name = users.get(row['user_id'], (None, None, None))
+            index = shard_for_user(row['user_id'], dst_shards)
+            batches[index].append({**row, 'username': username,
+                                   'first_name': first_name, 'last_name': last_name})
+
+            if len(batches[index]) >= batch_size:
+                targets[index].bulk_insert_messages(batches[index])
+                moved += len(batches[index])
+                batches[index] = []
+
+        for index, batch in batches.items():
+            if batch:
+                targets[index].bulk_insert_messages(batch)
+                moved += len(batch)
+
+        logger.info(f"🧩 {src_path} перенесен, всего сообщений: {moved}")
+
+    return moved
+
+def main():
+    """CLI: python -m data.sharding --src data/conversations.db --src-shards 1 --dst-shards 4"""
+    parser = argparse.ArgumentParser(description="Решардинг истории диалогов Vata Studio")
+    parser.add_argument('--src', required=True, help="Базовый путь исходной базы")
+    parser.add_argument('--src-shards', type=int, default=1)
+    parser.add_argument('--dst', help="Базовый путь новой базы (по умолчанию <src>.resharded)")
+    parser.add_argument('--dst-shards', type=int, required=True)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--archive-dir', help="Каталог архива исходной базы (если архивация включалась)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    root, ext = os.path.splitext(args.src)
+    dst = args.dst or f"{root}.resharded{ext}"
+    reshard(args.src, args.src_shards, dst, args.dst_shards, batch_size=args.batch_size,
+            archive_dir=args.archive_dir)
+
+if __name__ == "__main__":
+    main()
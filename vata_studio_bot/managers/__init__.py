@@ -1,12 +1,23 @@
-"""
-    .
-        .
+﻿"""
+Пакет для управления ботом менеджерами.
+Содержит инструменты для уведомления менеджеров и контроля состояния бота.
 """
 
 from .notification import ManagerNotifier
 from .control import BotController
+from .state_store import ControllerStateStore
+from .notification_store import NotificationStore, PendingNotification
+from .outbox import NotificationOutbox
+from .routing import ManagerRouter
+from .digest import ManagerDigest
 
 __all__ = [
     'ManagerNotifier',
-    'BotController'
+    'BotController',
+    'ControllerStateStore',
+    'NotificationStore',
+    'PendingNotification',
+    'NotificationOutbox',
+    'ManagerRouter',
+    'ManagerDigest'
 ]
\ No newline at end of file
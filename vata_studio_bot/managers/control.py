@@ -1,24 +1,84 @@
-﻿import logging
-from typing import Dict, List, Any, Set
-from datetime import datetime, timedelta
+﻿import asyncio
+import base64
+import logging
+import time
+from typing import Dict, List, Any, Iterable, Optional
+
+from utils.bitmap import CompressedBitmap
+from utils.deadline_timers import DeadlineTimers
+from utils.rate_limit import RateLimiter, TokenBucket
+from utils.timer_wheel import TimerWheel
+from .state_store import ControllerStateStore
 
 logger = logging.getLogger(__name__)
 
+class UserSession:
+    """
+    Сессия пользователя
+
+    Запись с __slots__ вместо словаря: без __dict__ и с отметками времени
+    time.monotonic() вместо datetime. Вычисляемые поля - свойства, а доступ
+    по ключу (session['message_count']) оставлен для обработчиков.
+    """
+
+    __slots__ = ('started_at', 'last_activity', 'ended_at', 'closed_by', 'message_count',
+                 'ai_responses', 'active', 'typing_started', 'typing_timeouts')
+
+    def __init__(self, now: float):
+        self.started_at = now
+        self.last_activity = now
+        self.ended_at: Optional[float] = None
+        self.closed_by: Optional[str] = None  # Причина закрытия: 'expired' или 'disabled'
+        self.message_count = 0
+        self.ai_responses = 0
+        self.active = True
+        self.typing_started: Optional[float] = None
+        self.typing_timeouts = 0
+
+    @property
+    def session_duration_minutes(self) -> int:
+        return int((time.monotonic() - self.started_at) // 60)
+
+    @property
+    def inactive_minutes(self) -> int:
+        return int((time.monotonic() - self.last_activity) // 60)
+
+    @property
+    def messages_per_minute(self) -> float:
+        return self.message_count / max(self.session_duration_minutes, 1)
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
 class BotController:
-    """Контроллер для управления состоянием бота"""
+    """
+    Контроллер для управления состоянием бота
+    
+    Если передан state_path, состояние (включение/отключение бота, переопределения
+    менеджеров, настройки, сессии и статистика) переживает перезапуск: изменения
+    пишутся в журнал, а сессии и статистика - в периодические снимки.
+    """
     
-    def __init__(self):
-        self.enabled_users: Set[int] = set()  # Пользователи с включенным ботом
-        self.disabled_users: Set[int] = set() # Пользователи с отключенным ботом
-        self.user_sessions: Dict[int, Dict[str, Any]] = {}  # Активные сессии
+    def __init__(self, state_path: Optional[str] = None):
+        # Храним только явные решения; остальные пользователи - по настройке по умолчанию
+        self.enabled_users = CompressedBitmap()   # Пользователи с включенным ботом
+        self.disabled_users = CompressedBitmap()  # Пользователи с отключенным ботом
+        self.user_sessions: Dict[int, UserSession] = {}  # Активные сессии
         self.manager_overrides: Dict[int, List[int]] = {}   # Менеджеры, переопределившие пользователей
+        self.user_managers: Dict[int, int] = {}             # Пользователь -> последний переопределивший менеджер
         
         # Настройки по умолчанию
         self.settings = {
             'auto_enable_new_users': True,
             'session_timeout_minutes': 30,
             'max_messages_per_minute': 10,
+            'max_chat_messages_per_minute': 30,
+            'max_global_messages_per_second': 50,
             'typing_timeout_seconds': 30,
+            'typing_alert_cooldown_seconds': 300,
             'enable_ai_by_default': True
         }
         
@@ -28,9 +88,32 @@ class BotController:
             'active_sessions': 0,
             'disabled_sessions': 0,
             'ai_responses': 0,
-            'manager_interventions': 0
+            'manager_interventions': 0,
+            'expired_sessions': 0,
+            'rate_limited_user': 0,
+            'rate_limited_chat': 0,
+            'rate_limited_global': 0
         }
         
+        # Ограничение скорости: на пользователя, на чат и общее
+        self.user_limiter = RateLimiter(self.settings['max_messages_per_minute'], 60)
+        self.chat_limiter = RateLimiter(self.settings['max_chat_messages_per_minute'], 60)
+        self.global_bucket = TokenBucket(self.settings['max_global_messages_per_second'],
+                                         self.settings['max_global_messages_per_second'])
+        
+        # Истечение сессий: таймер ставится при старте сессии, а активность
+        # таймер не трогает - она проверяется, когда таймер сработает
+        self.session_wheel = TimerWheel(tick_seconds=1.0)
+        
+        # Таймеры набора текста; обработчик истечения назначается при запуске бота
+        self.typing_timers = DeadlineTimers(cooldown_seconds=self.settings['typing_alert_cooldown_seconds'])
+        
+        # Журнал и снимки состояния
+        self.state_store: Optional[ControllerStateStore] = None
+        if state_path:
+            self.state_store = ControllerStateStore(state_path)
+            self._restore_state()
+        
         logger.info("🎛️ Контроллер бота инициализирован")
     
     def is_bot_enabled_for_user(self, user_id: int) -> bool:
@@ -40,19 +123,17 @@ class BotController:
         if user_id in self.enabled_users:
             return True
         
-        # Новый пользователь - применяем настройку по умолчанию
-        if self.settings['auto_enable_new_users']:
-            self.enable_bot_for_user(user_id)
-            return True
-        
-        return False
+        # Новый пользователь - настройка по умолчанию (без записи в множества)
+        return bool(self.settings['auto_enable_new_users'])
     
-    def enable_bot_for_user(self, user_id: int, manager_id: int = None) -> bool:
-        """Включение бота для пользователя"""
-        if user_id in self.disabled_users:
-            self.disabled_users.remove(user_id)
-        
-        self.enabled_users.add(user_id)
+    def _set_user_enabled(self, user_id: int, enabled: bool, manager_id: int = None):
+        """Изменение состояния бота для пользователя (общая часть с восстановлением из журнала)"""
+        if enabled:
+            self.disabled_users.discard(user_id)
+            self.enabled_users.add(user_id)
+        else:
+            self.enabled_users.discard(user_id)
+            self.disabled_users.add(user_id)
         
         # Записываем переопределение если было от менеджера
         if manager_id:
@@ -60,43 +141,87 @@ class BotController:
                 self.manager_overrides[manager_id] = []
             if user_id not in self.manager_overrides[manager_id]:
                 self.manager_overrides[manager_id].append(user_id)
+            self.user_managers[user_id] = manager_id
             
             self.stats['manager_interventions'] += 1
+    
+    def enable_bot_for_user(self, user_id: int, manager_id: int = None) -> bool:
+        """Включение бота для пользователя"""
+        # Бот уже включен (в том числе по настройке по умолчанию) - без менеджера
+        # это не исключение, и в битовую карту и журнал оно не пишется
+        if manager_id or not self.is_bot_enabled_for_user(user_id):
+            self._set_user_enabled(user_id, True, manager_id)
+            self._log_state('enable', user_id=user_id, manager_id=manager_id)
+            
+            logger.info(f"✅ Бот включен для user_id={user_id}" + 
+                       (f" менеджером {manager_id}" if manager_id else ""))
         
         # Создаем или обновляем сессию
         self._create_or_update_session(user_id)
-        
-        logger.info(f"✅ Бот включен для user_id={user_id}" + 
-                   (f" менеджером {manager_id}" if manager_id else ""))
         return True
     
     def disable_bot_for_user(self, user_id: int, manager_id: int = None) -> bool:
         """Отключение бота для пользователя"""
-        if user_id in self.enabled_users:
-            self.enabled_users.remove(user_id)
-        
-        self.disabled_users.add(user_id)
-        
-        # Записываем переопределение если было от менеджера
-        if manager_id:
-            if manager_id not in self.manager_overrides:
-                self.manager_overrides[manager_id] = []
-            if user_id not in self.manager_overrides[manager_id]:
-                self.manager_overrides[manager_id].append(user_id)
-            
-            self.stats['manager_interventions'] += 1
+        self._set_user_enabled(user_id, False, manager_id)
+        self._log_state('disable', user_id=user_id, manager_id=manager_id)
         
         # Закрываем сессию
-        if user_id in self.user_sessions:
-            self.user_sessions[user_id]['active'] = False
-            self.user_sessions[user_id]['ended_at'] = datetime.now()
-            self.stats['active_sessions'] -= 1
-            self.stats['disabled_sessions'] += 1
+        self._close_session(user_id)
         
         logger.info(f"⛔ Бот отключен для user_id={user_id}" + 
                    (f" менеджером {manager_id}" if manager_id else ""))
         return True
     
+    def _close_session(self, user_id: int):
+        """Закрытие сессии при отключении бота"""
+        session = self.user_sessions.get(user_id)
+        if session and session.active:
+            self.session_wheel.cancel(user_id)
+            session.active = False
+            session.ended_at = time.monotonic()
+            session.closed_by = 'disabled'
+            self.stats['active_sessions'] -= 1
+            self.stats['disabled_sessions'] += 1
+    
+    def set_bot_enabled_bulk(self, user_ids: Iterable[int], enabled: bool, manager_id: int = None) -> int:
+        """
+        Включение или отключение бота для списка пользователей
+        
+        Returns:
+            Количество обработанных пользователей
+        """
+        user_ids = list(user_ids)
+        for user_id in user_ids:
+            self._set_user_enabled(user_id, enabled, manager_id)
+            if not enabled:
+                self._close_session(user_id)
+        
+        self._log_state('bulk', user_ids=user_ids, enabled=enabled, manager_id=manager_id)
+        
+        logger.info(f"{'✅' if enabled else '⛔'} Бот {'включен' if enabled else 'отключен'} "
+                    f"для {len(user_ids)} пользователей" + (f" менеджером {manager_id}" if manager_id else ""))
+        return len(user_ids)
+    
+    def set_bot_enabled_range(self, start: int, stop: int, enabled: bool):
+        """Включение или отключение бота для всех user_id в диапазоне [start, stop)"""
+        self._set_range_enabled(start, stop, enabled)
+        self._log_state('range', start=start, stop=stop, enabled=enabled)
+        
+        if not enabled:
+            for user_id in [uid for uid in self.user_sessions if start <= uid < stop]:
+                self._close_session(user_id)
+        
+        logger.info(f"{'✅' if enabled else '⛔'} Бот {'включен' if enabled else 'отключен'} "
+                    f"для диапазона user_id [{start}, {stop})")
+    
+    def _set_range_enabled(self, start: int, stop: int, enabled: bool):
+        if enabled:
+            self.disabled_users.remove_range(start, stop)
+            self.enabled_users.add_range(start, stop)
+        else:
+            self.enabled_users.remove_range(start, stop)
+            self.disabled_users.add_range(start, stop)
+    
     def toggle_bot_for_user(self, user_id: int, manager_id: int = None) -> bool:
         """Переключение состояния бота для пользователя"""
         if self.is_bot_enabled_for_user(user_id):
@@ -106,55 +231,72 @@ class BotController:
     
     def _create_or_update_session(self, user_id: int):
         """Создание или обновление сессии пользователя"""
-        now = datetime.now()
+        now = time.monotonic()
+        session = self.user_sessions.get(user_id)
         
-        if user_id not in self.user_sessions:
+        if session is None:
             # Новая сессия
-            self.user_sessions[user_id] = {
-                'started_at': now,
-                'last_activity': now,
-                'message_count': 0,
-                'ai_responses': 0,
-                'active': True,
-                'typing_started': None,
-                'typing_timeouts': 0
-            }
+            self.user_sessions[user_id] = UserSession(now)
             self.stats['total_sessions'] += 1
             self.stats['active_sessions'] += 1
+            self._schedule_session_expiry(user_id)
         else:
             # Обновление существующей сессии
-            self.user_sessions[user_id]['last_activity'] = now
+            session.last_activity = now
             
-            # Если сессия была неактивна, возобновляем
-            if not self.user_sessions[user_id]['active']:
-                self.user_sessions[user_id]['active'] = True
-                self.user_sessions[user_id]['started_at'] = now
+            # Если сессия была неактивна, возобновляем (отключенной она числилась,
+            # только если ее закрыло отключение бота, а не истечение)
+            if not session.active:
+                if session.closed_by == 'disabled':
+                    self.stats['disabled_sessions'] -= 1
+                session.active = True
+                session.started_at = now
+                session.ended_at = None
+                session.closed_by = None
                 self.stats['active_sessions'] += 1
-                self.stats['disabled_sessions'] -= 1
+                self._schedule_session_expiry(user_id)
+    
+    def _schedule_session_expiry(self, user_id: int, inactive_seconds: float = 0):
+        """Постановка таймера истечения сессии"""
+        timeout_seconds = self.settings['session_timeout_minutes'] * 60
+        self.session_wheel.schedule(user_id, time.monotonic() + timeout_seconds - inactive_seconds)
     
     def record_user_message(self, user_id: int):
         """Запись сообщения пользователя"""
         self._create_or_update_session(user_id)
         
         session = self.user_sessions[user_id]
-        session['message_count'] += 1
-        session['last_activity'] = datetime.now()
+        session.message_count += 1
     
     def record_ai_response(self, user_id: int):
         """Запись ответа ИИ"""
         if user_id in self.user_sessions:
-            self.user_sessions[user_id]['ai_responses'] += 1
+            self.user_sessions[user_id].ai_responses += 1
             self.stats['ai_responses'] += 1
     
-    def start_typing_timer(self, user_id: int):
-        """Старт таймера набора текста"""
+    def start_typing_timer(self, user_id: int, user_info: Dict[str, Any] = None):
+        """
+        Старт таймера набора текста
+        
+        Если бот не ответит за typing_timeout_seconds, таймер сработает
+        и вызовет typing_timers.on_expire(user_id, user_info).
+        """
         if user_id in self.user_sessions:
-            self.user_sessions[user_id]['typing_started'] = datetime.now()
+            self.user_sessions[user_id].typing_started = time.monotonic()
+            self.typing_timers.schedule(user_id, self.settings['typing_timeout_seconds'], user_info)
     
     def stop_typing_timer(self, user_id: int):
         """Остановка таймера набора текста"""
         if user_id in self.user_sessions:
-            self.user_sessions[user_id]['typing_started'] = None
+            self.user_sessions[user_id].typing_started = None
+        self.typing_timers.cancel(user_id)
+    
+    def record_typing_timeout(self, user_id: int):
+        """Учет сработавшего таймера набора текста"""
+        session = self.user_sessions.get(user_id)
+        if session:
+            session.typing_timeouts += 1
+            session.typing_started = None
     
     def check_typing_timeout(self, user_id: int) -> bool:
         """Проверка таймаута набора текста"""
@@ -162,70 +304,95 @@ class BotController:
             return False
         
         session = self.user_sessions[user_id]
-        if not session['typing_started']:
+        if session.typing_started is None:
             return False
         
         timeout_seconds = self.settings['typing_timeout_seconds']
-        time_typing = (datetime.now() - session['typing_started']).seconds
+        time_typing = time.monotonic() - session.typing_started
         
         if time_typing > timeout_seconds:
-            session['typing_timeouts'] += 1
-            session['typing_started'] = None
+            session.typing_timeouts += 1
+            session.typing_started = None
             return True
         
         return False
     
-    def check_message_rate_limit(self, user_id: int) -> bool:
-        """Проверка ограничения скорости сообщений"""
-        if user_id not in self.user_sessions:
-            return True
+    def check_message_rate_limit(self, user_id: int, chat_id: int = None) -> bool:
+        """
+        Проверка ограничения скорости сообщений
         
-        session = self.user_sessions[user_id]
-        max_per_minute = self.settings['max_messages_per_minute']
+        Сообщение списывает по токену из корзины пользователя, чата и общей.
+        Если какая-то ступень отказала, уже списанные токены возвращаются.
+        """
+        if not self.user_limiter.allow(user_id):
+            self.stats['rate_limited_user'] += 1
+            return False
+        
+        if chat_id is not None and chat_id != user_id:
+            if not self.chat_limiter.allow(chat_id):
+                self.user_limiter.refund(user_id)
+                self.stats['rate_limited_chat'] += 1
+                return False
+        
+        if not self.global_bucket.try_consume():
+            self.user_limiter.refund(user_id)
+            if chat_id is not None and chat_id != user_id:
+                self.chat_limiter.refund(chat_id)
+            self.stats['rate_limited_global'] += 1
+            return False
         
-        # Здесь можно добавить сложную логику ограничения скорости
-        # Пока просто возвращаем True (не ограничиваем)
         return True
     
     def cleanup_inactive_sessions(self):
-        """Очистка неактивных сессий"""
-        now = datetime.now()
-        timeout_minutes = self.settings['session_timeout_minutes']
-        removed_count = 0
+        """
+        Очистка неактивных сессий
         
-        inactive_users = []
-        for user_id, session in self.user_sessions.items():
-            if session['active']:
-                inactive_time = (now - session['last_activity']).seconds // 60
-                if inactive_time > timeout_minutes:
-                    inactive_users.append(user_id)
+        Обходятся только сработавшие таймеры, а не все сессии. Если после
+        постановки таймера пользователь писал, сессия не закрывается, а таймер
+        переставляется на last_activity + таймаут.
+        """
+        now = time.monotonic()
+        timeout_seconds = self.settings['session_timeout_minutes'] * 60
+        removed_count = 0
         
-        for user_id in inactive_users:
-            self.user_sessions[user_id]['active'] = False
-            self.user_sessions[user_id]['ended_at'] = now
+        for user_id in self.session_wheel.advance(now):
+            session = self.user_sessions.get(user_id)
+            if not session or not session.active:
+                continue
+            
+            inactive_seconds = now - session.last_activity
+            if inactive_seconds < timeout_seconds:
+                self._schedule_session_expiry(user_id, inactive_seconds)
+                continue
+            
+            session.active = False
+            session.ended_at = now
+            session.closed_by = 'expired'
             self.stats['active_sessions'] -= 1
+            self.stats['expired_sessions'] += 1
             removed_count += 1
         
         if removed_count > 0:
             logger.info(f"🧹 Очищено {removed_count} неактивных сессий")
     
-    def get_user_session_info(self, user_id: int) -> Dict[str, Any]:
-        """Получение информации о сессии пользователя"""
-        if user_id not in self.user_sessions:
-            return None
-        
-        session = self.user_sessions[user_id].copy()
-        
-        # Добавляем вычисляемые поля
-        now = datetime.now()
-        session_duration = (now - session['started_at']).seconds // 60
-        inactive_time = (now - session['last_activity']).seconds // 60 if session['last_activity'] else 0
-        
-        session['session_duration_minutes'] = session_duration
-        session['inactive_minutes'] = inactive_time
-        session['messages_per_minute'] = session['message_count'] / max(session_duration, 1)
+    async def run_session_expiry(self, interval_seconds: float = 1.0):
+        """Фоновое истечение сессий (раз в тик колеса таймеров)"""
+        while True:
+            try:
+                self.cleanup_inactive_sessions()
+            except Exception as e:
+                logger.error(f"❌ Ошибка очистки сессий: {e}")
+            await asyncio.sleep(interval_seconds)
+    
+    def get_user_session_info(self, user_id: int) -> Optional[UserSession]:
+        """
+        Получение информации о сессии пользователя
         
-        return session
+        Возвращается сама сессия без копирования; вычисляемые поля
+        (session_duration_minutes, inactive_minutes, messages_per_minute)
+        считаются при обращении.
+        """
+        return self.user_sessions.get(user_id)
     
     def get_controller_stats(self) -> Dict[str, Any]:
         """Получение статистики контроллера"""
@@ -234,18 +401,176 @@ class BotController:
             'enabled_users': len(self.enabled_users),
             'disabled_users': len(self.disabled_users),
             'active_sessions': self.stats['active_sessions'],
+            'scheduled_expiries': len(self.session_wheel),
+            'rate_limiter': {
+                'user': self.user_limiter.get_stats(),
+                'chat': self.chat_limiter.get_stats()
+            },
+            'typing_timers': self.typing_timers.get_stats(),
             'settings': self.settings
         }
     
+    def _apply_setting(self, setting_name: str, value: Any):
+        """Применение настройки (общая часть с восстановлением из журнала)"""
+        self.settings[setting_name] = value
+        
+        # Лимиты применяются сразу
+        if setting_name == 'max_messages_per_minute':
+            self.user_limiter.configure(value, 60)
+        elif setting_name == 'max_chat_messages_per_minute':
+            self.chat_limiter.configure(value, 60)
+        elif setting_name == 'max_global_messages_per_second':
+            self.global_bucket = TokenBucket(value, value)
+        elif setting_name == 'typing_alert_cooldown_seconds':
+            self.typing_timers.cooldown_seconds = value
+        elif setting_name == 'session_timeout_minutes':
+            # Редкая операция: переставляем таймеры всех активных сессий
+            now = time.monotonic()
+            for user_id, session in self.user_sessions.items():
+                if session.active:
+                    self._schedule_session_expiry(user_id, now - session.last_activity)
+    
     def update_setting(self, setting_name: str, value: Any) -> bool:
         """Обновление настройки контроллера"""
         if setting_name in self.settings:
             old_value = self.settings[setting_name]
-            self.settings[setting_name] = value
+            self._apply_setting(setting_name, value)
+            self._log_state('setting', name=setting_name, value=value)
+            
             logger.info(f"⚙️ Настройка '{setting_name}' изменена: {old_value} -> {value}")
             return True
         return False
     
     def get_users_by_manager(self, manager_id: int) -> List[int]:
         """Получение пользователей, переопределенных менеджером"""
-        return self.manager_overrides.get(manager_id, [])
\ No newline at end of file
+        return self.manager_overrides.get(manager_id, [])
+    
+    def get_manager_for_user(self, user_id: int) -> Optional[int]:
+        """Менеджер, последним переопределивший пользователя"""
+        return self.user_managers.get(user_id)
+    
+    # ================== СОХРАНЕНИЕ СОСТОЯНИЯ ==================
+    
+    def _log_state(self, op: str, **payload):
+        """Запись операции в журнал состояния (если он подключен)"""
+        if self.state_store is not None:
+            self.state_store.append(op, payload)
+    
+    def export_state(self) -> Dict[str, Any]:
+        """
+        Снимок состояния контроллера
+        
+        Монотонные отметки времени сессий переводятся в unix-время,
+        иначе после перезапуска процесса они теряют смысл.
+        """
+        offset = time.time() - time.monotonic()
+        sessions = [
+            [user_id, session.started_at + offset, session.last_activity + offset,
+             session.ended_at + offset if session.ended_at is not None else None,
+             session.message_count, session.ai_responses, session.active, session.typing_timeouts,
+             session.closed_by]
+            for user_id, session in self.user_sessions.items()
+        ]
+        
+        return {
+            'version': 2,
+            'enabled_users': base64.b64encode(self.enabled_users.to_bytes()).decode('ascii'),
+            'disabled_users': base64.b64encode(self.disabled_users.to_bytes()).decode('ascii'),
+            'manager_overrides': {str(manager_id): list(users) for manager_id, users in self.manager_overrides.items()},
+            'settings': dict(self.settings),
+            'stats': dict(self.stats),
+            'sessions': sessions
+        }
+    
+    def load_state(self, state: Dict[str, Any]):
+        """Загрузка снимка состояния"""
+        self.enabled_users = self._load_bitmap(state.get('enabled_users', []))
+        self.disabled_users = self._load_bitmap(state.get('disabled_users', []))
+        self.manager_overrides = {int(manager_id): users for manager_id, users in state.get('manager_overrides', {}).items()}
+        self.user_managers = {user_id: manager_id for manager_id, users in self.manager_overrides.items() for user_id in users}
+        self.stats.update(state.get('stats', {}))
+        
+        for setting_name, value in state.get('settings', {}).items():
+            if setting_name in self.settings:
+                self._apply_setting(setting_name, value)
+        
+        offset = time.time() - time.monotonic()
+        now = time.monotonic()
+        self.user_sessions = {}
+        for user_id, started_at, last_activity, ended_at, message_count, ai_responses, active, typing_timeouts, *closed_by \
+                in state.get('sessions', []):
+            session = UserSession(started_at - offset)
+            session.last_activity = last_activity - offset
+            session.ended_at = ended_at - offset if ended_at is not None else None
+            session.message_count = message_count
+            session.ai_responses = ai_responses
+            session.active = active
+            session.typing_timeouts = typing_timeouts
+            session.closed_by = closed_by[0] if closed_by else None  # В старых снимках причины нет
+            self.user_sessions[user_id] = session
+            
+            # Истекшие за время простоя закроются на первом же тике
+            if active:
+                self._schedule_session_expiry(user_id, now - session.last_activity)
+        
+        self.stats['active_sessions'] = sum(1 for session in self.user_sessions.values() if session.active)
+    
+    @staticmethod
+    def _load_bitmap(value) -> CompressedBitmap:
+        """Битовая карта из снимка (версия 1 хранила список user_id)"""
+        if isinstance(value, str):
+            return CompressedBitmap.from_bytes(base64.b64decode(value))
+        return CompressedBitmap(value)
+    
+    def _replay_op(self, op: str, payload: Dict[str, Any]):
+        """Применение операции из журнала"""
+        if op == 'enable':
+            self._set_user_enabled(payload['user_id'], True, payload.get('manager_id'))
+        elif op == 'disable':
+            self._set_user_enabled(payload['user_id'], False, payload.get('manager_id'))
+        elif op == 'bulk':
+            for user_id in payload['user_ids']:
+                self._set_user_enabled(user_id, payload['enabled'], payload.get('manager_id'))
+        elif op == 'range':
+            self._set_range_enabled(payload['start'], payload['stop'], payload['enabled'])
+        elif op == 'setting' and payload['name'] in self.settings:
+            self._apply_setting(payload['name'], payload['value'])
+        else:
+            logger.warning(f"⚠️ Неизвестная операция в журнале контроллера: {op}")
+    
+    def _restore_state(self):
+        """Восстановление из снимка и хвоста журнала"""
+        started = time.perf_counter()
+        try:
+            state, ops = self.state_store.load()
+            if state:
+                self.load_state(state)
+            for op, payload in ops:
+                self._replay_op(op, payload)
+            
+            logger.info(f"♻️ Состояние контроллера восстановлено за {(time.perf_counter() - started) * 1000:.1f} мс: "
+                        f"{len(self.user_sessions)} сессий, {len(ops)} операций из журнала")
+        
+        except Exception as e:
+            logger.error(f"❌ Ошибка восстановления состояния контроллера: {e}")
+    
+    def snapshot_state(self):
+        """Постановка снимка состояния в очередь записи"""
+        if self.state_store is not None:
+            self.state_store.snapshot(self.export_state())
+    
+    async def run_snapshots(self, interval_seconds: int):
+        """Периодические снимки состояния в фоне"""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                self.snapshot_state()
+            except Exception as e:
+                logger.error(f"❌ Ошибка снимка состояния контроллера: {e}")
+    
+    def close(self):
+        """Остановка таймеров, финальный снимок и остановка записи состояния"""
+        self.typing_timers.cancel_all()
+        if self.state_store is not None:
+            self.snapshot_state()
+            self.state_store.close()
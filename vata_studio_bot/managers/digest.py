@@ -0,0 +1,79 @@
+﻿# managers/digest.py - сводка некритичных событий для менеджеров
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ManagerDigest:
+    """
+    Накопитель некритичных событий для периодической сводки
+
+    События (долгий набор текста, закрытые вызовы) не отправляются по
+    одному, а копятся по менеджерам; раз в интервал каждому менеджеру
+    уходит одно сообщение со всеми событиями. У каждого вида событий
+    хранится счетчик и последние max_lines строк, поэтому размер сводки
+    ограничен при любом потоке событий.
+    """
+
+    # Заголовки разделов в порядке вывода
+    SECTIONS = {
+        'typing_timeout': '⏰ Долгий набор текста',
+        'handled': '✅ Закрытые вызовы'
+    }
+
+    def __init__(self, max_lines: int = 10):
+        self.max_lines = max_lines
+        self._events: Dict[int, Dict[str, Tuple[int, Deque[str]]]] = {}
+
+        # Статистика
+        self.stats = {
+            'events': 0,
+            'digests': 0
+        }
+
+    def add(self, manager_id: int, kind: str, line: str, at: Optional[datetime] = None):
+        """Добавление события в сводку менеджера"""
+        sections = self._events.setdefault(manager_id, {})
+        count, lines = sections.get(kind, (0, deque(maxlen=self.max_lines)))
+        lines.append(f"{(at or datetime.now()).strftime('%H:%M')} {line}")
+        sections[kind] = (count + 1, lines)
+        self.stats['events'] += 1
+
+    def pending_managers(self) -> List[int]:
+        return list(self._events)
+
+    def render(self, manager_id: int, footer: str = "") -> Optional[str]:
+        """Текст сводки менеджера (None, если событий нет)"""
+        sections = self._events.get(manager_id)
+        if not sections:
+            return None
+
+        parts = ["📋 <b>Сводка событий</b>"]
+        for kind in list(self.SECTIONS) + [k for k in sections if k not in self.SECTIONS]:
+            if kind not in sections:
+                continue
+            count, lines = sections[kind]
+            parts.append(f"\n<b>{self.SECTIONS.get(kind, kind)}: {count}</b>")
+            parts.extend(f"• {line}" for line in lines)
+            if count > len(lines):
+                parts.append(f"• ... и еще {count - len(lines)}")
+
+        if footer:
+            parts.append(f"\n{footer}")
+        return "\n".join(parts)
+
+    def drain(self, footer: str = "") -> List[Tuple[int, str]]:
+        """Готовые сводки всех менеджеров; накопленные события сбрасываются"""
+        digests = []
+        for manager_id in list(self._events):
+            text = self.render(manager_id, footer)
+            if text:
+                digests.append((manager_id, text))
+        self._events.clear()
+        self.stats['digests'] += len(digests)
+        return digests
+
+    def __len__(self) -> int:
+        return sum(count for sections in self._events.values() for count, _ in sections.values())
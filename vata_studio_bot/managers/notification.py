@@ -1,29 +1,204 @@
 ﻿import logging
 from typing import List, Dict, Any
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
+import html
+import time
+
+from utils.deadline_timers import DeadlineTimers
+from utils.helpers import format_duration
+from utils.latency import LatencyStats
+from utils.outbound import PRIORITY_MANAGER, PRIORITY_DIGEST
+from .digest import ManagerDigest
+from .notification_store import NotificationStore
+from .outbox import NotificationOutbox
+from .routing import ManagerRouter
 
 logger = logging.getLogger(__name__)
 
 class ManagerNotifier:
     """Система уведомления менеджеров"""
     
-    def __init__(self, bot=None, manager_ids: List[int] = None):
+    def __init__(self, bot=None, manager_ids: List[int] = None, sender=None,
+                 max_concurrent_sends: int = 10, send_timeout_seconds: float = 10,
+                 store_path: str = None, debounce_seconds: float = 120,
+                 routing: str = 'least_loaded', sla_seconds: float = 300, affinity=None,
+                 digest_interval_seconds: float = 600):
         self.bot = bot
+        self.sender = sender  # OutboundScheduler; без него сообщения уходят напрямую
         self.manager_ids = manager_ids or []
-        self.pending_notifications = []
+        self.pending_notifications = NotificationStore(store_path)  # Ожидающие вызовы (store_path - в SQLite)
         self.enabled = True
         
+        # Уведомления сначала пишутся в outbox, доставляет их фоновый обработчик (run_outbox)
+        # с повторами; менеджерам уходит параллельно не больше max_concurrent_sends сообщений
+        self.outbox = NotificationOutbox(store_path, max_concurrent=max_concurrent_sends)
+        self.send_timeout_seconds = send_timeout_seconds
+        self._send_semaphore = asyncio.Semaphore(max_concurrent_sends)
+        
+        # Повторные вызовы от пользователя в пределах debounce_seconds после предыдущего
+        # не рассылаются заново, а дописываются в уже отправленное уведомление
+        self.debounce_seconds = debounce_seconds
+        self._active_calls: Dict[int, Dict[str, Any]] = {}
+        
+        # Вызов получает один менеджер (см. ManagerRouter); если за sla_seconds его
+        # не обработали, вызов дополнительно уходит следующему менеджеру
+        self.router = ManagerRouter(self.manager_ids, routing, affinity)
+        self.router.reset_loads({manager_id: self.pending_notifications.pending_count_for_manager(manager_id)
+                                 for manager_id in self.manager_ids})
+        self.sla_seconds = sla_seconds
+        self.escalation_timers = DeadlineTimers(on_expire=self._escalate)
+        self._open_calls: Dict[int, Dict[str, Any]] = {}  # Необработанный вызов пользователя
+        
+        # Некритичные события (долгий набор, закрытые вызовы) копятся и уходят
+        # одной сводкой раз в digest_interval_seconds (0 - отправлять сразу)
+        self.digest_interval_seconds = digest_interval_seconds
+        self.digest = ManagerDigest()
+        
+        # Время ответа менеджеров: ряд 'all' и ряд на каждого менеджера, окно - последний час
+        self.response_times = LatencyStats(window_seconds=3600)
+        
         # Статистика
         self.stats = {
             'total_calls': 0,
             'handled_calls': 0,
-            'avg_response_time': 0,
-            'last_notification': None
+            'last_notification': None,
+            'failed_deliveries': 0,
+            'coalesced_calls': 0,
+            'escalations': 0
         }
         
         logger.info(f"📞 Система уведомлений инициализирована. Менеджеров: {len(self.manager_ids)}")
     
+    async def _send(self, chat_id: int, text: str, priority: int, **kwargs):
+        """Отправка сообщения через очередь исходящих (если подключена)"""
+        if self.sender is not None:
+            return await self.sender.send_message(chat_id, text, priority=priority, **kwargs)
+        return await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    
+    async def _edit(self, chat_id: int, message_id: int, text: str, priority: int, **kwargs):
+        """Редактирование отправленного сообщения через очередь исходящих"""
+        edit = lambda: self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+        if self.sender is not None:
+            return await self.sender.submit(chat_id, edit, priority)
+        return await edit()
+    
+    async def _edit_for_manager(self, manager_id: int, message_id: int, text: str, **kwargs):
+        """Редактирование уведомления у одного менеджера"""
+        async with self._send_semaphore:
+            return await asyncio.wait_for(self._edit(manager_id, message_id, text, PRIORITY_MANAGER, **kwargs),
+                                          timeout=self.send_timeout_seconds)
+    
+    def has_active_call(self, user_id: int) -> bool:
+        """Есть ли у пользователя недавний вызов, к которому добавится новый"""
+        call = self._active_calls.get(user_id)
+        if call is None:
+            return False
+        if datetime.now() - call['last_at'] > timedelta(seconds=self.debounce_seconds):
+            del self._active_calls[user_id]
+            return False
+        return True
+    
+    @staticmethod
+    def _render_call_alert(call: Dict[str, Any]) -> str:
+        """Текст уведомления о вызове (со всеми вопросами серии, parse_mode="HTML")"""
+        questions = [html.escape(question) for question in call['questions']]
+        if len(questions) == 1:
+            question_text = f"❓ Вопрос: {questions[0]}"
+        else:
+            # Показываем последние 10, чтобы не упереться в лимит длины сообщения
+            shown = questions[-10:]
+            question_text = f"❓ Вопросы ({len(questions)}):\n" + "\n".join(
+                f"{len(questions) - len(shown) + i}. {q}" for i, q in enumerate(shown, 1))
+        
+        escalation_text = ""
+        if call['escalations']:
+            escalation_text = f"\n⏫ Передан дальше: нет ответа за {call['sla_minutes']} мин\n"
+        
+        return f"""
+🚨 ВНИМАНИЕ: Вызов менеджера!
+{escalation_text}
+{call['user_info']}
+{question_text}
+{call['context_text']}
+
+⚠️ Требуется вмешательство менеджера!
+        """
+    
+    async def _append_to_call(self, call: Dict[str, Any], question: str) -> bool:
+        """Добавление вопроса к уже поставленному уведомлению"""
+        call['questions'].append(question)
+        call['last_at'] = datetime.now()
+        self.stats['coalesced_calls'] += 1
+        
+        # Еще не отправленные уведомления уйдут уже с новым текстом,
+        # отправленные редактируем; те, что отправляются сейчас, поправит _on_outbox_delivered
+        text = self._render_call_alert(call)
+        self.outbox.update_pending_text(call['call_key'], text)
+        
+        if call['message_ids']:
+            results = await asyncio.gather(*[
+                self._edit_for_manager(manager_id, message_id, text, parse_mode="HTML")
+                for manager_id, message_id in list(call['message_ids'].items())
+            ], return_exceptions=True)
+            
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures:
+                logger.warning(f"⚠️ Не удалось обновить {len(failures)} уведомлений о вызове user_id={call['user_id']}")
+        
+        logger.info(f"🔁 Повторный вызов user_id={call['user_id']} добавлен к уведомлению "
+                    f"({len(call['questions'])} вопросов)")
+        return True
+    
+    # ================== OUTBOX ==================
+    
+    async def run_outbox(self):
+        """Фоновая доставка уведомлений из outbox"""
+        await self.outbox.run(self._deliver_outbox_entry, self._on_outbox_delivered)
+    
+    async def _deliver_outbox_entry(self, entry: Dict[str, Any]):
+        """Одна попытка отправки записи outbox (ошибка - повтор по расписанию outbox)"""
+        try:
+            return await asyncio.wait_for(
+                self._send(entry['chat_id'], entry['text'], entry['priority'], parse_mode=entry['parse_mode']),
+                timeout=self.send_timeout_seconds
+            )
+        except Exception:
+            self.stats['failed_deliveries'] += 1
+            raise
+    
+    async def _on_outbox_delivered(self, entry: Dict[str, Any], result):
+        """Учет доставленного уведомления"""
+        if entry['kind'] == 'typing_timeout':
+            logger.info(f"⏰ Уведомление о таймауте отправлено менеджеру {entry['chat_id']}")
+            return
+        if entry['kind'] != 'manager_call':
+            return
+        
+        manager_id = entry['chat_id']
+        user_id = entry['payload']['user_id']
+        logger.info(f"✅ Уведомление отправлено менеджеру {manager_id}")
+        
+        # Добавляем в pending для отслеживания
+        try:
+            self.pending_notifications.add(user_id, manager_id, entry['payload']['question'])
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения уведомления: {e}")
+        
+        # Вызов мог пополниться, пока сообщение отправлялось
+        call = self._open_calls.get(user_id) or self._active_calls.get(user_id)
+        message_id = getattr(result, 'message_id', None)
+        if call is None or call['call_key'] != entry['call_key'] or message_id is None:
+            return
+        call['message_ids'][manager_id] = message_id
+        
+        text = self._render_call_alert(call)
+        if text != entry['text']:
+            try:
+                await self._edit_for_manager(manager_id, message_id, text, parse_mode="HTML")
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось обновить уведомление менеджеру {manager_id}: {e}")
+    
     async def notify_manager(self, user_id: int, username: str, 
                            first_name: str, last_name: str, 
                            question: str, context: List[Dict] = None):
@@ -32,73 +207,121 @@ class ManagerNotifier:
             logger.info(f"📞 Вызов менеджера (система отключена): user_id={user_id}, вопрос: {question[:50]}...")
             return False
         
+        # Повторный вызов в окне - дописываем в отправленное уведомление
+        if self.debounce_seconds > 0 and self.has_active_call(user_id):
+            return await self._append_to_call(self._active_calls[user_id], question)
+        
         self.stats['total_calls'] += 1
         self.stats['last_notification'] = datetime.now()
         
-        # Формируем сообщение для менеджера
-        user_info = f"👤 Пользователь: {first_name} {last_name}"
+        # Формируем сообщение для менеджера (уходит с parse_mode="HTML" - данные пользователя экранируем)
+        user_info = f"👤 Пользователь: {html.escape(f'{first_name} {last_name}')}"
         if username:
-            user_info += f" (@{username})"
+            user_info += f" (@{html.escape(username)})"
         user_info += f" (ID: {user_id})"
         
-        question_text = f"❓ Вопрос: {question}"
-        
         # Добавляем контекст если есть
         context_text = ""
         if context:
             context_text = "\n\n📜 Контекст диалога:\n"
             for msg in context[-3:]:  # Последние 3 сообщения
                 sender = "Бот" if msg.get('is_bot') else "Пользователь"
-                text = msg.get('text', '')[:100]
+                text = html.escape(msg.get('text', '')[:100])
                 context_text += f"{sender}: {text}\n"
         
         # Формируем полное сообщение
-        message = f"""
-🚨 ВНИМАНИЕ: Вызов менеджера!
-
-{user_info}
-{question_text}
-{context_text}
-
-⚠️ Требуется вмешательство менеджера!
-        """
+        call = {
+            'user_id': user_id,
+            'call_key': f"{user_id}:{time.time_ns()}",
+            'user_info': user_info,
+            'context_text': context_text,
+            'questions': [question],
+            'created_at': datetime.now(),
+            'last_at': datetime.now(),
+            'message_ids': {},
+            'managers': [],
+            'escalations': 0,
+            'sla_minutes': round(self.sla_seconds / 60)
+        }
+        message = self._render_call_alert(call)
+        if self.debounce_seconds > 0:
+            self._active_calls[user_id] = call
         
-        # Отправляем всем менеджерам
-        success = False
-        for manager_id in self.manager_ids:
-            try:
-                await self.bot.send_message(
-                    chat_id=manager_id,
-                    text=message,
-                    parse_mode="HTML"
-                )
-                logger.info(f"✅ Уведомление отправлено менеджеру {manager_id}")
-                success = True
-                
-                # Добавляем в pending для отслеживания
-                self.pending_notifications.append({
-                    'user_id': user_id,
-                    'manager_id': manager_id,
-                    'question': question,
-                    'timestamp': datetime.now(),
-                    'handled': False
-                })
-                
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки уведомления менеджеру {manager_id}: {e}")
+        # Прошлый вызов еще не обработан - остаемся у тех же менеджеров
+        previous = self._open_calls.get(user_id)
+        if previous is not None:
+            call['managers'] = list(previous['managers'])
+        else:
+            manager_id = self.router.pick(user_id)
+            self.router.assign(user_id, manager_id)
+            call['managers'] = [manager_id]
+        self._open_calls[user_id] = call
         
-        if success:
-            # Отправляем пользователю подтверждение
-            try:
-                await self.bot.send_message(
-                    chat_id=user_id,
-                    text="✅ <b>Менеджер уведомлен!</b>\n\nС вами свяжутся в ближайшее время. А пока могу помочь с другими вопросами?",
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки подтверждения пользователю: {e}")
+        # Записываем уведомления в outbox - доставит фоновый обработчик, обработчик пользователя не ждет
+        try:
+            for manager_id in call['managers']:
+                self._enqueue_call_alert(call, manager_id, message)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи уведомления в outbox: {e}")
+            self._release_call(user_id)
+            return False
+        
+        if self.sla_seconds > 0:
+            self.escalation_timers.schedule(user_id, self.sla_seconds, call['call_key'])
+        
+        logger.info(f"📞 Вызов user_id={user_id} назначен менеджеру {', '.join(map(str, call['managers']))}")
+        return True
+    
+    def _enqueue_call_alert(self, call: Dict[str, Any], manager_id: int, text: str):
+        """Запись уведомления о вызове одному менеджеру в outbox"""
+        self.outbox.enqueue(
+            manager_id,
+            text,
+            f"call:{call['call_key']}:{manager_id}",
+            kind='manager_call',
+            priority=PRIORITY_MANAGER,
+            call_key=call['call_key'],
+            payload={'user_id': call['user_id'], 'question': call['questions'][-1]}
+        )
+    
+    async def _escalate(self, user_id: int, call_key: str):
+        """Вызов не обработан за sla_seconds - передаем следующему менеджеру"""
+        call = self._open_calls.get(user_id)
+        if call is None or call['call_key'] != call_key:
+            return
+        
+        manager_id = self.router.pick(user_id, exclude=call['managers'])
+        if manager_id is None:
+            logger.warning(f"⚠️ Вызов user_id={user_id} не обработан, уведомлены уже все менеджеры")
+            return
+        
+        self.router.add_load(manager_id)
+        call['managers'].append(manager_id)
+        call['escalations'] += 1
+        self.stats['escalations'] += 1
+        
+        text = self._render_call_alert(call)
+        self.outbox.update_pending_text(call_key, text)
+        self._enqueue_call_alert(call, manager_id, text)
+        logger.info(f"⏫ Вызов user_id={user_id} передан менеджеру {manager_id} (нет ответа {self.sla_seconds} сек)")
         
-        return success
+        self.escalation_timers.schedule(user_id, self.sla_seconds, call_key)
+    
+    def _release_call(self, user_id: int, handled_by: int = None):
+        """Закрытие вызова: снимаем нагрузку с менеджеров и таймер эскалации"""
+        # Закрытый вызов больше не принимает повторы: следующий вызов пользователя - новый
+        self._active_calls.pop(user_id, None)
+        call = self._open_calls.pop(user_id, None)
+        if call is None:
+            return None
+        
+        self.escalation_timers.cancel(user_id)
+        self.outbox.cancel_pending(call['call_key'])
+        for manager_id in call['managers']:
+            self.router.add_load(manager_id, -1)
+        if handled_by is not None:
+            self.router.remember(user_id, handled_by)
+        return call
     
     async def notify_typing_timeout(self, user_id: int, username: str, 
                                   first_name: str, last_name: str):
@@ -106,81 +329,178 @@ class ManagerNotifier:
         if not self.enabled or not self.bot or not self.manager_ids:
             return
         
+        # Одному менеджеру - тому же, кого выбрали бы для вызова
+        manager_id = self.router.pick(user_id)
+        
+        # Сводка и уведомление уходят с parse_mode="HTML": одно имя с "<" или "&"
+        # не должно ломать всю сводку с событиями других пользователей
+        name = html.escape(f"{first_name} {last_name}")
+        username = html.escape(f"{username}")
+        
+        if self.digest_interval_seconds > 0:
+            self.digest.add(manager_id, 'typing_timeout', f"{name} (@{username}, ID: {user_id})")
+            return
+        
         message = f"""
 ⏰ ВНИМАНИЕ: Долгий набор текста
 
-👤 Пользователь: {first_name} {last_name} (@{username})
+👤 Пользователь: {name} (@{username})
 🆔 ID: {user_id}
 
 Пользователь долго набирает сообщение. Возможно, нужна помощь или есть сложный вопрос.
         """
         
-        for manager_id in self.manager_ids[:1]:  # Только первому менеджеру
-            try:
-                await self.bot.send_message(
-                    chat_id=manager_id,
-                    text=message,
-                    parse_mode="HTML"
-                )
-                logger.info(f"⏰ Уведомление о таймауте отправлено менеджеру {manager_id}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки уведомления о таймауте: {e}")
+        try:
+            self.outbox.enqueue(manager_id, message, f"typing:{user_id}:{int(time.time())}",
+                                kind='typing_timeout', priority=PRIORITY_MANAGER)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи уведомления о таймауте: {e}")
     
     def mark_notification_handled(self, user_id: int, manager_id: int = None):
-        """Отметить уведомление как обработанное"""
-        for notification in self.pending_notifications:
-            if notification['user_id'] == user_id and not notification['handled']:
-                if manager_id is None or notification['manager_id'] == manager_id:
-                    notification['handled'] = True
-                    notification['handled_at'] = datetime.now()
-                    
-                    # Обновляем статистику
-                    self.stats['handled_calls'] += 1
-                    
-                    response_time = (notification['handled_at'] - notification['timestamp']).seconds
-                    # Обновляем среднее время ответа
-                    if self.stats['avg_response_time'] == 0:
-                        self.stats['avg_response_time'] = response_time
-                    else:
-                        self.stats['avg_response_time'] = (self.stats['avg_response_time'] + response_time) / 2
-                    
-                    logger.info(f"✅ Уведомление отмечено как обработанное. Время ответа: {response_time} сек")
-                    return True
-        
-        return False
+        """Отметить вызов пользователя как обработанный (manager_id - кто обработал)"""
+        handled_at = datetime.now()
+        call = self._release_call(user_id, manager_id)
+        
+        # Вызов закрывается целиком - снимаем уведомления всех менеджеров, которым он ушел
+        notifications = []
+        notification = self.pending_notifications.mark_handled(user_id, handled_at=handled_at)
+        while notification is not None:
+            notifications.append(notification)
+            notification = self.pending_notifications.mark_handled(user_id, handled_at=handled_at)
+        
+        if call is None:
+            if not notifications:
+                return False
+            # Вызов до перезапуска: нагрузка была восстановлена по уведомлениям
+            for n in notifications:
+                self.router.add_load(n.manager_id, -1)
+        
+        # Обновляем статистику
+        self.stats['handled_calls'] += 1
+        
+        started_at = min(n.timestamp for n in notifications) if notifications else call['created_at']
+        response_time = (handled_at - started_at).total_seconds()
+        self.response_times.record('all', response_time)
+        if manager_id is not None:
+            self.response_times.record(manager_id, response_time)
+        
+        # Остальным менеджерам, получившим вызов, - строка в сводке
+        recipients = set(call['managers']) if call is not None else set()
+        recipients.update(n.manager_id for n in notifications)
+        recipients.discard(manager_id)
+        handled_by = f"менеджер {manager_id}" if manager_id is not None else "закрыт"
+        for recipient in recipients:
+            self.digest.add(recipient, 'handled',
+                            f"Пользователь {user_id}: {handled_by} за {format_duration(round(response_time))}")
+        
+        logger.info(f"✅ Уведомление отмечено как обработанное. Время ответа: {response_time:.0f} сек")
+        return True
     
     def get_notification_stats(self) -> Dict[str, Any]:
         """Получение статистики уведомлений"""
-        pending = len([n for n in self.pending_notifications if not n['handled']])
-        
+        outbox = self.outbox.get_stats()
+        response = self.response_times.summary('all')
         return {
             'total_calls': self.stats['total_calls'],
             'handled_calls': self.stats['handled_calls'],
-            'pending_calls': pending,
-            'avg_response_time': self.stats['avg_response_time'],
-            'last_notification': self.stats['last_notification']
+            'pending_calls': self.pending_notifications.pending_count(),
+            'avg_response_time': response['mean'],
+            'response_time': response,
+            'response_time_by_manager': {manager_id: self.response_times.summary(manager_id)
+                                         for manager_id in self.response_times.names() if manager_id != 'all'},
+            'last_notification': self.stats['last_notification'],
+            'undelivered': outbox['pending'],
+            'failed_deliveries': outbox['failed'],
+            'avg_delivery_lag': outbox['avg_lag_seconds'],
+            'max_delivery_lag': outbox['max_lag_seconds'],
+            'p99_delivery_lag': outbox['lag_p99_seconds'],
+            'oldest_undelivered': outbox['oldest_pending_seconds'],
+            'open_calls': len(self._open_calls),
+            'escalations': self.stats['escalations'],
+            'digest_events': len(self.digest),
+            'manager_loads': dict(self.router.loads)
         }
     
     def cleanup_old_notifications(self, hours: int = 24):
         """Очистка старых уведомлений"""
-        now = datetime.now()
-        old_count = 0
+        cutoff = datetime.now() - timedelta(hours=hours)
+        old_count = self.pending_notifications.expire_older_than(cutoff)
+        
+        # Завершенные записи outbox (доставленные, отмененные, неотправленные)
+        pruned = self.outbox.prune(hours * 3600)
+        if pruned:
+            logger.info(f"🧹 Из outbox удалено {pruned} завершенных записей")
+        
+        # Завершенные серии вызовов
+        for user_id in [uid for uid in self._active_calls if not self.has_active_call(uid)]:
+            self._active_calls.pop(user_id, None)
         
-        self.pending_notifications = [
-            n for n in self.pending_notifications
-            if (now - n['timestamp']).total_seconds() < hours * 3600
-        ]
+        # Забытые вызовы больше не считаем нагрузкой
+        for user_id in [uid for uid, call in self._open_calls.items() if call['created_at'] < cutoff]:
+            self._release_call(user_id)
         
-        old_count = len(self.pending_notifications) - len(self.pending_notifications)
+        # Пересчет нагрузки: открытые вызовы и уведомления, пережившие перезапуск
+        loads: Dict[int, int] = {}
+        for call in self._open_calls.values():
+            for manager_id in call['managers']:
+                loads[manager_id] = loads.get(manager_id, 0) + 1
+        for notification in self.pending_notifications:
+            if notification.user_id not in self._open_calls:
+                loads[notification.manager_id] = loads.get(notification.manager_id, 0) + 1
+        self.router.reset_loads(loads)
         if old_count > 0:
             logger.info(f"🧹 Очищено {old_count} старых уведомлений")
     
+    async def run_periodic_cleanup(self, hours: int = 24, interval_seconds: int = 3600):
+        """Периодическая очистка старых уведомлений в фоне"""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                self.cleanup_old_notifications(hours)
+            except Exception as e:
+                logger.error(f"❌ Ошибка очистки уведомлений: {e}")
+    
+    def flush_digest(self) -> int:
+        """Постановка накопленных сводок в outbox"""
+        if not len(self.digest):
+            return 0
+        
+        stats = self.get_notification_stats()
+        footer = (f"📊 Вызовов: {stats['total_calls']}, обработано: {stats['handled_calls']}, "
+                  f"ожидают: {stats['pending_calls']}, медиана ответа: "
+                  f"{format_duration(round(stats['response_time']['p50']))}")
+        
+        digests = self.digest.drain(footer)
+        epoch = int(time.time())
+        for manager_id, text in digests:
+            try:
+                self.outbox.enqueue(manager_id, text, f"digest:{manager_id}:{epoch}",
+                                    kind='digest', priority=PRIORITY_DIGEST)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи сводки для менеджера {manager_id}: {e}")
+        
+        logger.info(f"📋 Сводки поставлены в очередь для {len(digests)} менеджеров")
+        return len(digests)
+    
+    async def run_digest(self):
+        """Периодическая отправка сводок в фоне"""
+        if self.digest_interval_seconds <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.digest_interval_seconds)
+            try:
+                self.flush_digest()
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки сводок: {e}")
+    
     async def send_manager_stats(self, manager_id: int):
         """Отправка статистики менеджеру"""
         if not self.bot:
             return
         
         stats = self.get_notification_stats()
+        response = stats['response_time']
+        own = stats['response_time_by_manager'].get(manager_id)
         
         message = f"""
 📊 <b>Статистика уведомлений</b>
@@ -188,25 +508,39 @@ class ManagerNotifier:
 • Всего вызовов: {stats['total_calls']}
 • Обработано: {stats['handled_calls']}
 • Ожидают: {stats['pending_calls']}
-• Среднее время ответа: {stats['avg_response_time']:.1f} сек
+• Время ответа: медиана {format_duration(round(response['p50']))}, 90% - {format_duration(round(response['p90']))}, \
+99% - {format_duration(round(response['p99']))} (среднее {format_duration(round(response['mean']))})
+• За последний час: медиана {format_duration(round(response['window']['p50']))} ({response['window']['count']} вызовов)
+• Ваша медиана: {format_duration(round(own['p50'])) if own else 'нет данных'}
 • Последний вызов: {stats['last_notification'].strftime('%H:%M') if stats['last_notification'] else 'нет'}
+• Не доставлено: {stats['undelivered']} (ошибок: {stats['failed_deliveries']})
+• Задержка доставки: {stats['avg_delivery_lag']:.1f} сек (99% - {stats['p99_delivery_lag']:.1f} сек)
+• Передано по таймауту: {stats['escalations']}
+• Ваши открытые вызовы: {stats['manager_loads'].get(manager_id, 0)}
 
 <b>Текущие ожидающие:</b>
         """
         
-        pending = [n for n in self.pending_notifications if not n['handled']]
+        pending = self.pending_notifications.oldest(5)
         if pending:
-            for i, n in enumerate(pending[:5], 1):
-                time_ago = (datetime.now() - n['timestamp']).seconds // 60
-                message += f"\n{i}. Пользователь {n['user_id']} - {time_ago} мин назад"
+            for i, n in enumerate(pending, 1):
+                time_ago = int((datetime.now() - n.timestamp).total_seconds() // 60)
+                message += f"\n{i}. Пользователь {n.user_id} - {time_ago} мин назад"
         else:
             message += "\n✅ Нет ожидающих вызовов"
         
         try:
-            await self.bot.send_message(
-                chat_id=manager_id,
-                text=message,
-                parse_mode="HTML"
-            )
+            await self._send(manager_id, message, PRIORITY_DIGEST, parse_mode="HTML")
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки статистики: {e}")
+    
+    async def close(self):
+        """Закрытие outbox (недоставленные уведомления остаются в базе)"""
+        self.escalation_timers.cancel_all()
+        
+        # Неотправленная сводка уйдет после перезапуска
+        try:
+            self.flush_digest()
         except Exception as e:
-            logger.error(f"❌ Ошибка отправки статистики: {e}")
\ No newline at end of file
+            logger.error(f"❌ Ошибка сохранения сводок: {e}")
+        await self.outbox.close()
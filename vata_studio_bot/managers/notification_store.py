@@ -0,0 +1,229 @@
+﻿# managers/notification_store.py - ожидающие вызовы менеджеров
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Iterator
+
+logger = logging.getLogger(__name__)
+
+class PendingNotification:
+    """Необработанное уведомление менеджеру"""
+
+    __slots__ = ('notification_id', 'user_id', 'manager_id', 'question', 'timestamp')
+
+    def __init__(self, notification_id: int, user_id: int, manager_id: int,
+                 question: str, timestamp: datetime):
+        self.notification_id = notification_id
+        self.user_id = user_id
+        self.manager_id = manager_id
+        self.question = question
+        self.timestamp = timestamp
+
+class NotificationStore:
+    """
+    Хранилище ожидающих уведомлений
+
+    Уведомления проиндексированы по id, user_id и manager_id, поэтому
+    отметка об обработке и выборки по пользователю или менеджеру не
+    просматривают весь список, а число ожидающих известно сразу.
+    Устаревание идет по min-куче времени создания: обработанные записи
+    остаются в куче и пропускаются при извлечении.
+
+    Если задан db_path, уведомления дублируются в SQLite и переживают
+    перезапуск; обработанные остаются в таблице с handled = 1.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path
+
+        self._by_id: Dict[int, PendingNotification] = {}
+        self._by_user: Dict[int, Dict[int, PendingNotification]] = {}
+        self._by_manager: Dict[int, Dict[int, PendingNotification]] = {}
+        self._heap: List[tuple] = []
+        self._ids = itertools.count(1)
+
+        if db_path:
+            self._init_database()
+            self._load()
+
+    # ================== SQLITE ==================
+
+    def _init_database(self):
+        """Создание таблицы уведомлений"""
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS manager_notifications (
+                    notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    manager_id INTEGER NOT NULL,
+                    question TEXT,
+                    timestamp TEXT NOT NULL,
+                    handled INTEGER NOT NULL DEFAULT 0,
+                    handled_at TEXT
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_manager_notifications_pending
+                ON manager_notifications(timestamp) WHERE handled = 0
+            ''')
+            conn.commit()
+
+    def _load(self):
+        """Загрузка ожидающих уведомлений после перезапуска"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT notification_id, user_id, manager_id, question, timestamp
+                FROM manager_notifications
+                WHERE handled = 0
+                ORDER BY timestamp
+            ''')
+            for notification_id, user_id, manager_id, question, timestamp in cursor.fetchall():
+                self._index(PendingNotification(notification_id, user_id, manager_id, question,
+                                                datetime.fromisoformat(timestamp)))
+
+        if self._by_id:
+            logger.info(f"📞 Загружено {len(self._by_id)} ожидающих уведомлений")
+
+    # ================== ИНДЕКСЫ ==================
+
+    def _index(self, notification: PendingNotification):
+        self._by_id[notification.notification_id] = notification
+        self._by_user.setdefault(notification.user_id, {})[notification.notification_id] = notification
+        self._by_manager.setdefault(notification.manager_id, {})[notification.notification_id] = notification
+        heapq.heappush(self._heap, (notification.timestamp, notification.notification_id))
+
+    def _unindex(self, notification: PendingNotification):
+        del self._by_id[notification.notification_id]
+        for index, key in ((self._by_user, notification.user_id), (self._by_manager, notification.manager_id)):
+            bucket = index[key]
+            del bucket[notification.notification_id]
+            if not bucket:
+                del index[key]
+
+        # В куче остаются устаревшие записи; перестраиваем, когда их становится больше живых
+        if len(self._heap) > 2 * len(self._by_id) + 64:
+            self._heap = [(n.timestamp, n.notification_id) for n in self._by_id.values()]
+            heapq.heapify(self._heap)
+
+    # ================== ОПЕРАЦИИ ==================
+
+    def add(self, user_id: int, manager_id: int, question: str,
+            timestamp: Optional[datetime] = None) -> PendingNotification:
+        """Добавление ожидающего уведомления"""
+        timestamp = timestamp or datetime.now()
+
+        if self.db_path:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO manager_notifications (user_id, manager_id, question, timestamp)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, manager_id, question, timestamp.isoformat(' ')))
+                notification_id = cursor.lastrowid
+                conn.commit()
+        else:
+            notification_id = next(self._ids)
+
+        notification = PendingNotification(notification_id, user_id, manager_id, question, timestamp)
+        self._index(notification)
+        return notification
+
+    def mark_handled(self, user_id: int, manager_id: Optional[int] = None,
+                     handled_at: Optional[datetime] = None) -> Optional[PendingNotification]:
+        """
+        Отметка самого раннего ожидающего уведомления пользователя
+
+        Returns:
+            Обработанное уведомление или None
+        """
+        candidates = self._by_user.get(user_id)
+        if not candidates:
+            return None
+
+        notification = None
+        for candidate in candidates.values():
+            if manager_id is None or candidate.manager_id == manager_id:
+                notification = candidate
+                break
+        if notification is None:
+            return None
+
+        self._unindex(notification)
+
+        if self.db_path:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute('UPDATE manager_notifications SET handled = 1, handled_at = ? WHERE notification_id = ?',
+                             ((handled_at or datetime.now()).isoformat(' '), notification.notification_id))
+                conn.commit()
+
+        return notification
+
+    def expire_older_than(self, cutoff: datetime) -> int:
+        """
+        Удаление ожидающих уведомлений старше cutoff
+
+        Returns:
+            Количество удаленных
+        """
+        expired = []
+        while self._heap and self._heap[0][0] < cutoff:
+            _, notification_id = heapq.heappop(self._heap)
+            notification = self._by_id.get(notification_id)
+            if notification is not None:
+                self._unindex(notification)
+                expired.append(notification_id)
+
+        if self.db_path:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute('DELETE FROM manager_notifications WHERE timestamp < ?', (cutoff.isoformat(' '),))
+                conn.commit()
+
+        return len(expired)
+
+    # ================== ВЫБОРКИ ==================
+
+    def pending_count(self) -> int:
+        """Число ожидающих уведомлений"""
+        return len(self._by_id)
+
+    def pending_for_user(self, user_id: int) -> List[PendingNotification]:
+        return list(self._by_user.get(user_id, {}).values())
+
+    def pending_for_manager(self, manager_id: int) -> List[PendingNotification]:
+        return list(self._by_manager.get(manager_id, {}).values())
+
+    def pending_count_for_manager(self, manager_id: int) -> int:
+        return len(self._by_manager.get(manager_id, ()))
+
+    def oldest(self, limit: int = 5) -> List[PendingNotification]:
+        """Самые давние ожидающие уведомления"""
+        return [self._by_id[notification_id]
+                for _, notification_id in heapq.nsmallest(limit, self._live_heap_entries())]
+
+    def _live_heap_entries(self) -> Iterator[tuple]:
+        return ((timestamp, notification_id) for timestamp, notification_id in self._heap
+                if notification_id in self._by_id)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[PendingNotification]:
+        return iter(list(self._by_id.values()))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика хранилища"""
+        return {
+            'pending': len(self._by_id),
+            'users': len(self._by_user),
+            'managers': len(self._by_manager),
+            'persistent': bool(self.db_path)
+        }
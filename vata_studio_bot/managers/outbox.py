@@ -0,0 +1,341 @@
+﻿# managers/outbox.py - надежная доставка уведомлений менеджерам
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from utils.latency import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+class NotificationOutbox:
+    """
+    Очередь исходящих уведомлений в SQLite (outbox)
+
+    Уведомление сначала записывается в таблицу, и только потом фоновый
+    обработчик его доставляет. Неудачная отправка повторяется с
+    экспоненциальной задержкой (с учетом retry_after от Telegram) до
+    max_attempts попыток. Ключ идемпотентности не дает поставить одно и то
+    же уведомление дважды, в том числе после перезапуска.
+
+    Доставка "хотя бы один раз": если процесс упадет между отправкой и
+    отметкой в таблице, после перезапуска сообщение уйдет повторно.
+    Без db_path таблица живет в памяти (повторы есть, переживания
+    перезапуска нет).
+
+    Таблица в режиме WAL с synchronous = NORMAL: фиксация пишет в журнал
+    без fsync (fsync - при контрольной точке), поэтому запись на цикле
+    событий не ждет диска. Падение процесса записи не теряет, отключение
+    питания может потерять последние. Отправленные, отмененные и
+    неотправленные записи удаляет prune (см. cleanup_old_notifications).
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_attempts: int = 8,
+                 base_delay_seconds: float = 2.0, max_delay_seconds: float = 600.0,
+                 batch_size: int = 50, max_concurrent: int = 10):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.batch_size = batch_size
+        self.max_concurrent = max_concurrent
+
+        self._waiter: Optional[asyncio.Future] = None
+        self._in_flight = 0
+        self._tasks: Set[asyncio.Task] = set()  # Идущие попытки доставки
+
+        # Статистика
+        self.stats = {
+            'enqueued': 0,
+            'duplicates': 0,
+            'delivered': 0,
+            'retries': 0,
+            'failed': 0,
+            'total_lag_seconds': 0.0,
+            'max_lag_seconds': 0.0
+        }
+        self.lag = LatencyHistogram()  # Задержка от записи до доставки
+
+        self._conn = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие базы и создание таблицы"""
+        if self.db_path:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+        conn = sqlite3.connect(self.db_path or ':memory:')
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        if self.db_path:
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute('PRAGMA synchronous = NORMAL')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                kind TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                priority INTEGER NOT NULL DEFAULT 1,
+                call_key TEXT,
+                payload TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                sent_at REAL,
+                message_id INTEGER,
+                last_error TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notification_outbox_due
+            ON notification_outbox(next_attempt_at) WHERE status = 'pending'
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notification_outbox_call
+            ON notification_outbox(call_key) WHERE call_key IS NOT NULL
+        ''')
+
+        # Отправки, прерванные падением процесса, повторяем
+        recovered = cursor.execute(
+            "UPDATE notification_outbox SET status = 'pending' WHERE status = 'sending'").rowcount
+        conn.commit()
+
+        if recovered:
+            logger.warning(f"⚠️ В outbox возвращено {recovered} прерванных отправок")
+
+        return conn
+
+    # ================== ПОСТАНОВКА ==================
+
+    def enqueue(self, chat_id: int, text: str, idempotency_key: str, kind: str = 'alert',
+                priority: int = 1, parse_mode: Optional[str] = "HTML", call_key: Optional[str] = None,
+                payload: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        """
+        Запись уведомления в outbox
+
+        Returns:
+            id записи или None, если уведомление с таким ключом уже есть
+        """
+        now = time.time()
+        cursor = self._conn.execute('''
+            INSERT OR IGNORE INTO notification_outbox
+                (idempotency_key, kind, chat_id, text, parse_mode, priority, call_key, payload,
+                 created_at, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (idempotency_key, kind, chat_id, text, parse_mode, priority, call_key,
+              json.dumps(payload, ensure_ascii=False) if payload is not None else None, now, now))
+        self._conn.commit()
+
+        if not cursor.rowcount:
+            self.stats['duplicates'] += 1
+            return None
+
+        self.stats['enqueued'] += 1
+        self._wake()
+        return cursor.lastrowid
+
+    def update_pending_text(self, call_key: str, text: str) -> int:
+        """Замена текста еще не отправленных уведомлений вызова"""
+        cursor = self._conn.execute('''
+            UPDATE notification_outbox SET text = ?
+            WHERE call_key = ? AND status = 'pending'
+        ''', (text, call_key))
+        self._conn.commit()
+        return cursor.rowcount
+
+    def cancel_pending(self, call_key: str) -> int:
+        """Отмена еще не отправленных уведомлений вызова (вызов уже обработан)"""
+        cursor = self._conn.execute('''
+            UPDATE notification_outbox SET status = 'cancelled'
+            WHERE call_key = ? AND status = 'pending'
+        ''', (call_key,))
+        self._conn.commit()
+        return cursor.rowcount
+
+    def prune(self, older_than_seconds: float) -> int:
+        """
+        Удаление завершенных записей (sent, cancelled, failed) старше older_than_seconds
+
+        Returns:
+            Количество удаленных записей
+        """
+        cursor = self._conn.execute('''
+            DELETE FROM notification_outbox
+            WHERE status IN ('sent', 'cancelled', 'failed')
+              AND COALESCE(sent_at, next_attempt_at) < ?
+        ''', (time.time() - older_than_seconds,))
+        self._conn.commit()
+        return cursor.rowcount
+
+    # ================== ДОСТАВКА ==================
+
+    async def run(self, deliver: Callable[[Dict[str, Any]], Awaitable[Any]],
+                  on_delivered: Optional[Callable[[Dict[str, Any], Any], Awaitable[None]]] = None):
+        """
+        Фоновая доставка
+
+        Args:
+            deliver: Корутина отправки записи; результат передается в on_delivered
+            on_delivered: Вызывается после успешной доставки
+        """
+        while True:
+            free = self.max_concurrent - self._in_flight
+            if free <= 0:
+                # Ждем завершения одной из отправок
+                await self._sleep(float('inf'))
+                continue
+
+            rows = self._claim_due(min(free, self.batch_size))
+            if not rows:
+                await self._sleep(self._seconds_until_due())
+                continue
+
+            for row in rows:
+                self._in_flight += 1
+                task = asyncio.create_task(self._attempt(row, deliver, on_delivered))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def _claim_due(self, limit: int) -> List[Dict[str, Any]]:
+        """Выбор записей, которым пора уходить (помечаются как отправляемые)"""
+        rows = self._conn.execute('''
+            SELECT * FROM notification_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY priority, next_attempt_at
+            LIMIT ?
+        ''', (time.time(), limit)).fetchall()
+
+        if rows:
+            self._conn.executemany("UPDATE notification_outbox SET status = 'sending' WHERE outbox_id = ?",
+                                   [(row['outbox_id'],) for row in rows])
+            self._conn.commit()
+
+        result = []
+        for row in rows:
+            entry = dict(row)
+            entry['payload'] = json.loads(entry['payload']) if entry['payload'] else {}
+            result.append(entry)
+        return result
+
+    def _seconds_until_due(self) -> float:
+        row = self._conn.execute(
+            "SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = 'pending'").fetchone()
+        if row[0] is None:
+            return float('inf')
+        return max(0.0, row[0] - time.time())
+
+    async def _attempt(self, entry: Dict[str, Any], deliver, on_delivered):
+        """Одна попытка доставки"""
+        try:
+            try:
+                result = await deliver(entry)
+            except Exception as e:
+                self._schedule_retry(entry, e)
+                return
+
+            self._mark_sent(entry, result)
+            if on_delivered is not None:
+                try:
+                    await on_delivered(entry, result)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработки доставленного уведомления {entry['outbox_id']}: {e}")
+        finally:
+            self._in_flight -= 1
+            self._wake()
+
+    def _mark_sent(self, entry: Dict[str, Any], result: Any):
+        now = time.time()
+        self._conn.execute('''
+            UPDATE notification_outbox
+            SET status = 'sent', sent_at = ?, attempts = attempts + 1, message_id = ?, last_error = NULL
+            WHERE outbox_id = ?
+        ''', (now, getattr(result, 'message_id', None), entry['outbox_id']))
+        self._conn.commit()
+
+        lag = now - entry['created_at']
+        self.stats['delivered'] += 1
+        self.stats['total_lag_seconds'] += lag
+        self.stats['max_lag_seconds'] = max(self.stats['max_lag_seconds'], lag)
+        self.lag.record(lag)
+
+    def _schedule_retry(self, entry: Dict[str, Any], error: Exception):
+        """Повтор с экспоненциальной задержкой или отказ после max_attempts"""
+        attempts = entry['attempts'] + 1
+        reason = 'таймаут' if isinstance(error, asyncio.TimeoutError) else str(error)
+
+        if attempts >= self.max_attempts:
+            self._conn.execute('''
+                UPDATE notification_outbox SET status = 'failed', attempts = ?, last_error = ?
+                WHERE outbox_id = ?
+            ''', (attempts, reason, entry['outbox_id']))
+            self._conn.commit()
+            self.stats['failed'] += 1
+            logger.error(f"❌ Уведомление {entry['idempotency_key']} не доставлено за {attempts} попыток: {reason}")
+            return
+
+        delay = min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempts - 1))
+        delay *= random.uniform(0.8, 1.2)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, float(retry_after))
+
+        self._conn.execute('''
+            UPDATE notification_outbox
+            SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE outbox_id = ?
+        ''', (attempts, time.time() + delay, reason, entry['outbox_id']))
+        self._conn.commit()
+        self.stats['retries'] += 1
+        logger.warning(f"⏳ Уведомление {entry['idempotency_key']}: попытка {attempts} не удалась ({reason}), "
+                       f"повтор через {delay:.0f} сек")
+
+    async def _sleep(self, seconds: float):
+        """Ожидание seconds секунд или до _wake()"""
+        loop = asyncio.get_running_loop()
+        self._waiter = loop.create_future()
+        handle = loop.call_later(seconds, self._wake) if seconds != float('inf') else None
+        try:
+            await self._waiter
+        finally:
+            if handle is not None:
+                handle.cancel()
+            self._waiter = None
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    # ================== МЕТРИКИ ==================
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики outbox, включая задержку доставки"""
+        row = self._conn.execute('''
+            SELECT COUNT(*), MIN(created_at) FROM notification_outbox WHERE status IN ('pending', 'sending')
+        ''').fetchone()
+        pending, oldest = row[0], row[1]
+        delivered = self.stats['delivered']
+
+        return {
+            **self.stats,
+            'pending': pending,
+            'in_flight': self._in_flight,
+            'oldest_pending_seconds': time.time() - oldest if oldest else 0.0,
+            'avg_lag_seconds': self.stats['total_lag_seconds'] / delivered if delivered else 0.0,
+            **{f"lag_{name}_seconds": value for name, value in self.lag.percentiles().items()}
+        }
+
+    async def close(self):
+        """Закрытие базы после завершения идущих попыток доставки (они пишут в нее результат)"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._conn.close()
@@ -0,0 +1,147 @@
+﻿# managers/routing.py - выбор менеджера для вызова
+import heapq
+import itertools
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ManagerRouter:
+    """
+    Назначение вызова одному менеджеру
+
+    Стратегии:
+        least_loaded - менеджер с наименьшим числом открытых вызовов
+        round_robin - по кругу
+        sticky - менеджер, который уже вел пользователя (переопределения
+                 BotController или прошлое назначение), иначе least_loaded
+
+    Нагрузка хранится в min-куче (нагрузка, порядок, менеджер). Изменение
+    нагрузки добавляет новую запись, старая остается в куче и пропускается
+    при извлечении, поэтому и выбор, и переназначение стоят O(log n).
+    """
+
+    STRATEGIES = ('least_loaded', 'round_robin', 'sticky')
+
+    def __init__(self, manager_ids: Iterable[int], strategy: str = 'least_loaded',
+                 affinity: Optional[Callable[[int], Optional[int]]] = None):
+        self.set_strategy(strategy)
+
+        self.manager_ids = list(manager_ids)
+        self.affinity = affinity  # user_id -> менеджер (например, BotController.get_manager_for_user)
+
+        self.loads: Dict[int, int] = {manager_id: 0 for manager_id in self.manager_ids}
+        self._order = {manager_id: i for i, manager_id in enumerate(self.manager_ids)}
+        self._heap: List[Tuple[int, int, int]] = [(0, i, manager_id) for i, manager_id in enumerate(self.manager_ids)]
+        self._round_robin = itertools.count()
+        self._last_manager: Dict[int, int] = {}  # Последний менеджер пользователя
+
+        # Статистика
+        self.stats = {
+            'assigned': 0,
+            'sticky_hits': 0
+        }
+
+    def set_strategy(self, strategy: str):
+        """Смена стратегии (действует на следующие вызовы)"""
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Неизвестная стратегия распределения: {strategy}")
+        self.strategy = strategy
+
+    # ================== НАГРУЗКА ==================
+
+    def _set_load(self, manager_id: int, load: int):
+        self.loads[manager_id] = load
+        heapq.heappush(self._heap, (load, self._order[manager_id], manager_id))
+
+        # Устаревших записей стало много - перестраиваем кучу
+        if len(self._heap) > 2 * len(self.loads) + 64:
+            self._heap = [(load, self._order[m], m) for m, load in self.loads.items()]
+            heapq.heapify(self._heap)
+
+    def add_load(self, manager_id: int, delta: int = 1):
+        """Изменение числа открытых вызовов менеджера"""
+        if manager_id in self.loads:
+            self._set_load(manager_id, max(0, self.loads[manager_id] + delta))
+
+    def reset_loads(self, loads: Dict[int, int]):
+        """Замена нагрузки целиком (пересчет после очистки или перезапуска)"""
+        for manager_id in self.manager_ids:
+            self.loads[manager_id] = loads.get(manager_id, 0)
+        self._heap = [(load, self._order[m], m) for m, load in self.loads.items()]
+        heapq.heapify(self._heap)
+
+    def _least_loaded(self, exclude: Iterable[int] = ()) -> Optional[int]:
+        """Наименее загруженный менеджер не из exclude"""
+        exclude = set(exclude)
+        skipped = []
+        chosen = None
+
+        while self._heap:
+            load, order, manager_id = self._heap[0]
+            if self.loads.get(manager_id) != load:
+                heapq.heappop(self._heap)  # Устаревшая запись
+                continue
+            if manager_id in exclude:
+                skipped.append(heapq.heappop(self._heap))
+                continue
+            chosen = manager_id
+            break
+
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return chosen
+
+    # ================== ВЫБОР ==================
+
+    def sticky_manager(self, user_id: int) -> Optional[int]:
+        """Менеджер, закрепленный за пользователем"""
+        manager_id = self.affinity(user_id) if self.affinity else None
+        if manager_id not in self.loads:
+            manager_id = self._last_manager.get(user_id)
+        return manager_id if manager_id in self.loads else None
+
+    def pick(self, user_id: int, exclude: Iterable[int] = ()) -> Optional[int]:
+        """
+        Выбор менеджера для пользователя (без учета назначения)
+
+        Returns:
+            id менеджера или None, если все исключены
+        """
+        exclude = set(exclude)
+        if len(exclude) >= len(self.manager_ids):
+            return None
+
+        if self.strategy == 'sticky':
+            manager_id = self.sticky_manager(user_id)
+            if manager_id is not None and manager_id not in exclude:
+                self.stats['sticky_hits'] += 1
+                return manager_id
+
+        if self.strategy == 'round_robin':
+            for _ in range(len(self.manager_ids)):
+                manager_id = self.manager_ids[next(self._round_robin) % len(self.manager_ids)]
+                if manager_id not in exclude:
+                    return manager_id
+            return None
+
+        return self._least_loaded(exclude)
+
+    def assign(self, user_id: int, manager_id: int):
+        """Назначение вызова менеджеру"""
+        self.add_load(manager_id, 1)
+        self._last_manager[user_id] = manager_id
+        self.stats['assigned'] += 1
+
+    def remember(self, user_id: int, manager_id: int):
+        """Запоминание менеджера, который обработал вызов пользователя"""
+        if manager_id in self.loads:
+            self._last_manager[user_id] = manager_id
+
+    def get_stats(self) -> Dict[str, object]:
+        """Нагрузка и статистика распределения"""
+        return {
+            **self.stats,
+            'strategy': self.strategy,
+            'loads': dict(self.loads)
+        }
@@ -0,0 +1,193 @@
+﻿# managers/state_store.py - журнал и снимки состояния контроллера бота
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ControllerStateStore:
+    """
+    Хранилище состояния BotController в SQLite
+
+    Каждое изменение (включение/отключение бота, настройка) дописывается
+    в журнал controller_log, периодически сохраняется сжатый снимок всего
+    состояния, а журнал до снимка удаляется. При старте читается снимок
+    и хвост журнала после него.
+
+    Запись идет в отдельном потоке из очереди, поэтому обработчики сообщений
+    только кладут операцию в очередь и не ждут диска.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500):
+        self.path = path
+        self.batch_size = batch_size
+
+        # Статистика
+        self.stats = {
+            'logged_ops': 0,
+            'snapshots': 0,
+            'write_errors': 0
+        }
+
+        self._init_database()
+
+        self._queue: "queue.Queue[Optional[Tuple[str, Any]]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._run_writer, name="controller-state-writer", daemon=True)
+        self._writer.start()
+
+    def _init_database(self):
+        """Создание таблиц журнала и снимка"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with sqlite3.connect(self.path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA journal_mode = WAL')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS controller_log (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS controller_snapshot (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    last_seq INTEGER NOT NULL,
+                    created_at TEXT NOT NULL,
+                    state BLOB NOT NULL
+                )
+            ''')
+
+            conn.commit()
+
+    # ================== ЧТЕНИЕ ==================
+
+    def load(self) -> Tuple[Optional[Dict[str, Any]], List[Tuple[str, Dict[str, Any]]]]:
+        """
+        Загрузка последнего снимка и операций журнала после него
+
+        Returns:
+            (снимок или None, список (операция, параметры))
+        """
+        with sqlite3.connect(self.path) as conn:
+            cursor = conn.cursor()
+
+            row = cursor.execute('SELECT last_seq, state FROM controller_snapshot WHERE id = 1').fetchone()
+            last_seq, state = (row[0], json.loads(zlib.decompress(row[1]))) if row else (0, None)
+
+            cursor.execute('SELECT op, payload FROM controller_log WHERE seq > ? ORDER BY seq', (last_seq,))
+            ops = [(op, json.loads(payload)) for op, payload in cursor.fetchall()]
+
+        return state, ops
+
+    # ================== ЗАПИСЬ ==================
+
+    def append(self, op: str, payload: Dict[str, Any]):
+        """Добавление операции в журнал (в фоне)"""
+        self._queue.put(('op', (op, json.dumps(payload))))
+
+    def snapshot(self, state: Dict[str, Any]):
+        """
+        Сохранение снимка (в фоне)
+
+        Снимок встает в ту же очередь, что и операции, поэтому он
+        покрывает ровно те операции, которые были поставлены до него.
+        """
+        self._queue.put(('snapshot', state))
+
+    def _run_writer(self):
+        """Поток записи: операции из очереди пишутся пачками в одной транзакции"""
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA synchronous = NORMAL')
+
+        try:
+            while True:
+                items = [self._queue.get()]
+                while len(items) < self.batch_size:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                try:
+                    stop = self._write_batch(conn, items)
+                except Exception as e:
+                    conn.rollback()
+                    self.stats['write_errors'] += 1
+                    logger.error(f"❌ Ошибка записи состояния контроллера: {e}")
+                    stop = None in items
+                finally:
+                    for _ in items:
+                        self._queue.task_done()
+
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, items: List[Optional[Tuple[str, Any]]]) -> bool:
+        """Запись пачки; True, если в ней был сигнал остановки"""
+        ops = []
+        for item in items:
+            if item is None:
+                self._flush_ops(conn, ops)
+                return True
+
+            kind, value = item
+            if kind == 'op':
+                ops.append(value)
+            else:
+                self._flush_ops(conn, ops)
+                ops = []
+                self._write_snapshot(conn, value)
+
+        self._flush_ops(conn, ops)
+        return False
+
+    def _flush_ops(self, conn: sqlite3.Connection, ops: List[Tuple[str, str]]):
+        if not ops:
+            return
+        conn.executemany('INSERT INTO controller_log (op, payload) VALUES (?, ?)', ops)
+        conn.commit()
+        self.stats['logged_ops'] += len(ops)
+
+    def _write_snapshot(self, conn: sqlite3.Connection, state: Dict[str, Any]):
+        """Запись снимка и удаление покрытой им части журнала"""
+        blob = zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'), 6)
+        last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM controller_log').fetchone()[0]
+
+        conn.execute('''
+            INSERT INTO controller_snapshot (id, last_seq, created_at, state) VALUES (1, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                last_seq = excluded.last_seq,
+                created_at = excluded.created_at,
+                state = excluded.state
+        ''', (last_seq, datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), blob))
+        conn.execute('DELETE FROM controller_log WHERE seq <= ?', (last_seq,))
+        conn.commit()
+
+        self.stats['snapshots'] += 1
+        logger.info(f"💾 Снимок состояния контроллера: {len(blob)} байт, журнал до seq={last_seq} удален")
+
+    def flush(self):
+        """Ожидание записи всего, что уже в очереди"""
+        self._queue.join()
+
+    def close(self):
+        """Остановка потока записи (после записи очереди)"""
+        self._queue.put(None)
+        self._writer.join()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика хранилища"""
+        return {**self.stats, 'queued': self._queue.qsize()}
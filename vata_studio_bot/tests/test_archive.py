@@ -0,0 +1,31 @@
+﻿# tests/test_archive.py - архивация старых сообщений
+import sqlite3
+
+from data.archive import MessageArchiver
+from data.database import ConversationDatabase
+from data.rollups import AnalyticsRollup
+
+def test_archive_waits_for_rollup_watermark(tmp_path):
+    db = ConversationDatabase(str(tmp_path / "conversations.db"), history_cache_users=0)
+    for i in range(10):
+        db.save_message(i % 3, "user", "Иван", "Петров", f"сообщение {i}")
+    with sqlite3.connect(db.db_path) as conn:
+        conn.execute("UPDATE messages SET timestamp = '2020-01-01 12:00:00'")
+
+    rollup = AnalyticsRollup(db, batch_size=4)
+    archiver = MessageArchiver(db, str(tmp_path / "archive"), max_age_days=1,
+                               archive_limit=rollup.watermark)
+
+    # Сводки еще не считались - архивировать нечего
+    assert archiver.archive_old_messages() == 0
+
+    # Одна пачка сводок - в архив уходит только учтенное
+    assert rollup._rollup_batch() == 4
+    assert archiver.archive_old_messages() == 4
+
+    rollup.run_once()
+    assert archiver.archive_old_messages() == 6
+
+    with sqlite3.connect(db.db_path) as conn:
+        total = conn.execute("SELECT SUM(total_messages) FROM daily_stats").fetchone()[0]
+    assert total == 10
@@ -0,0 +1,59 @@
+﻿# tests/test_control.py - сессии пользователей в контроллере бота
+import time
+
+from managers.control import BotController
+
+USER_ID = 42
+
+def make_controller(monkeypatch):
+    """Контроллер с управляемыми часами (clock[0] - текущее time.monotonic())"""
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    return BotController(), clock
+
+def test_resume_after_expiry_does_not_touch_disabled_sessions(monkeypatch):
+    controller, clock = make_controller(monkeypatch)
+    controller.record_user_message(USER_ID)
+
+    for _ in range(3):
+        clock[0] += 31 * 60
+        controller.cleanup_inactive_sessions()
+        assert not controller.user_sessions[USER_ID].active
+        controller.record_user_message(USER_ID)
+
+    assert controller.stats['expired_sessions'] == 3
+    assert controller.stats['disabled_sessions'] == 0
+    assert controller.stats['active_sessions'] == 1
+
+def test_resume_after_disable_returns_disabled_session(monkeypatch):
+    controller, clock = make_controller(monkeypatch)
+    controller.record_user_message(USER_ID)
+    controller.disable_bot_for_user(USER_ID)
+    assert controller.stats['disabled_sessions'] == 1
+
+    controller.enable_bot_for_user(USER_ID)
+    assert controller.stats['disabled_sessions'] == 0
+    assert controller.stats['active_sessions'] == 1
+
+def test_close_reason_survives_snapshot(monkeypatch):
+    controller, clock = make_controller(monkeypatch)
+    controller.record_user_message(USER_ID)
+    controller.disable_bot_for_user(USER_ID)
+
+    restored = BotController()
+    restored.load_state(controller.export_state())
+    assert restored.user_sessions[USER_ID].closed_by == 'disabled'
+
+def test_enable_for_default_user_stores_nothing(monkeypatch):
+    controller, clock = make_controller(monkeypatch)
+    logged = []
+    monkeypatch.setattr(controller, '_log_state', lambda op, **payload: logged.append(op))
+
+    controller.enable_bot_for_user(USER_ID)
+    assert USER_ID not in controller.enabled_users
+    assert controller.user_sessions[USER_ID].active
+    assert logged == []
+
+    controller.enable_bot_for_user(USER_ID, manager_id=7)
+    assert USER_ID in controller.enabled_users
+    assert logged == ['enable']
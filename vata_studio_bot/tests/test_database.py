@@ -0,0 +1,33 @@
+﻿# tests/test_database.py - хранение ответов бота в reply_blobs
+import sqlite3
+
+from data.database import ConversationDatabase
+
+REPLY = "✅ Менеджер уведомлен! С вами свяжутся в ближайшее время."
+
+def save_reply(db: ConversationDatabase, user_id: int):
+    db.save_message(user_id, "user", "Иван", "Петров", REPLY, is_bot=True)
+
+def test_reply_saved_while_purge_runs_is_resolvable(tmp_path):
+    db = ConversationDatabase(str(tmp_path / "conversations.db"), history_cache_users=0)
+    save_reply(db, 1)
+
+    # Сообщение ушло в архив, и purge_unused_replies (в потоке архивации) уже удалил
+    # тело ответа, но еще не вернулся - кэши ConversationDatabase остались прежними
+    with sqlite3.connect(db.db_path) as conn:
+        conn.execute("DELETE FROM messages")
+        conn.execute("DELETE FROM reply_blobs")
+
+    # Тот же ответ другому пользователю - тело должно записаться заново
+    save_reply(db, 2)
+    history = db.get_conversation_history(2, limit=5)
+    assert [m['text'] for m in history] == [REPLY]
+
+def test_purge_keeps_referenced_replies(tmp_path):
+    db = ConversationDatabase(str(tmp_path / "conversations.db"), history_cache_users=0)
+    save_reply(db, 1)
+    assert db.purge_unused_replies() == 0
+
+    with sqlite3.connect(db.db_path) as conn:
+        conn.execute("DELETE FROM messages")
+    assert db.purge_unused_replies() == 1
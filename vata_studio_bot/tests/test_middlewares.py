@@ -0,0 +1,25 @@
+﻿# tests/test_middlewares.py - общие этапы обработки сообщений
+import asyncio
+from types import SimpleNamespace
+
+from bot.middlewares import SessionMiddleware
+from managers.control import BotController
+
+USER_ID = 42
+
+def start_event():
+    user = SimpleNamespace(id=USER_ID, username="user", first_name="Иван", last_name="Петров")
+    return SimpleNamespace(from_user=user)
+
+def test_start_does_not_enable_user_disabled_by_manager():
+    controller = BotController()
+    controller.disable_bot_for_user(USER_ID, manager_id=7)
+    middleware = SessionMiddleware(lambda: controller)
+
+    async def handler(event, data):
+        return controller.is_bot_enabled_for_user(USER_ID)
+
+    data = {'handler': SimpleNamespace(flags={'session': 'start'})}
+    assert asyncio.run(middleware(handler, start_event(), data)) is False
+    assert not controller.is_bot_enabled_for_user(USER_ID)
+    assert USER_ID in controller.user_sessions
@@ -0,0 +1,85 @@
+﻿# tests/test_notification.py - вызовы менеджеров и серии повторных вызовов
+import asyncio
+
+from managers.notification import ManagerNotifier
+
+USER_ID = 42
+
+class FakeBot:
+    """Бот без сети: уведомления только пишутся в outbox"""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return None
+
+def make_notifier(**kwargs) -> ManagerNotifier:
+    return ManagerNotifier(bot=FakeBot(), manager_ids=[1, 2], debounce_seconds=120, **kwargs)
+
+async def call(notifier: ManagerNotifier, question: str) -> bool:
+    return await notifier.notify_manager(USER_ID, "user", "Иван", "Петров", question)
+
+def test_repeat_call_is_appended_to_open_call():
+    async def scenario():
+        notifier = make_notifier()
+        assert await call(notifier, "первый вопрос")
+        assert await call(notifier, "второй вопрос")
+
+        assert notifier.outbox.stats['enqueued'] == 1
+        assert notifier.stats['coalesced_calls'] == 1
+        assert notifier.outbox.get_stats()['pending'] == 1
+        await notifier.close()
+
+    asyncio.run(scenario())
+
+def test_call_after_handled_within_debounce_is_new_call():
+    async def scenario():
+        notifier = make_notifier()
+        assert await call(notifier, "первый вопрос")
+        first_manager = notifier._open_calls[USER_ID]['managers'][0]
+        assert notifier.mark_notification_handled(USER_ID, first_manager)
+        assert not notifier.has_active_call(USER_ID)
+
+        # Новый вызов в пределах debounce_seconds - новое уведомление, нагрузка и таймер SLA
+        assert await call(notifier, "новый вопрос")
+
+        assert notifier.outbox.stats['enqueued'] == 2
+        assert notifier.stats['coalesced_calls'] == 0
+        assert notifier.stats['total_calls'] == 2
+        assert notifier.outbox.get_stats()['pending'] == 1
+        assert sum(notifier.router.loads.values()) == 1
+        assert USER_ID in notifier.escalation_timers
+        await notifier.close()
+
+    asyncio.run(scenario())
+
+def test_delivered_call_does_not_send_second_confirmation():
+    async def scenario():
+        notifier = make_notifier()
+        assert await call(notifier, "вопрос")
+
+        # Доставка уведомления менеджеру (без фонового обработчика outbox)
+        entry = notifier.outbox._claim_due(10)[0]
+        await notifier._on_outbox_delivered(entry, None)
+
+        # Пользователю уже ответил call_manager - в outbox только уведомление менеджеру
+        assert notifier.outbox.stats['enqueued'] == 1
+        assert notifier.pending_notifications.pending_count() == 1
+        await notifier.close()
+
+    asyncio.run(scenario())
+
+def test_user_fields_are_escaped_in_digest_and_alert():
+    async def scenario():
+        notifier = make_notifier()
+        await notifier.notify_typing_timeout(USER_ID, "a&b", "<Иван>", "Петров & Ко")
+        digests = notifier.digest.drain()
+        assert len(digests) == 1
+        text = digests[0][1]
+        assert "&lt;Иван&gt; Петров &amp; Ко (@a&amp;b" in text
+        assert "<Иван>" not in text
+
+        await notifier.notify_manager(USER_ID, "user", "<Иван>", "Петров", "цена < 100 & скидка?")
+        alert = notifier._render_call_alert(notifier._open_calls[USER_ID])
+        assert "&lt;Иван&gt;" in alert and "цена &lt; 100 &amp; скидка?" in alert
+        await notifier.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+﻿# tests/test_outbox.py - очередь исходящих уведомлений
+import asyncio
+import time
+
+from managers.outbox import NotificationOutbox
+
+def test_prune_removes_only_old_finished_entries(tmp_path):
+    outbox = NotificationOutbox(str(tmp_path / "notifications.db"))
+    for key in ("sent-old", "cancelled-old", "sent-new", "pending"):
+        outbox.enqueue(1, "текст", key)
+
+    entries = {entry['idempotency_key']: entry for entry in outbox._claim_due(10)}
+    outbox._mark_sent(entries["sent-old"], None)
+    outbox._mark_sent(entries["sent-new"], None)
+    outbox._conn.execute("UPDATE notification_outbox SET status = 'pending' WHERE idempotency_key = 'pending'")
+    outbox._conn.execute("UPDATE notification_outbox SET status = 'cancelled' WHERE idempotency_key = 'cancelled-old'")
+
+    hour_ago = time.time() - 3600
+    outbox._conn.execute("UPDATE notification_outbox SET sent_at = ?, next_attempt_at = ? "
+                         "WHERE idempotency_key IN ('sent-old', 'cancelled-old')", (hour_ago, hour_ago))
+    outbox._conn.commit()
+
+    assert outbox.prune(600) == 2
+    remaining = {row[0] for row in outbox._conn.execute("SELECT idempotency_key FROM notification_outbox")}
+    assert remaining == {"sent-new", "pending"}
+    asyncio.run(outbox.close())
+
+def test_close_waits_for_deliveries_in_flight(tmp_path):
+    path = str(tmp_path / "notifications.db")
+
+    async def slow_deliver(entry):
+        await asyncio.sleep(0.2)
+
+    async def scenario():
+        outbox = NotificationOutbox(path)
+        outbox.enqueue(1, "текст", "key")
+        runner = asyncio.create_task(outbox.run(slow_deliver))
+        await asyncio.sleep(0.05)
+        assert outbox._in_flight == 1
+
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        await outbox.close()
+
+    asyncio.run(scenario())
+
+    reopened = NotificationOutbox(path)
+    assert reopened._conn.execute("SELECT status FROM notification_outbox").fetchone()[0] == 'sent'
+    asyncio.run(reopened.close())
@@ -0,0 +1,65 @@
+﻿# tests/test_sharding.py - шардированная история диалогов
+import sqlite3
+import time
+
+import pytest
+
+from data.archive import MessageArchiver
+from data.sharding import ShardedConversationDatabase, reshard
+
+def test_reads_see_queued_messages_without_waiting_for_queue(tmp_path):
+    db = ShardedConversationDatabase(str(tmp_path / "conversations.db"), 2, history_cache_users=0)
+    shard = db.shard_for(7)
+    save = shard.save_message
+
+    def slow_save(**kwargs):
+        time.sleep(0.4)
+        save(**kwargs)
+
+    shard.save_message = slow_save
+    texts = ["первое", "второе", "третье", "четвертое"]
+    for i, text in enumerate(texts):
+        db.save_message(7, "user", "Иван", "Петров", text, is_bot=i % 2 == 1)
+
+    # Очередь пишется ~1.6 с; читатель ждет не больше одной текущей записи
+    started = time.monotonic()
+    history = db.get_conversation_history(7, limit=5)
+    assert time.monotonic() - started < 1
+    assert [m['text'] for m in history] == texts
+
+    stats = db.get_user_stats(7)
+    assert (stats['total_messages'], stats['bot_messages'], stats['user_messages']) == (4, 2, 2)
+
+    db.flush()
+    assert [m['text'] for m in db.get_conversation_history(7, limit=5)] == texts
+    assert db.get_user_stats(7)['total_messages'] == 4
+    db.close()
+
+def _archive_everything(db, archive_dir):
+    with sqlite3.connect(db.db_path) as conn:
+        conn.execute("UPDATE messages SET timestamp = '2020-01-01 00:00:00'")
+    MessageArchiver(db, str(archive_dir), max_age_days=1).archive_old_messages()
+
+def test_reshard_carries_archived_messages(tmp_path):
+    src = ShardedConversationDatabase(str(tmp_path / "src.db"), 1, history_cache_users=0)
+    for user_id in range(4):
+        src.save_message(user_id, "user", "Иван", "Петров", f"старое {user_id}")
+    src.flush()
+    _archive_everything(src.shards[0], tmp_path / "archive")
+    for user_id in range(4):
+        src.save_message(user_id, "user", "Иван", "Петров", f"новое {user_id}")
+    src.close()
+
+    with pytest.raises(ValueError):
+        reshard(str(tmp_path / "src.db"), 1, str(tmp_path / "refused.db"), 2)
+
+    moved = reshard(str(tmp_path / "src.db"), 1, str(tmp_path / "dst.db"), 2,
+                    archive_dir=str(tmp_path / "archive"))
+    assert moved == 8
+
+    dst = ShardedConversationDatabase(str(tmp_path / "dst.db"), 2, history_cache_users=0)
+    for user_id in range(4):
+        history = dst.get_conversation_history(user_id, limit=5)
+        assert [m['text'] for m in history] == [f"старое {user_id}", f"новое {user_id}"]
+        assert dst.get_user_stats(user_id)['total_messages'] == 2
+    dst.close()
@@ -1,8 +1,8 @@
-"""
-   Vata Studio Assistant.
+﻿"""
+Утилиты для бота Vata Studio Assistant.
 """
 
-from .logger import setup_logging, get_logger, BotLogger
+from .logger import setup_logging, get_logger
 from .helpers import (
     clean_text, extract_keywords, normalize_query,
     format_tariff_response, format_model_response,
@@ -11,14 +11,19 @@ from .helpers import (
     validate_phone, format_phone, split_into_chunks,
     extract_emails, calculate_similarity, Cache
 )
+from .rate_limit import TokenBucket, RateLimiter
+from .timer_wheel import TimerWheel
+from .bitmap import CompressedBitmap
+from .deadline_timers import DeadlineTimers
+from .outbound import OutboundScheduler
+from .latency import LatencyHistogram, RollingLatency, LatencyStats
 
 __all__ = [
-    # 
+    # Логирование
     'setup_logging',
     'get_logger',
-    'BotLogger',
     
-    # 
+    # Помощники
     'clean_text',
     'extract_keywords',
     'normalize_query',
@@ -35,5 +40,15 @@ __all__ = [
     'split_into_chunks',
     'extract_emails',
     'calculate_similarity',
-    'Cache'
+    'Cache',
+    
+    'TokenBucket',
+    'RateLimiter',
+    'TimerWheel',
+    'CompressedBitmap',
+    'DeadlineTimers',
+    'OutboundScheduler',
+    'LatencyHistogram',
+    'RollingLatency',
+    'LatencyStats'
 ]
\ No newline at end of file
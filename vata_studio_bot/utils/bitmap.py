@@ -0,0 +1,290 @@
+﻿import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, Any
+
+# Контейнер с числом значений больше порога хранится битовой картой
+ARRAY_LIMIT = 4096
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+BITMAP_BYTES = CHUNK_SIZE // 8
+
+_MAGIC = b'RBM1'
+_HEADER = struct.Struct('<4sI')
+_CONTAINER = struct.Struct('<qBI')
+
+class _ArrayContainer:
+    """Разреженный контейнер: отсортированный массив младших 16 бит"""
+
+    __slots__ = ('values',)
+
+    def __init__(self, values: array = None):
+        self.values = values if values is not None else array('H')
+
+    def __contains__(self, low: int) -> bool:
+        i = bisect_left(self.values, low)
+        return i < len(self.values) and self.values[i] == low
+
+    def add(self, low: int) -> bool:
+        i = bisect_left(self.values, low)
+        if i < len(self.values) and self.values[i] == low:
+            return False
+        self.values.insert(i, low)
+        return True
+
+    def discard(self, low: int) -> bool:
+        i = bisect_left(self.values, low)
+        if i < len(self.values) and self.values[i] == low:
+            del self.values[i]
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.values)
+
+    def to_bitmap(self) -> '_BitmapContainer':
+        container = _BitmapContainer()
+        for low in self.values:
+            container.add(low)
+        return container
+
+    def payload(self) -> bytes:
+        values = self.values
+        if sys.byteorder == 'big':
+            values = array('H', values)
+            values.byteswap()
+        return values.tobytes()
+
+class _BitmapContainer:
+    """Плотный контейнер: 65536 бит (8 КБ)"""
+
+    __slots__ = ('bits', 'cardinality')
+
+    def __init__(self, bits: bytearray = None):
+        self.bits = bits if bits is not None else bytearray(BITMAP_BYTES)
+        self.cardinality = int.from_bytes(self.bits, 'little').bit_count() if bits is not None else 0
+
+    def __contains__(self, low: int) -> bool:
+        return bool(self.bits[low >> 3] & (1 << (low & 7)))
+
+    def add(self, low: int) -> bool:
+        mask = 1 << (low & 7)
+        if self.bits[low >> 3] & mask:
+            return False
+        self.bits[low >> 3] |= mask
+        self.cardinality += 1
+        return True
+
+    def discard(self, low: int) -> bool:
+        mask = 1 << (low & 7)
+        if not self.bits[low >> 3] & mask:
+            return False
+        self.bits[low >> 3] &= ~mask
+        self.cardinality -= 1
+        return True
+
+    def set_range(self, lo: int, hi: int, value: bool):
+        """Установка или сброс битов [lo, hi)"""
+        fill = 0xFF if value else 0x00
+        while lo < hi and lo & 7:
+            self._set_bit(lo, value)
+            lo += 1
+        while lo < hi and hi & 7:
+            hi -= 1
+            self._set_bit(hi, value)
+        if lo < hi:
+            self.bits[lo >> 3:hi >> 3] = bytes([fill]) * ((hi - lo) >> 3)
+        self.cardinality = int.from_bytes(self.bits, 'little').bit_count()
+
+    def _set_bit(self, low: int, value: bool):
+        if value:
+            self.bits[low >> 3] |= 1 << (low & 7)
+        else:
+            self.bits[low >> 3] &= ~(1 << (low & 7))
+
+    def __len__(self) -> int:
+        return self.cardinality
+
+    def __iter__(self) -> Iterator[int]:
+        for index, byte in enumerate(self.bits):
+            while byte:
+                lowest = byte & -byte
+                yield (index << 3) + lowest.bit_length() - 1
+                byte ^= lowest
+
+    def to_array(self) -> _ArrayContainer:
+        return _ArrayContainer(array('H', iter(self)))
+
+    def payload(self) -> bytes:
+        return bytes(self.bits)
+
+class CompressedBitmap:
+    """
+    Сжатое множество целых чисел в стиле Roaring
+
+    Число делится на старшую часть (ключ контейнера) и младшие 16 бит.
+    Контейнер до 4096 значений - отсортированный массив по 2 байта
+    на значение, больше - битовая карта на 8 КБ. Интерфейс как у set:
+    add / discard / in / len / итерация, плюс операции над диапазонами
+    и компактная сериализация.
+    """
+
+    def __init__(self, values: Iterable[int] = ()):
+        self._containers: Dict[int, Any] = {}
+        self._size = 0
+        self.update(values)
+
+    # ================== ОДИНОЧНЫЕ ОПЕРАЦИИ ==================
+
+    def __contains__(self, value: int) -> bool:
+        container = self._containers.get(value >> CHUNK_BITS)
+        return container is not None and (value & 0xFFFF) in container
+
+    def add(self, value: int):
+        key = value >> CHUNK_BITS
+        container = self._containers.get(key)
+        if container is None:
+            container = self._containers[key] = _ArrayContainer()
+
+        if container.add(value & 0xFFFF):
+            self._size += 1
+            if isinstance(container, _ArrayContainer) and len(container) > ARRAY_LIMIT:
+                self._containers[key] = container.to_bitmap()
+
+    def discard(self, value: int):
+        key = value >> CHUNK_BITS
+        container = self._containers.get(key)
+        if container is None or not container.discard(value & 0xFFFF):
+            return
+
+        self._size -= 1
+        self._compact(key)
+
+    def _compact(self, key: int):
+        """Удаление пустого контейнера и возврат битовой карты в массив"""
+        container = self._containers[key]
+        if not len(container):
+            del self._containers[key]
+        elif isinstance(container, _BitmapContainer) and len(container) <= ARRAY_LIMIT:
+            self._containers[key] = container.to_array()
+
+    # ================== МАССОВЫЕ ОПЕРАЦИИ ==================
+
+    def update(self, values: Iterable[int]):
+        """Добавление списка значений"""
+        for value in values:
+            self.add(value)
+
+    def difference_update(self, values: Iterable[int]):
+        """Удаление списка значений"""
+        for value in values:
+            self.discard(value)
+
+    def add_range(self, start: int, stop: int):
+        """Добавление всех значений [start, stop)"""
+        self._set_range(start, stop, True)
+
+    def remove_range(self, start: int, stop: int):
+        """Удаление всех значений [start, stop)"""
+        self._set_range(start, stop, False)
+
+    def _set_range(self, start: int, stop: int, value: bool):
+        position = start
+        while position < stop:
+            key = position >> CHUNK_BITS
+            lo = position & 0xFFFF
+            hi = min(stop - (key << CHUNK_BITS), CHUNK_SIZE)
+            position = (key << CHUNK_BITS) + hi
+
+            container = self._containers.get(key)
+            if container is None:
+                if not value:
+                    continue
+                container = _ArrayContainer()
+
+            before = len(container)
+            if isinstance(container, _ArrayContainer) and not value:
+                values = container.values
+                del values[bisect_left(values, lo):bisect_left(values, hi)]
+            elif isinstance(container, _ArrayContainer) and before + (hi - lo) <= ARRAY_LIMIT:
+                container.values = array('H', sorted(set(container.values).union(range(lo, hi))))
+            else:
+                if isinstance(container, _ArrayContainer):
+                    container = container.to_bitmap()
+                container.set_range(lo, hi, value)
+
+            self._containers[key] = container
+            self._size += len(container) - before
+            self._compact(key)
+
+    # ================== ПРОСМОТР ==================
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def __iter__(self) -> Iterator[int]:
+        for key in sorted(self._containers):
+            base = key << CHUNK_BITS
+            for low in self._containers[key]:
+                yield base + low
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, CompressedBitmap):
+            return len(self) == len(other) and all(value in other for value in self)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"CompressedBitmap(size={self._size}, containers={len(self._containers)})"
+
+    def memory_bytes(self) -> int:
+        """Примерный объем данных контейнеров"""
+        return sum(len(c) * 2 if isinstance(c, _ArrayContainer) else BITMAP_BYTES
+                   for c in self._containers.values())
+
+    # ================== СЕРИАЛИЗАЦИЯ ==================
+
+    def to_bytes(self) -> bytes:
+        """Компактное двоичное представление"""
+        parts = [_HEADER.pack(_MAGIC, len(self._containers))]
+        for key in sorted(self._containers):
+            container = self._containers[key]
+            kind = 0 if isinstance(container, _ArrayContainer) else 1
+            parts.append(_CONTAINER.pack(key, kind, len(container)))
+            parts.append(container.payload())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CompressedBitmap':
+        """Восстановление из to_bytes()"""
+        magic, count = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("Неизвестный формат битовой карты")
+
+        bitmap = cls()
+        offset = _HEADER.size
+        for _ in range(count):
+            key, kind, cardinality = _CONTAINER.unpack_from(data, offset)
+            offset += _CONTAINER.size
+
+            if kind == 0:
+                values = array('H')
+                values.frombytes(data[offset:offset + cardinality * 2])
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                container = _ArrayContainer(values)
+                offset += cardinality * 2
+            else:
+                container = _BitmapContainer(bytearray(data[offset:offset + BITMAP_BYTES]))
+                offset += BITMAP_BYTES
+
+            bitmap._containers[key] = container
+            bitmap._size += len(container)
+
+        return bitmap
@@ -0,0 +1,113 @@
+﻿import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+class DeadlineTimers:
+    """
+    Отменяемые таймеры по ключу поверх loop.call_later
+
+    На ключ приходится один таймер: повторная постановка переносит срок.
+    Таймеры хранятся в куче цикла событий, поэтому тысячи одновременных
+    таймеров почти ничего не стоят. По истечении вызывается корутина
+    on_expire(key, payload); повторные срабатывания для ключа в пределах
+    cooldown_seconds после предыдущего схлопываются.
+    """
+
+    def __init__(self, on_expire: Optional[Callable[[Hashable, Any], Awaitable[None]]] = None,
+                 cooldown_seconds: float = 0):
+        self.on_expire = on_expire
+        self.cooldown_seconds = cooldown_seconds
+        self._handles: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._last_fired: Dict[Hashable, float] = {}
+        self._prune_at = 1024
+        self._tasks: Set[asyncio.Task] = set()
+
+        # Статистика
+        self.stats = {
+            'scheduled': 0,
+            'cancelled': 0,
+            'fired': 0,
+            'coalesced': 0
+        }
+
+    def schedule(self, key: Hashable, delay: float, payload: Any = None) -> bool:
+        """
+        Постановка (перенос) таймера
+
+        Returns:
+            False, если нет запущенного цикла событий
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+
+        handle = self._handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+        self._handles[key] = loop.call_later(delay, self._expire, key, payload)
+        self.stats['scheduled'] += 1
+        return True
+
+    def cancel(self, key: Hashable) -> bool:
+        """Отмена таймера"""
+        handle = self._handles.pop(key, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        self.stats['cancelled'] += 1
+        return True
+
+    def cancel_all(self):
+        """Отмена всех таймеров (при остановке)"""
+        for handle in self._handles.values():
+            handle.cancel()
+        self._handles.clear()
+
+    def _expire(self, key: Hashable, payload: Any):
+        self._handles.pop(key, None)
+
+        now = time.monotonic()
+        last = self._last_fired.get(key)
+        if last is not None and now - last < self.cooldown_seconds:
+            self.stats['coalesced'] += 1
+            return
+
+        self._last_fired[key] = now
+        self._prune_last_fired(now)
+        self.stats['fired'] += 1
+
+        if self.on_expire is None:
+            return
+
+        task = asyncio.ensure_future(self._run_callback(key, payload))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_callback(self, key: Hashable, payload: Any):
+        try:
+            await self.on_expire(key, payload)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки таймера {key}: {e}")
+
+    def _prune_last_fired(self, now: float):
+        """Отметки старше окна схлопывания больше не нужны"""
+        if len(self._last_fired) < self._prune_at:
+            return
+        self._last_fired = {key: fired for key, fired in self._last_fired.items()
+                            if now - fired < self.cooldown_seconds}
+        self._prune_at = max(1024, 2 * len(self._last_fired))
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._handles
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика таймеров"""
+        return {**self.stats, 'pending': len(self._handles)}
@@ -0,0 +1,195 @@
+﻿import math
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек с логарифмическими корзинами (в духе HDR Histogram)
+
+    Значение попадает в корзину floor(log(v / min_value) / log(1 + precision)),
+    поэтому любой квантиль восстанавливается с относительной ошибкой не больше
+    precision, а память зависит только от разброса значений (сотни корзин на
+    диапазон от миллисекунд до суток), но не от их числа. Гистограммы можно
+    складывать - так собираются скользящие окна и общие сводки.
+    """
+
+    __slots__ = ('min_value', 'precision', '_log_base', 'buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self, min_value: float = 0.001, precision: float = 0.01):
+        self.min_value = min_value
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _index(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        return int(math.log(value / self.min_value) / self._log_base) + 1
+
+    def _value(self, index: int) -> float:
+        """Середина корзины (ошибка не больше precision / 2 от ее границ)"""
+        if index == 0:
+            return self.min_value
+        low = self.min_value * math.exp((index - 1) * self._log_base)
+        return low * (1 + self.precision / 2)
+
+    def record(self, value: float, count: int = 1):
+        """Добавление значения (в секундах)"""
+        value = max(0.0, value)
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'LatencyHistogram'):
+        """Прибавление другой гистограммы с теми же параметрами"""
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Квантиль q (0..1); 0 для пустой гистограммы"""
+        if not self.count:
+            return 0.0
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def percentiles(self, qs: Iterable[float] = (0.5, 0.9, 0.99)) -> Dict[str, float]:
+        """Несколько квантилей за один проход: {'p50': ..., 'p90': ..., 'p99': ...}"""
+        qs = sorted(qs)
+        result = {f"p{q * 100:g}": 0.0 for q in qs}
+        if not self.count:
+            return result
+
+        ranks = [(q, q * (self.count - 1)) for q in qs]
+        seen = 0
+        i = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while i < len(ranks) and seen > ranks[i][1]:
+                result[f"p{ranks[i][0] * 100:g}"] = min(max(self._value(index), self.min), self.max)
+                i += 1
+            if i == len(ranks):
+                break
+        return result
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self) -> Dict[str, float]:
+        """Число, среднее, максимум и p50/p90/p99"""
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'max': self.max,
+            **self.percentiles()
+        }
+
+class RollingLatency:
+    """
+    Задержки за последние window_seconds
+
+    Окно разбито на slots гистограмм; устаревшая гистограмма сбрасывается,
+    когда время доходит до ее ячейки, поэтому запись стоит O(1), а сводка
+    за окно - сложение slots гистограмм.
+    """
+
+    def __init__(self, window_seconds: float = 3600, slots: int = 12,
+                 min_value: float = 0.001, precision: float = 0.01):
+        self.slot_seconds = window_seconds / slots
+        self._slots: List[LatencyHistogram] = [LatencyHistogram(min_value, precision) for _ in range(slots)]
+        self._epochs: List[int] = [-1] * slots
+
+    def _slot(self, now: float) -> LatencyHistogram:
+        epoch = int(now // self.slot_seconds)
+        i = epoch % len(self._slots)
+        if self._epochs[i] != epoch:
+            old = self._slots[i]
+            self._slots[i] = LatencyHistogram(old.min_value, old.precision)
+            self._epochs[i] = epoch
+        return self._slots[i]
+
+    def record(self, value: float, now: Optional[float] = None):
+        self._slot(time.monotonic() if now is None else now).record(value)
+
+    def snapshot(self, now: Optional[float] = None) -> LatencyHistogram:
+        """Гистограмма за окно"""
+        now = time.monotonic() if now is None else now
+        oldest = int(now // self.slot_seconds) - len(self._slots) + 1
+        merged = LatencyHistogram(self._slots[0].min_value, self._slots[0].precision)
+        for epoch, histogram in zip(self._epochs, self._slots):
+            if epoch >= oldest:
+                merged.merge(histogram)
+        return merged
+
+class LatencyStats:
+    """
+    Набор именованных рядов задержек
+
+    Для каждого ряда (менеджер, обработчик, этап) хранится гистограмма за
+    все время и скользящее окно. Ряды создаются при первой записи. Для
+    задержек меньше миллисекунды (этапы обработки) задайте min_value меньше.
+    """
+
+    def __init__(self, window_seconds: float = 3600, min_value: float = 0.001, precision: float = 0.01):
+        self.window_seconds = window_seconds
+        self.min_value = min_value
+        self.precision = precision
+        self._total: Dict[Hashable, LatencyHistogram] = {}
+        self._window: Dict[Hashable, RollingLatency] = {}
+
+    def record(self, name: Hashable, value: float, now: Optional[float] = None):
+        """Запись задержки value секунд в ряд name"""
+        histogram = self._total.get(name)
+        if histogram is None:
+            histogram = self._total[name] = LatencyHistogram(self.min_value, self.precision)
+            self._window[name] = RollingLatency(self.window_seconds, min_value=self.min_value,
+                                                precision=self.precision)
+        histogram.record(value)
+        self._window[name].record(value, now)
+
+    @contextmanager
+    def measure(self, name: Hashable):
+        """Замер времени блока: with stats.measure('db'): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def names(self) -> List[Hashable]:
+        return list(self._total)
+
+    def histogram(self, name: Hashable) -> LatencyHistogram:
+        """Гистограмма ряда за все время (пустая, если записей не было)"""
+        return self._total.get(name) or LatencyHistogram(self.min_value, self.precision)
+
+    def summary(self, name: Hashable, now: Optional[float] = None) -> Dict[str, Any]:
+        """Сводка ряда: за все время и за окно"""
+        histogram = self.histogram(name)
+        window = self._window.get(name)
+        return {
+            **histogram.summary(),
+            'window': window.snapshot(now).summary() if window else LatencyHistogram().summary()
+        }
+
+    def get_stats(self, now: Optional[float] = None) -> Dict[Hashable, Dict[str, Any]]:
+        """Сводки всех рядов"""
+        return {name: self.summary(name, now) for name in self._total}
@@ -0,0 +1,291 @@
+﻿import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .rate_limit import RateLimiter, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений (меньше - раньше)
+PRIORITY_REPLY = 0      # Ответы пользователям
+PRIORITY_MANAGER = 1    # Уведомления менеджерам
+PRIORITY_DIGEST = 2     # Сводки и статистика для менеджеров
+PRIORITY_BROADCAST = 3  # Рассылки
+
+class _OutboundItem:
+    __slots__ = ('priority', 'seq', 'chat_id', 'send', 'future', 'queued_at', 'attempts')
+
+    def __init__(self, priority: int, seq: int, chat_id: int,
+                 send: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.send = send
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundScheduler:
+    """
+    Очередь исходящих сообщений с соблюдением лимитов Telegram
+
+    У каждого чата своя очередь по приоритету, общий порядок задает куча
+    готовых чатов. Отправка требует токен из корзины чата и из общей
+    корзины; чат без токена откладывается до их пополнения и не мешает
+    остальным. В каждом чате одновременно отправляется не больше одного
+    сообщения, поэтому порядок внутри чата сохраняется. Ответ 429
+    (исключение с retry_after) возвращает сообщение в голову очереди чата
+    и откладывает чат на указанное время.
+    """
+
+    def __init__(self, bot=None, global_per_second: float = 30, global_burst: int = 1,
+                 chat_per_second: float = 1, chat_burst: int = 3,
+                 max_in_flight: int = 30, max_retries: int = 5):
+        self.bot = bot
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+
+        # Общая корзина почти без запаса: иначе в первую секунду ушло бы вдвое больше лимита
+        self.global_bucket = TokenBucket(global_burst, global_per_second)
+        self.chat_limiter = RateLimiter(chat_burst, chat_burst / chat_per_second)
+
+        self._seq = itertools.count()
+        self._chat_queues: Dict[int, List[Tuple[int, int, _OutboundItem]]] = {}
+        self._ready: List[Tuple[int, int, int]] = []           # (приоритет, seq, chat_id) головы очереди чата
+        self._delayed: List[Tuple[float, int]] = []            # (когда можно, chat_id)
+        self._delayed_chats: Set[int] = set()
+        self._in_flight_chats: Set[int] = set()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._waiter: Optional[asyncio.Future] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()  # Идущие отправки
+
+        # Статистика
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'retry_after': 0,
+            'throttled_chats': 0,
+            'max_wait_seconds': 0.0,
+            'total_wait_seconds': 0.0,
+            'sent_by_priority': {}
+        }
+
+    # ================== ПОСТАНОВКА В ОЧЕРЕДЬ ==================
+
+    def submit(self, chat_id: int, send: Callable[[], Awaitable[Any]],
+               priority: int = PRIORITY_REPLY) -> asyncio.Future:
+        """
+        Постановка отправки в очередь
+
+        Args:
+            chat_id: Чат, в который уходит сообщение
+            send: Функция без аргументов, возвращающая корутину отправки
+            priority: Приоритет (PRIORITY_*)
+
+        Returns:
+            Future с результатом отправки
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = _OutboundItem(priority, next(self._seq), chat_id, send, future)
+
+        heapq.heappush(self._chat_queues.setdefault(chat_id, []), (item.priority, item.seq, item))
+        self._push_ready(chat_id)
+        self.stats['queued'] += 1
+
+        self._ensure_worker()
+        self._wake()
+        return future
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> asyncio.Future:
+        """Отправка bot.send_message через очередь"""
+        return self.submit(chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text, **kwargs), priority)
+
+    def answer(self, message, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> asyncio.Future:
+        """Ответ на входящее сообщение (message.answer) через очередь"""
+        return self.submit(message.chat.id, lambda: message.answer(text, **kwargs), priority)
+
+    def edit_text(self, message, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> asyncio.Future:
+        """Редактирование сообщения (message.edit_text) через очередь"""
+        return self.submit(message.chat.id, lambda: message.edit_text(text, **kwargs), priority)
+
+    def _push_ready(self, chat_id: int):
+        """Постановка головы очереди чата в кучу готовых"""
+        queue = self._chat_queues.get(chat_id)
+        if not queue or chat_id in self._delayed_chats or chat_id in self._in_flight_chats:
+            return
+        priority, seq, _ = queue[0]
+        heapq.heappush(self._ready, (priority, seq, chat_id))
+
+    def _delay_chat(self, chat_id: int, until: float):
+        """Откладывание чата до момента until"""
+        if chat_id in self._delayed_chats:
+            return
+        self._delayed_chats.add(chat_id)
+        heapq.heappush(self._delayed, (until, chat_id))
+
+    # ================== ОТПРАВКА ==================
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def start(self):
+        """Запуск обработчика очереди"""
+        self._ensure_worker()
+
+    async def stop(self, drain_timeout: float = 5.0):
+        """Остановка: дожидаемся отправки очереди (не дольше drain_timeout)"""
+        deadline = time.monotonic() + drain_timeout
+        while (self._chat_queues or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+
+            # Возвращаем отложенные чаты, у которых истек срок
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                self._delayed_chats.discard(chat_id)
+                self._push_ready(chat_id)
+
+            wait = self._next_wait(now)
+            if wait is not None:
+                await self._sleep(wait)
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            queue = self._chat_queues.get(chat_id)
+            if not queue or queue[0][:2] != (priority, seq) or chat_id in self._in_flight_chats \
+                    or chat_id in self._delayed_chats:
+                continue  # Устаревшая запись
+
+            if queue[0][2].future.cancelled():
+                # Отправитель перестал ждать (таймаут) - не тратим на сообщение лимит
+                heapq.heappop(queue)
+                self.stats['cancelled'] += 1
+                if not queue:
+                    del self._chat_queues[chat_id]
+                self._push_ready(chat_id)
+                continue
+
+            chat_bucket = self.chat_limiter.bucket(chat_id, now)
+            if not chat_bucket.try_consume(1, now):
+                self.stats['throttled_chats'] += 1
+                self._delay_chat(chat_id, now + chat_bucket.time_until_available(1, now))
+                continue
+
+            self.global_bucket.try_consume(1, now)
+            _, _, item = heapq.heappop(queue)
+            if not queue:
+                del self._chat_queues[chat_id]
+
+            self._in_flight += 1
+            self._in_flight_chats.add(chat_id)
+            task = asyncio.create_task(self._deliver(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _sleep(self, seconds: float):
+        """Ожидание seconds секунд или до _wake()"""
+        loop = asyncio.get_running_loop()
+        self._waiter = loop.create_future()
+        handle = None
+        if seconds != float('inf'):
+            handle = loop.call_later(seconds, self._wake)
+        try:
+            await self._waiter
+        finally:
+            if handle is not None:
+                handle.cancel()
+            self._waiter = None
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _next_wait(self, now: float) -> Optional[float]:
+        """
+        Сколько ждать до следующей отправки
+
+        Returns:
+            None - можно отправлять сейчас, inf - ждать нового события
+            (постановки или завершения отправки), иначе число секунд
+        """
+        global_wait = self.global_bucket.time_until_available(1, now)
+        paused = self._paused_until - now
+        if self._ready and self._in_flight < self.max_in_flight and paused <= 0 and global_wait <= 0:
+            return None
+
+        timeouts = [wait for wait in (paused, global_wait) if wait > 0]
+        if not self._ready and self._delayed:
+            timeouts.append(self._delayed[0][0] - now)
+
+        if self._in_flight >= self.max_in_flight or not (self._ready or self._delayed):
+            return max(timeouts) if timeouts else float('inf')
+        return max(timeouts)
+
+    async def _deliver(self, item: _OutboundItem):
+        """Отправка одного сообщения"""
+        item.attempts += 1
+        try:
+            result = await item.send()
+
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is not None and item.attempts <= self.max_retries:
+                # 429: возвращаем сообщение в голову очереди чата и ждем
+                self.stats['retry_after'] += 1
+                logger.warning(f"⏳ Лимит Telegram для чата {item.chat_id}: повтор через {retry_after} сек")
+                heapq.heappush(self._chat_queues.setdefault(item.chat_id, []), (item.priority, item.seq, item))
+                self._delay_chat(item.chat_id, time.monotonic() + float(retry_after))
+            else:
+                self.stats['failed'] += 1
+                logger.error(f"❌ Ошибка отправки в чат {item.chat_id}: {e}")
+                if not item.future.done():
+                    item.future.set_exception(e)
+
+        else:
+            waited = time.monotonic() - item.queued_at
+            self.stats['sent'] += 1
+            self.stats['total_wait_seconds'] += waited
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+            by_priority = self.stats['sent_by_priority']
+            by_priority[item.priority] = by_priority.get(item.priority, 0) + 1
+            if not item.future.done():
+                item.future.set_result(result)
+
+        finally:
+            self._in_flight -= 1
+            self._in_flight_chats.discard(item.chat_id)
+            self._push_ready(item.chat_id)
+            self._wake()
+
+    def pause(self, seconds: float):
+        """Пауза всех отправок (например, после общего флуд-лимита)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики очереди"""
+        sent = self.stats['sent']
+        return {
+            **self.stats,
+            'sent_by_priority': dict(self.stats['sent_by_priority']),
+            'avg_wait_seconds': self.stats['total_wait_seconds'] / sent if sent else 0.0,
+            'queue_depth': sum(len(queue) for queue in self._chat_queues.values()),
+            'queued_chats': len(self._chat_queues),
+            'delayed_chats': len(self._delayed_chats),
+            'in_flight': self._in_flight
+        }
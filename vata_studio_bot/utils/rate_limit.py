@@ -0,0 +1,124 @@
+﻿import time
+from collections import OrderedDict
+from typing import Dict, Any, Hashable, Optional
+
+class TokenBucket:
+    """
+    Корзина токенов
+
+    Вмещает capacity токенов и пополняется со скоростью rate токенов
+    в секунду. Пополнение считается лениво при обращении, поэтому
+    проверка стоит O(1) по времени и памяти.
+    """
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated_at')
+
+    def __init__(self, capacity: float, rate: float, now: Optional[float] = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def try_consume(self, amount: float = 1.0, now: Optional[float] = None) -> bool:
+        """Списать amount токенов, если они есть"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def refund(self, amount: float = 1.0):
+        """Вернуть токены (если запрос отклонен на следующей ступени)"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def time_until_available(self, amount: float = 1.0, now: Optional[float] = None) -> float:
+        """Через сколько секунд будет доступно amount токенов"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        """Корзина полна - ее можно удалить без потери состояния"""
+        return self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+class RateLimiter:
+    """
+    Набор корзин токенов по ключу (пользователь, чат и т.п.)
+
+    Корзины хранятся в порядке последнего обращения. Корзина, которая
+    успела полностью наполниться, ничем не отличается от новой, поэтому
+    такие корзины удаляются с головы очереди за амортизированное O(1).
+    """
+
+    def __init__(self, capacity: float, per_seconds: float, max_keys: int = 100000):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+        # Статистика
+        self.stats = {
+            'allowed': 0,
+            'rejected': 0,
+            'evicted': 0
+        }
+
+    def configure(self, capacity: float, per_seconds: float):
+        """Изменение лимита (существующие корзины сбрасываются)"""
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self._buckets.clear()
+
+    def bucket(self, key: Hashable, now: float) -> TokenBucket:
+        """Корзина для ключа (создается при первом обращении)"""
+        # Вытесняем до выдачи, чтобы не удалить корзину, которую сейчас вернем
+        self._evict(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, self.rate, now)
+            self._buckets[key] = bucket
+        else:
+            self._buckets.move_to_end(key)
+
+        return bucket
+
+    def allow(self, key: Hashable, amount: float = 1.0, now: Optional[float] = None) -> bool:
+        """Проверка и списание токена для ключа"""
+        now = time.monotonic() if now is None else now
+        if self.bucket(key, now).try_consume(amount, now):
+            self.stats['allowed'] += 1
+            return True
+
+        self.stats['rejected'] += 1
+        return False
+
+    def refund(self, key: Hashable, amount: float = 1.0):
+        """Вернуть токен ключу"""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.refund(amount)
+            self.stats['allowed'] -= 1
+
+    def _evict(self, now: float):
+        """Удаление простаивающих корзин с головы очереди"""
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and not bucket.is_full(now):
+                break
+            del self._buckets[key]
+            self.stats['evicted'] += 1
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика лимитера"""
+        return {**self.stats, 'buckets': len(self._buckets)}
@@ -0,0 +1,72 @@
+﻿import math
+import time
+from typing import Dict, List, Hashable, Optional
+
+class TimerWheel:
+    """
+    Хэшированное колесо таймеров
+
+    Время делится на тики длиной tick_seconds; таймер кладется в ячейку
+    тика, в котором наступает его срок. advance() обходит только ячейки
+    прошедших тиков, поэтому постановка, отмена и срабатывание стоят
+    амортизированное O(1) независимо от общего числа таймеров. Таймеры
+    дальше одного оборота колеса (tick_seconds * slots) остаются в ячейке
+    и проверяются раз за оборот.
+    """
+
+    def __init__(self, tick_seconds: float = 1.0, slots: int = 4096, now: Optional[float] = None):
+        self.tick_seconds = tick_seconds
+        self._slots: List[Dict[Hashable, float]] = [{} for _ in range(slots)]
+        self._where: Dict[Hashable, int] = {}
+        self._current_tick = self._tick_of(time.monotonic() if now is None else now)
+
+    def _tick_of(self, moment: float) -> int:
+        return int(moment // self.tick_seconds)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """Поставить (или переставить) таймер key на момент deadline (time.monotonic)"""
+        self.cancel(key)
+
+        # Ячейка с округлением вверх: к ее обходу срок гарантированно наступил
+        tick = max(math.ceil(deadline / self.tick_seconds), self._current_tick + 1)
+        index = tick % len(self._slots)
+        self._slots[index][key] = deadline
+        self._where[key] = index
+
+    def cancel(self, key: Hashable) -> bool:
+        """Отменить таймер"""
+        index = self._where.pop(key, None)
+        if index is None:
+            return False
+        del self._slots[index][key]
+        return True
+
+    def advance(self, now: Optional[float] = None) -> List[Hashable]:
+        """
+        Прокрутить колесо до момента now
+
+        Returns:
+            Ключи таймеров, срок которых наступил
+        """
+        now = time.monotonic() if now is None else now
+        target = self._tick_of(now)
+        expired = []
+
+        # После долгого простоя достаточно обойти каждую ячейку один раз
+        steps = min(target - self._current_tick, len(self._slots))
+        for step in range(1, steps + 1):
+            slot = self._slots[(self._current_tick + step) % len(self._slots)]
+            due = [key for key, deadline in slot.items() if deadline <= now]
+            for key in due:
+                del slot[key]
+                del self._where[key]
+            expired.extend(due)
+
+        self._current_tick = max(self._current_tick, target)
+        return expired
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def __len__(self) -> int:
+        return len(self._where)